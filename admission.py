@@ -0,0 +1,184 @@
+"""Admission control in front of the graph: bounded concurrency, a bounded fair queue, early rejection.
+
+At most ADMISSION_MAX_INFLIGHT recommendations run at once; beyond that requests wait in a queue
+of at most ADMISSION_MAX_QUEUE (ADMISSION_MAX_QUEUED_PER_USER per user). A freed slot goes to the
+queued user with the fewest running requests, round-robin among equals, so one user resubmitting
+can't starve everyone else. A request is turned away with Busy right away when the queue is full
+or its expected wait (queue position x recent service time) exceeds ADMISSION_MAX_WAIT, and
+after ADMISSION_MAX_WAIT in the queue otherwise. Under overload the model server keeps working
+on a steady number of requests instead of timing all of them out.
+
+Metrics (with TRACE_ENABLED=1): admission_inflight and admission_queue_depth gauges, the
+admission_wait_seconds histogram and admission_requests_total{outcome}.
+"""
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+import tracing
+from asynclog import logger
+
+ADMISSION_MAX_INFLIGHT = int(os.environ.get("ADMISSION_MAX_INFLIGHT", "4"))
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", "32"))
+ADMISSION_MAX_QUEUED_PER_USER = int(os.environ.get("ADMISSION_MAX_QUEUED_PER_USER", "2"))
+# Seconds a request may wait for a slot before it is told to come back later
+ADMISSION_MAX_WAIT = float(os.environ.get("ADMISSION_MAX_WAIT", "20"))
+# Set to 1 only when the app is reachable solely through a reverse proxy that appends X-Forwarded-For;
+# otherwise any client could pick its own user key with that header and dodge the per-user limits
+ADMISSION_TRUST_PROXY = os.environ.get("ADMISSION_TRUST_PROXY", "0") == "1"
+
+class Busy(Exception):
+    """Raised instead of queueing a request that would wait too long; `retry_after` is in seconds"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+class AdmissionController:
+    def __init__(
+        self,
+        max_inflight=ADMISSION_MAX_INFLIGHT,
+        max_queue=ADMISSION_MAX_QUEUE,
+        max_queued_per_user=ADMISSION_MAX_QUEUED_PER_USER,
+        max_wait=ADMISSION_MAX_WAIT,
+    ):
+        self.max_inflight = max(1, max_inflight)
+        self.max_queue = max_queue
+        self.max_queued_per_user = max_queued_per_user
+        self.max_wait = max_wait
+        self.inflight = 0
+        self.queued = 0
+        self._running = {}           # user -> running requests
+        self._queues = OrderedDict()  # user -> deque of futures, in round-robin order
+        # Moving average of how long an admitted request holds its slot
+        self._service_time = None
+
+    def would_queue(self):
+        return self.inflight >= self.max_inflight or self.queued > 0
+
+    def expected_wait(self, position):
+        """Seconds until the request at queue `position` (0 = next) gets a slot, None if unknown"""
+        if self._service_time is None:
+            return None
+        return math.ceil((position + 1) / self.max_inflight) * self._service_time
+
+    def _reject(self, outcome, reason, retry_after):
+        tracing.incr("admission_requests_total", outcome=outcome)
+        logger.warning("[admission] Rejected (%s): %d running, %d queued", reason, self.inflight, self.queued)
+        raise Busy(reason, retry_after)
+
+    def _grant(self, user):
+        self.inflight += 1
+        self._running[user] = self._running.get(user, 0) + 1
+
+    async def acquire(self, user):
+        """Wait for a slot for `user`; raises Busy when there is no room"""
+        started = time.perf_counter()
+        if not self.would_queue():
+            self._grant(user)
+            self._admitted(started)
+            return
+
+        retry_after = self.expected_wait(self.queued) or self.max_wait
+        if self.queued >= self.max_queue:
+            self._reject("queue_full", "the queue is full", retry_after)
+        user_queue = self._queues.get(user)
+        if user_queue is not None and len(user_queue) >= self.max_queued_per_user:
+            self._reject("user_queue_full", "you already have requests waiting", retry_after)
+        expected = self.expected_wait(self.queued)
+        if expected is not None and expected > self.max_wait:
+            self._reject("expected_wait", f"the expected wait is about {expected:.1f}s", expected)
+
+        waiter = asyncio.get_running_loop().create_future()
+        if user_queue is None:
+            user_queue = self._queues[user] = deque()
+        user_queue.append(waiter)
+        self.queued += 1
+        self._publish()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # Granted at the same moment it gave up; hand the slot on
+                self.release(user)
+            else:
+                waiter.cancel()
+                self._remove(user, waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                self._reject("timeout", f"no slot freed up within {self.max_wait:.1f}s", self.max_wait)
+            raise
+        self._admitted(started)
+
+    def _admitted(self, started):
+        tracing.incr("admission_requests_total", outcome="admitted")
+        tracing.observe("admission_wait_seconds", time.perf_counter() - started)
+        self._publish()
+
+    def _remove(self, user, waiter):
+        user_queue = self._queues.get(user)
+        if user_queue is None or waiter not in user_queue:
+            return
+        user_queue.remove(waiter)
+        self.queued -= 1
+        if not user_queue:
+            del self._queues[user]
+        self._publish()
+
+    def release(self, user, service_time=None):
+        self.inflight -= 1
+        self._running[user] -= 1
+        if not self._running[user]:
+            del self._running[user]
+        if service_time is not None:
+            self._service_time = service_time if self._service_time is None else 0.8 * self._service_time + 0.2 * service_time
+        self._dispatch()
+        self._publish()
+
+    def _dispatch(self):
+        while self.inflight < self.max_inflight and self._queues:
+            # Fewest running requests first; min() keeps the round-robin order among ties
+            user = min(self._queues, key=lambda u: self._running.get(u, 0))
+            user_queue = self._queues.pop(user)
+            waiter = user_queue.popleft()
+            self.queued -= 1
+            if user_queue:
+                self._queues[user] = user_queue  # back of the line
+            self._grant(user)
+            waiter.set_result(None)
+
+    def _publish(self):
+        tracing.set_gauge("admission_inflight", self.inflight)
+        tracing.set_gauge("admission_queue_depth", self.queued)
+
+    @asynccontextmanager
+    async def admit(self, user):
+        await self.acquire(user)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(user, time.perf_counter() - started)
+
+    def stats(self):
+        return {
+            "inflight": self.inflight,
+            "queued": self.queued,
+            "users_waiting": len(self._queues),
+            "service_time": self._service_time,
+        }
+
+def user_key(request):
+    """Who a Gradio request belongs to for fair sharing: the client address, else the browser session"""
+    if request is None:
+        return None
+    if ADMISSION_TRUST_PROXY:
+        forwarded = (getattr(request, "headers", None) or {}).get("x-forwarded-for", "")
+        if forwarded:
+            # The last entry is the one our proxy appended; anything before it came from the client
+            return forwarded.split(",")[-1].strip()
+    client = getattr(request, "client", None)
+    host = getattr(client, "host", None)
+    return host or getattr(request, "session_hash", None)
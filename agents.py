@@ -1,405 +1,438 @@
-from langgraph.graph import StateGraph, END
-from search import duckduckgo_search
-import ollama
+from providers import SearchUnavailable, search_books
+from ratelimit import gather_bounded, SEARCH_MAX_INFLIGHT
+import llm
+from jsonparse import (
+    AUTHORED_BOOK_LIST_SCHEMA,
+    BOOK_LIST_SCHEMA,
+    RECOMMENDATION_LIST_SCHEMA,
+    check_book,
+    check_recommendation,
+    parse_json_array,
+)
 import asyncio
 import re
 import json
-import asyncio
-import httpx
 import os
-import ast
-import traceback
-
-class AsyncLogger:
-    def __init__(self):
-        self._log = []
-        self._lock = asyncio.Lock()
-    
-    async def log(self, message):
-        async with self._lock:
-            self._log.append(message)
-    
-    async def get_log(self):
-        async with self._lock:
-            return "\n".join(self._log)
-    
-    async def clear(self):
-        async with self._lock:
-            self._log.clear()
-
-logger = AsyncLogger()
-
-def extract_json_array(text: str):
-    # Remove Markdown/HTML formatting
-    text = re.sub(r"```(?:json)?\n?|</?(?:pre|code|p)>", "", text, flags=re.IGNORECASE)
-
-    # Extract the first [...] block
-    match = re.search(r"(\[\s*{.*?}\s*\])", text, re.DOTALL)
-    if not match:
-        # Try to find any JSON array in the text
-        match = re.search(r"(\[.*?\])", text, re.DOTALL)
-        if not match:
-            return []
-    
-    json_str = match.group(1)
-
-    # Try parsing as JSON
-    try:
-        return json.loads(json_str)
-    except json.JSONDecodeError as e:
-        print("[extract_json_array] JSON decode error:", e)
-
-        # Fallback: try ast.literal_eval
-        try:
-            return ast.literal_eval(json_str)
-        except Exception as e2:
-            print("[extract_json_array] literal_eval failed:", e2)
-            # Try to fix common JSON issues
-            try:
-                # Remove trailing commas
-                json_str = re.sub(r',\s*}', '}', json_str)
-                json_str = re.sub(r',\s*]', ']', json_str)
-                # Fix unquoted keys
-                json_str = re.sub(r'(\w+):', r'"\1":', json_str)
-                # Fix extra quotes around objects
-                json_str = re.sub(r'"\s*{\s*"', '{"', json_str)
-                json_str = re.sub(r'"\s*}\s*"', '"}', json_str)
-                # Fix missing commas between objects
-                json_str = re.sub(r'"\s*}\s*{', '"},{', json_str)
-                # Fix extra quotes around individual objects in arrays
-                json_str = re.sub(r'"\s*({[^}]+})\s*"', r'\1', json_str)
-                return json.loads(json_str)
-            except Exception as e3:
-                print("[extract_json_array] JSON fixing failed:", e3)
-                return []
-
-def safe_json_parse(content: str, fallback_value=None):
-    """Safely parse JSON content with multiple fallback strategies"""
-    if fallback_value is None:
-        fallback_value = []
-    
-    # Clean the content
-    cleaned_content = re.sub(r"```(?:json)?\n?|</?(?:pre|code|p)>", "", content, flags=re.IGNORECASE).strip()
-    
-    # Try direct JSON parsing
-    try:
-        return json.loads(cleaned_content)
-    except json.JSONDecodeError as e:
-        print(f"[safe_json_parse] JSONDecodeError: {e}")
-        
-        # Try to extract JSON array
-        extracted = extract_json_array(cleaned_content)
-        if extracted:
-            return extracted
-            
-        # Try ast.literal_eval
-        try:
-            return ast.literal_eval(cleaned_content)
-        except Exception as e2:
-            print(f"[safe_json_parse] literal_eval failed: {e2}")
-            
-            # Try to fix common JSON issues
-            try:
-                # Remove trailing commas
-                fixed_content = re.sub(r',\s*}', '}', cleaned_content)
-                fixed_content = re.sub(r',\s*]', ']', fixed_content)
-                # Fix unquoted keys
-                fixed_content = re.sub(r'(\w+):', r'"\1":', fixed_content)
-                # Fix single quotes to double quotes
-                fixed_content = fixed_content.replace("'", '"')
-                # Fix extra quotes around objects
-                fixed_content = re.sub(r'"\s*{\s*"', '{"', fixed_content)
-                fixed_content = re.sub(r'"\s*}\s*"', '"}', fixed_content)
-                # Fix missing commas between objects
-                fixed_content = re.sub(r'"\s*}\s*{', '"},{', fixed_content)
-                # Fix extra quotes around individual objects in arrays
-                fixed_content = re.sub(r'"\s*({[^}]+})\s*"', r'\1', fixed_content)
-                return json.loads(fixed_content)
-            except Exception as e3:
-                print(f"[safe_json_parse] JSON fixing failed: {e3}")
-                return fallback_value
-
-def merge_state(current_state: dict, new_data: dict) -> dict:
-    """Safely merge new data into current state, preserving existing data"""
-    merged_state = current_state.copy()
-    for key, value in new_data.items():
-        if key in merged_state:
-            # If both are lists, extend the current list
-            if isinstance(merged_state[key], list) and isinstance(value, list):
-                merged_state[key].extend(value)
-            # If both are strings, concatenate them
-            elif isinstance(merged_state[key], str) and isinstance(value, str):
-                merged_state[key] += "\n" + value
-            # Otherwise, overwrite
-            else:
-                merged_state[key] = value
-        else:
-            merged_state[key] = value
-    return merged_state
+from typing import Annotated, TypedDict
+from jsonparse import ArrayScanner
+from rerank import prerank, format_hit, PRERANK_TOKEN_BUDGET
+import prompts
+from catalog import get_catalog, normalize_title
+import tracing
+from tracing import traced_node
+from asynclog import logger, request_logged
+from deadline import remaining
+import runtrace
+from runtrace import append_events
+
+# langgraph is imported by build_graph, not at import time
+
+
+# Ask the model server for schema-constrained JSON; turn off for models/servers without support
+STRUCTURED_OUTPUT = os.environ.get("LLM_STRUCTURED_OUTPUT", "1") == "1"
+# Overlap extraction with searching: parse books from the token stream and search each one right away
+PIPELINE_STREAMING = os.environ.get("PIPELINE_STREAMING", "0") == "1"
+
+# "conditional" skips nodes the input doesn't need, "fixed" always runs all four (for comparison)
+GRAPH_ROUTING = os.environ.get("GRAPH_ROUTING", "conditional")
+# Have the extraction call fill in missing authors itself, instead of a separate completion call
+FUSE_AUTHOR_COMPLETION = os.environ.get("FUSE_AUTHOR_COMPLETION", "0") == "1"
+# Per-book search results remembered within a session, oldest dropped first
+BOOK_MEMO_MAX = int(os.environ.get("BOOK_MEMO_MAX", "64"))
+# With less time than this left, reasoning returns the top search hits instead of calling the model
+REASONING_MIN_BUDGET = float(os.environ.get("REASONING_MIN_BUDGET", "3"))
+
+def output_format(schema):
+    return schema if STRUCTURED_OUTPUT else None
+
+def merge_book_searches(current, update):
+    """Reducer for the per-book memo: new entries are added, the oldest fall out past BOOK_MEMO_MAX"""
+    merged = {**(current or {}), **(update or {})}
+    if len(merged) > BOOK_MEMO_MAX:
+        merged = dict(list(merged.items())[-BOOK_MEMO_MAX:])
+    return merged
+
+class RecommenderState(TypedDict, total=False):
+    user_input: str
+    # The user_input that extracted_books came from, so an unchanged resubmission skips extraction
+    extracted_from: str
+    extracted_books: list
+    recommendations: list
+    final_recommendations: list
+    # What the run did, as runtrace records; rendered to text by the caller
+    events: Annotated[list, append_events]
+    # book_key(book) -> [query, results] of its similarity search
+    book_searches: Annotated[dict, merge_book_searches]
+    # Absolute time.time() the request must finish by (see deadline.py), None for no limit;
+    # checkpointed like everything else, so every input must bring its own
+    deadline: float
+
+def llm_timeout(deadline):
+    return remaining(deadline, llm.LLM_TIMEOUT)
+
+def book_key(book):
+    author = re.sub(r"\s+", " ", book.get("author", "")).strip().lower()
+    return f"{normalize_title(book.get('title', ''))}|{author}"
+
+def extraction_prompt(fill_authors=False):
+    return prompts.EXTRACT_WITH_AUTHORS if fill_authors else prompts.EXTRACT
+
+def clean_book(book):
+    """Normalize one book entry to {title, author} strings, None if it has no title"""
+    if not isinstance(book, dict):
+        return None
+    validated_book = {
+        "title": str(book.get("title", "")).strip(),
+        "author": str(book.get("author", "")).strip()
+    }
+    if not validated_book["title"]:  # Only keep books with a title
+        return None
+    return validated_book
+
+def clean_books(books):
+    # Ensure books is a list and each book has required fields
+    if not isinstance(books, list):
+        return []
+    return [b for b in (clean_book(book) for book in books) if b is not None]
 
 # Node 1: Extract books from user input
 async def extract_books_node(state):
     try:
-        print("[extract_books_node] 👉 enter")
+        logger.info("[extract_books_node] 👉 enter")
         user_input = state.get("user_input", "")
-        prompt = (
-            "Extract all book titles and authors from the user input. Do not add books on your own, just take the user input."
-            "If a book is mentioned but the author is missing, try to fill the missing author in using reasoning with your knowledge."
-            "IMPORTANT: Output ONLY a valid JSON array with this exact format:\n"
-            '[{"title": "Book Title", "author": "Author Name"}]\n'
-            "Rules:\n"
-            "- Use double quotes for all strings\n"
-            "- No trailing commas\n"
-            "- No markdown formatting or code blocks\n"
-            "- No explanations or extra text\n"
-            "- If no books found, return empty array: []\n\n"
-            f"User input: {user_input}"
-        )
-        print("[extract_books_node] Prompt sent to LLM:\n", prompt)
+        started = [runtrace.RunStarted(user_input)]
+        if state.get("extracted_books") is not None and state.get("extracted_from") == user_input:
+            # Same input as the session's last run; its books are still in the checkpoint
+            logger.info("[extract_books_node] Input unchanged, reusing %d extracted books", len(state["extracted_books"]))
+            return {"events": started}
+        prompt = extraction_prompt(FUSE_AUTHOR_COMPLETION)
+        data = prompt.fit_text(user_input)
+        logger.debug("[extract_books_node] Prompt data sent to LLM:\n%s", data)
 
-        response = ollama.chat(model="llama3", messages=[{"role": "user", "content": prompt}])
+        try:
+            response = await llm.chat(
+                **prompt.chat_args(data),
+                timeout=llm_timeout(state.get("deadline")),
+                format=output_format(AUTHORED_BOOK_LIST_SCHEMA if FUSE_AUTHOR_COMPLETION else BOOK_LIST_SCHEMA),
+                cache=True,
+            )
+        except asyncio.TimeoutError:
+            # Clear extracted_from, or the previous run's input would match and reuse these empty books
+            logger.warning("[extract_books_node] Extraction ran out of time, continuing without books")
+            return {"extracted_books": [], "extracted_from": None, "events": started}
         content = response["message"]["content"]
 
-        print("[extract_books_node] Raw LLM response:\n", repr(content))
-        print(f"[extract_books_node] Response type: {type(content)}, length: {len(content)}")
+        logger.debug("[extract_books_node] Raw LLM response:\n%r", content)
 
-        # Use the new safe JSON parsing function
-        books = safe_json_parse(content, fallback_value=[])
-        
-        # If parsing completely failed, try to extract book titles manually
-        if not books and content:
-            print("[extract_books_node] JSON parsing failed, attempting manual extraction")
-            # Look for patterns like "title" or "book" in the content
-            lines = content.split('\n')
-            manual_books = []
-            for line in lines:
-                line = line.strip()
-                if any(keyword in line.lower() for keyword in ['title', 'book', 'author']):
-                    # Try to extract title and author from the line
-                    title_match = re.search(r'"title":\s*"([^"]+)"', line)
-                    author_match = re.search(r'"author":\s*"([^"]+)"', line)
-                    if title_match:
-                        title = title_match.group(1)
-                        author = author_match.group(1) if author_match else "Unknown"
-                        manual_books.append({"title": title, "author": author})
-            
-            if manual_books:
-                books = manual_books
-                print("[extract_books_node] Manual extraction successful:", books)
-            else:
-                # Last resort: try to extract from the specific malformed pattern we saw
-                print("[extract_books_node] Attempting pattern-based extraction")
-                # Look for patterns like "title": "Book Name"
-                title_matches = re.findall(r'"title":\s*"([^"]+)"', content)
-                author_matches = re.findall(r'"author":\s*"([^"]+)"', content)
-                
-                if title_matches:
-                    for i, title in enumerate(title_matches):
-                        author = author_matches[i] if i < len(author_matches) else "Unknown"
-                        manual_books.append({"title": title, "author": author})
-                    
-                    if manual_books:
-                        books = manual_books
-                        print("[extract_books_node] Pattern-based extraction successful:", books)
-        
-        # Additional fix: if books is a list but contains malformed strings, try to fix them
-        if isinstance(books, list) and books:
-            print("[extract_books_node] Checking for malformed book entries...")
-            fixed_books = []
-            for book in books:
-                if isinstance(book, str):
-                    # Try to parse the string as JSON
-                    try:
-                        # Remove extra quotes around the object
-                        cleaned_book = book.strip()
-                        if cleaned_book.startswith('"') and cleaned_book.endswith('"'):
-                            cleaned_book = cleaned_book[1:-1]
-                        parsed_book = json.loads(cleaned_book)
-                        if isinstance(parsed_book, dict) and parsed_book.get("title"):
-                            fixed_books.append(parsed_book)
-                    except:
-                        # Try regex extraction as fallback
-                        title_match = re.search(r'"title":\s*"([^"]+)"', book)
-                        author_match = re.search(r'"author":\s*"([^"]+)"', book)
-                        if title_match:
-                            title = title_match.group(1)
-                            author = author_match.group(1) if author_match else "Unknown"
-                            fixed_books.append({"title": title, "author": author})
-                elif isinstance(book, dict) and book.get("title"):
-                    fixed_books.append(book)
-            
-            if fixed_books:
-                books = fixed_books
-                print("[extract_books_node] Fixed malformed book entries:", books)
-        
-        print("[extract_books_node] Parsed books:", books)
+        # Constrained replies parse directly, anything else goes through the single-pass scanner
+        books = parse_json_array(content, check_book)
+        logger.debug("[extract_books_node] Parsed books: %s", books)
 
-        # Ensure books is a list and each book has required fields
-        if not isinstance(books, list):
-            books = []
-        
-        # Validate and clean each book entry
-        validated_books = []
-        for book in books:
-            if isinstance(book, dict):
-                validated_book = {
-                    "title": str(book.get("title", "")).strip(),
-                    "author": str(book.get("author", "")).strip()
-                }
-                if validated_book["title"]:  # Only add if title is not empty
-                    validated_books.append(validated_book)
-        
-        print("[extract_books_node] Validated books:", validated_books)
-        print("[extract_books_node] 👈 exit with", {"extracted_books": validated_books})
-        return {"extracted_books": validated_books}
+        # The catalog is free, so authors it knows never trigger a completion call
+        validated_books = [book if book["author"] else resolve_from_catalog(book) for book in clean_books(books)]
+        logger.info("[extract_books_node] 👈 exit with %d books: %s", len(validated_books), validated_books)
+        return {"extracted_books": validated_books, "extracted_from": user_input, "events": started}
 
     except Exception as e:
-        print("[extract_books_node] ❌ exception:", repr(e))
-        print("[extract_books_node] Traceback:\n", traceback.format_exc())
+        logger.exception("[extract_books_node] ❌ exception: %r", e)
         raise
 
-# Node 1.1 New Node: Complete missing authors
-async def complete_authors_node(state):
-    try:
-        print("[complete_authors_node] 👉 enter")
-        books = state.get("extracted_books", [])
-        incomplete_books = [book for book in books if not book.get("author", "").strip()]
-
-        if not incomplete_books:
-            print("[complete_authors_node] No missing authors to complete.")
-            return {"extracted_books": books}
-
-        # Prepare prompt for LLM
-        prompt = (
-            "You are given a list of books with some missing authors. "
-            "For each book, fill in the correct author using your knowledge. "
-            "IMPORTANT: Output ONLY a valid JSON array with this exact format:\n"
-            '[{"title": "Book Title", "author": "Author Name"}]\n'
-            "Rules:\n"
-            "- Use double quotes for all strings\n"
-            "- No trailing commas\n"
-            "- No markdown formatting or code blocks\n"
-            "- No explanations or extra text\n"
-            "- Return all books, not just the ones with missing authors\n\n"
-            f"Books with missing authors:\n{json.dumps(incomplete_books, ensure_ascii=False)}"
+def resolve_from_catalog(book):
+    """Canonical title and, if missing, the author from the offline catalog; unchanged on a miss"""
+    catalog = get_catalog()
+    if catalog is None:
+        return book
+    match = catalog.resolve(book["title"])
+    if match is None:
+        return book
+    title, author = match
+    logger.info("[complete_authors_node] Catalog match for '%s': '%s' by %s", book["title"], title, author)
+    return {"title": title, "author": book.get("author", "").strip() or author}
+
+async def complete_missing_authors(books, deadline=None):
+    """Fill in missing authors from the catalog, then one LLM call, then a DuckDuckGo lookup"""
+    books = [resolve_from_catalog(book) for book in books]
+    incomplete_books = [book for book in books if not book.get("author", "").strip()]
+
+    if not incomplete_books:
+        logger.info("[complete_authors_node] No missing authors to complete.")
+        return books
+
+    # A long list goes out in several calls, each within the prompt's budget
+    chunks = prompts.AUTHORS.chunk_items(incomplete_books, lambda book: json.dumps(book, ensure_ascii=False))
+    replies = await asyncio.gather(*(complete_authors_chunk(chunk, deadline) for chunk in chunks))
+    completed_books_from_llm = [book for reply in replies for book in reply]
+    logger.debug("[complete_authors_node] Parsed completed books: %s", completed_books_from_llm)
+
+    # Merge back into the full book list
+    title_to_author = {book["title"]: book.get("author", "Unknown") for book in completed_books_from_llm}
+    completed_books = []
+    for book in books:
+        title = book.get("title", "").strip()
+        author = book.get("author", "").strip()
+        if not author:
+            # Fill from LLM result, DuckDuckGo fallback runs below for what is still missing
+            author = title_to_author.get(title, "").strip()
+        completed_books.append({
+            "title": title,
+            "author": author
+        })
+
+    # DuckDuckGo fallback for authors the LLM could not fill, all lookups run concurrently
+    missing = [book for book in completed_books if not book["author"]]
+    if missing:
+        found_authors = await gather_bounded(
+            [search_author(book["title"], deadline) for book in missing], limit=SEARCH_MAX_INFLIGHT
         )
+        for book, found_author in zip(missing, found_authors):
+            book["author"] = found_author
 
-        print("[complete_authors_node] Prompt sent to LLM:\n", prompt)
-        response = ollama.chat(model="llama3", messages=[{"role": "user", "content": prompt}])
+    validated_books = clean_books(completed_books)
+    logger.info("[complete_authors_node] Validated completed books: %s", validated_books)
+    return validated_books
+
+async def complete_authors_chunk(books, deadline=None):
+    data = json.dumps(books, ensure_ascii=False)
+    logger.debug("[complete_authors_node] Prompt data sent to LLM:\n%s", data)
+    try:
+        response = await llm.chat(
+            **prompts.AUTHORS.chat_args(data),
+            timeout=llm_timeout(deadline),
+            format=output_format(BOOK_LIST_SCHEMA),
+            cache=True,
+        )
         content = response["message"]["content"]
+    except asyncio.TimeoutError:
+        logger.warning("[complete_authors_node] Author completion ran out of time")
+        content = "[]"
 
-        print("[complete_authors_node] Raw LLM response:\n", repr(content))
-        print(f"[complete_authors_node] Response type: {type(content)}, length: {len(content)}")
-
-        # Use the new safe JSON parsing function
-        completed_books_from_llm = safe_json_parse(content, fallback_value=[])
-        print("[complete_authors_node] Parsed completed books:", completed_books_from_llm)
-
-        # Merge back into the full book list
-        title_to_author = {book["title"]: book.get("author", "Unknown") for book in completed_books_from_llm}
-        completed_books = []
-        for book in books:
-            title = book.get("title", "").strip()
-            author = book.get("author", "").strip()
-            if not author:
-                # Fill from LLM result or fallback to DuckDuckGo
-                author = title_to_author.get(title, "").strip()
-                if not author:
-                    # DuckDuckGo fallback if still missing
-                    query = f"{title} book author"
-                    print(f"[complete_authors_node] Searching DuckDuckGo for author: {query}")
-                    search_results = await duckduckgo_search(query)
-
-                    found_author = "Unknown"
-                    if search_results:
-                        for res in search_results:
-                            snippet = res.get("snippet", "")
-                            title_text = res.get("title", "")
-                            match = re.search(r"by ([A-Z][a-z]+(?: [A-Z][a-z]+)*)", snippet + " " + title_text)
-                            if match:
-                                found_author = match.group(1)
-                                print(f"[complete_authors_node] Found author '{found_author}' for book '{title}'")
-                                break
-                    author = found_author
-
-            completed_books.append({
-                "title": title,
-                "author": author
-            })
+    logger.debug("[complete_authors_node] Raw LLM response:\n%r", content)
+    return parse_json_array(content, check_book)
 
-        # Validate the completed books
-        validated_books = []
-        for book in completed_books:
-            if isinstance(book, dict):
-                validated_book = {
-                    "title": str(book.get("title", "")).strip(),
-                    "author": str(book.get("author", "")).strip()
-                }
-                if validated_book["title"]:  # Only add if title is not empty
-                    validated_books.append(validated_book)
-        
-        print("[complete_authors_node] Validated completed books:", validated_books)
-        return {"extracted_books": validated_books}
+# Node 1.1 New Node: Complete missing authors
+async def complete_authors_node(state):
+    try:
+        logger.info("[complete_authors_node] 👉 enter")
+        books = state.get("extracted_books", [])
+        return {"extracted_books": await complete_missing_authors(books, state.get("deadline"))}
 
     except Exception as e:
-        print("[complete_authors_node] ❌ exception:", repr(e))
-        print("[complete_authors_node] Traceback:\n", traceback.format_exc())
+        logger.exception("[complete_authors_node] ❌ exception: %r", e)
         raise
 
+async def search_author(title, deadline=None):
+    query = f"{title} book author"
+    logger.info("[complete_authors_node] Searching for author: %s", query)
+    try:
+        search_results = await search_books(query, kind="author", title=title, deadline=deadline)
+    except (asyncio.TimeoutError, SearchUnavailable) as e:
+        logger.warning("[complete_authors_node] Author search for '%s' did not complete: %r", title, e)
+        return "Unknown"
+
+    for res in search_results or []:
+        snippet = res.get("snippet", "")
+        title_text = res.get("title", "")
+        match = re.search(r"by ([A-Z][a-z]+(?: [A-Z][a-z]+)*)", snippet + " " + title_text)
+        if match:
+            found_author = match.group(1)
+            logger.info("[complete_authors_node] Found author '%s' for book '%s'", found_author, title)
+            return found_author
+    return "Unknown"
+
 # Node 2
+async def search_similar(book, deadline=None):
+    """(query, results) for `book`; results is None when the search ran out of time or kept failing"""
+    title = book.get("title", "")
+    author = book.get("author", "")
+    query = f"Books similar to '{title}' by {author}"
+    logger.info("[recommend_books_node] Searching with query: %s", query)
+    try:
+        search_results = await search_books(query, kind="similar", title=title, deadline=deadline)
+    except (asyncio.TimeoutError, SearchUnavailable) as e:
+        logger.warning("[recommend_books_node] Search for '%s' did not complete: %r", title, e)
+        return query, None
+    return query, search_results
+
+def summarize_searches(searches):
+    """Turn (query, results) pairs into the recommendation list and the search events, in book order"""
+    events = []
+    recommended_books = []
+    for query, search_results in searches:
+        events.append(runtrace.SearchIssued(query))
+
+        if search_results is None:
+            events.append(runtrace.SearchSkipped(query))
+            continue
+        if not search_results:
+            events.append(runtrace.NoResults(query))
+            logger.info("[recommend_books_node] No results found for query: %s", query)
+            continue
+
+        logger.debug("[recommend_books_node] Results for query '%s': %s", query, search_results)
+
+        for res in search_results:
+            recommended_books.append({
+                "title": res.get("title", "No Title"),
+                "link": res.get("link", ""),
+                "snippet": res.get("snippet", "")
+            })
+            events.append(runtrace.HitFound(query, res.get("title", "No Title"), res.get("link", "")))
+
+    if not recommended_books:
+        events.append(runtrace.NoHits())
+    return recommended_books, events
+
 async def recommend_books_node(state):
     try:
-        print("[recommend_books_node] 👉 enter")
+        logger.info("[recommend_books_node] 👉 enter")
         extracted_books = state.get("extracted_books", [])
-        reasoning_steps = []
-        recommended_books = []
 
-        print("[recommend_books_node] Extracted books:", extracted_books)
-        # await logger.log(f"[recommend_books_node] Extracted books: {extracted_books}")
+        logger.debug("[recommend_books_node] Extracted books: %s", extracted_books)
 
         if not extracted_books:
-            reasoning_steps.append("No books extracted from the input. Check if the extraction failed.")
-            return {"recommendations": [], "reasoning": "\n".join(reasoning_steps)}
-
-        for book in extracted_books:
-            title = book.get("title", "")
-            author = book.get("author", "")
-            query = f"Books similar to '{title}' by {author}"
-            reasoning_steps.append(f"Searching DuckDuckGo with query: {query}")
-
-            print(f"[recommend_books_node] Searching with query: {query}")
-            # await logger.log(f"Searching DuckDuckGo with query: {query}")
-
-            search_results = await duckduckgo_search(query)
-
-            if not search_results:
-                reasoning_steps.append(f"No results found for: {query}")
-                print(f"[recommend_books_node] No results found for query: {query}")
-                # await logger.log(f"No results found for query: {query}")
-                continue
+            return {"extracted_books": [], "recommendations": [], "events": [runtrace.NoBooks()]}
+
+        # Only books without a remembered search go out; gather keeps results in book order
+        memo = state.get("book_searches") or {}
+        keys = [book_key(book) for book in extracted_books]
+        new_books = {key: book for key, book in zip(keys, extracted_books) if key not in memo}
+        logger.info("[recommend_books_node] %d of %d books reuse earlier searches", len(keys) - len(new_books), len(keys))
+        results = await gather_bounded(
+            [search_similar(book, state.get("deadline")) for book in new_books.values()], limit=SEARCH_MAX_INFLIGHT
+        )
+        searched = {key: list(result) for key, result in zip(new_books, results)}
+        searches = [searched.get(key) or memo[key] for key in keys]
+        # Unfinished searches aren't remembered, the next run tries them again
+        new_searches = {key: search for key, search in searched.items() if search[1] is not None}
 
-            print(f"[recommend_books_node] Results for query '{query}': {search_results}")
+        recommended_books, events = summarize_searches(searches)
 
-            for res in search_results:
-                recommended_books.append({
-                    "title": res.get("title", "No Title"),
-                    "link": res.get("link", ""),
-                    "snippet": res.get("snippet", "")
-                })
-                reasoning_steps.append(f"✅ Found: {res.get('title', 'No Title')} ({res.get('link', '')})")
+        logger.debug("[recommend_books_node] Final recommendations: %s", recommended_books)
+        logger.info("[recommend_books_node] 👈 exit with %d recommendations", len(recommended_books))
+        # reasoning_node needs the input books to filter them out of the hits
+        return {
+            "extracted_books": extracted_books,
+            "recommendations": recommended_books,
+            "events": events,
+            "book_searches": new_searches,
+        }
+    
+    except Exception as e:
+        logger.exception("[recommend_books_node] ❌ exception: %r", e)
+        raise
 
-        if not recommended_books:
-            reasoning_steps.append("No recommendations found across all queries.")
+# Node 1+2 (streaming pipeline): extract books and search for each as soon as it is parsed
+async def extract_and_search_node(state):
+    try:
+        logger.info("[extract_and_search_node] 👉 enter")
+        user_input = state.get("user_input", "")
+        prompt = extraction_prompt(FUSE_AUTHOR_COMPLETION)
+        data = prompt.fit_text(user_input)
+        logger.debug("[extract_and_search_node] Prompt data sent to LLM:\n%s", data)
+
+        semaphore = asyncio.Semaphore(max(1, SEARCH_MAX_INFLIGHT))
+
+        deadline = state.get("deadline")
+
+        async def limited_search(book):
+            async with semaphore:
+                return await search_similar(book, deadline)
+
+        scanner = ArrayScanner()
+        books = []
+        searches = {}  # index in books -> search task
+        reused = {}    # index in books -> remembered (query, results)
+        incomplete = []
+        memo = state.get("book_searches") or {}
+        extracted_from = user_input
+
+        def search_for(index, book):
+            remembered = memo.get(book_key(book))
+            if remembered is not None:
+                reused[index] = remembered
+                return
+            logger.info("[extract_and_search_node] Dispatching search for '%s' while extraction continues", book["title"])
+            searches[index] = asyncio.create_task(limited_search(book))
+
+        def dispatch(book):
+            if not book["author"]:
+                book = resolve_from_catalog(book)
+            index = len(books)
+            books.append(book)
+            if book["author"]:
+                search_for(index, book)
+            else:
+                incomplete.append(index)
 
-        print("[recommend_books_node] Final recommendations:", recommended_books)
-        print("[recommend_books_node] 👈 exit with", {"recommendations": recommended_books, "reasoning": "\n".join(reasoning_steps)})
+        try:
+            if state.get("extracted_books") is not None and state.get("extracted_from") == user_input:
+                # Same input as the session's last run; its books are still in the checkpoint
+                logger.info("[extract_and_search_node] Input unchanged, reusing %d extracted books", len(state["extracted_books"]))
+                for book in state["extracted_books"]:
+                    dispatch(book)
+            else:
+                try:
+                    async for chunk in llm.stream_chat(
+                        **prompt.chat_args(data),
+                        timeout=llm_timeout(deadline),
+                        format=output_format(AUTHORED_BOOK_LIST_SCHEMA if FUSE_AUTHOR_COMPLETION else BOOK_LIST_SCHEMA),
+                        cache=True,
+                    ):
+                        for item in scanner.feed(chunk["message"]["content"]):
+                            book = clean_book(item) if check_book(item) else None
+                            if book is not None:
+                                dispatch(book)
+                except asyncio.TimeoutError:
+                    # Keep the books parsed so far; the reply is cut off, so don't record it as extracted
+                    logger.warning("[extract_and_search_node] Extraction ran out of time after %d books", len(books))
+                    extracted_from = None
+                else:
+                    # Anything the scanner could only recover once the reply was complete
+                    for item in (scanner.finish() or [])[scanner.emitted:]:
+                        book = clean_book(item) if check_book(item) else None
+                        if book is not None:
+                            dispatch(book)
+
+            # Author completion only for the entries that came without one
+            if incomplete:
+                completed = await complete_missing_authors([books[i] for i in incomplete], deadline)
+                for index, book in zip(incomplete, completed):
+                    books[index] = book
+                    search_for(index, book)
+
+            results = [
+                reused[i] if i in reused else await searches[i]
+                for i in range(len(books)) if i in reused or i in searches
+            ]
+        except BaseException:
+            for task in searches.values():
+                task.cancel()
+            raise
+
+        logger.info("[extract_and_search_node] Extracted books: %s (%d searches reused)", books, len(reused))
+        started = runtrace.RunStarted(state.get("user_input", ""))
+        if not books:
+            return {
+                "extracted_books": [],
+                "extracted_from": extracted_from,
+                "recommendations": [],
+                "events": [started, runtrace.NoBooks()],
+            }
+
+        recommended_books, events = summarize_searches(results)
+        logger.info("[extract_and_search_node] 👈 exit with %d recommendations", len(recommended_books))
         return {
+            "extracted_books": books,
+            "extracted_from": extracted_from,
             "recommendations": recommended_books,
-            "reasoning": "\n".join(reasoning_steps)
+            "events": [started] + events,
+            "book_searches": {
+                book_key(books[i]): list(task.result()) for i, task in searches.items() if task.result()[1] is not None
+            },
         }
-    
+
     except Exception as e:
-        print("[extract_books_node] ❌ exception:", repr(e))
+        logger.exception("[extract_and_search_node] ❌ exception: %r", e)
         raise
 
 # Node 3: Reason about the search results and generate recommendations
@@ -407,51 +440,63 @@ async def recommend_books_node(state):
 async def reasoning_node(state):
     try:
         recommendations = state.get("recommendations", [])
-        initial_reasoning = state.get("reasoning", "")
 
         if not recommendations:
-            final_reasoning = initial_reasoning + "\nNo recommendations found to reason about."
-            print("[reasoning_node] No recommendations to process.")
-            return {"final_recommendations": [], "final_reasoning": final_reasoning}
-
-        # Format recommendations as input for the LLM
-        recommendations_text = "\n".join(
-            [f"Title: {rec['title']}\nLink: {rec['link']}\nSnippet: {rec['snippet']}\n" for rec in recommendations]
-        )
-
-        prompt = (
-            "You are a helpful book recommendation expert. You are given a web search result. "
-            "Analyze it and select the most relevant book recommendations. Explain why you recommend each book. "
-            "Do not recommend the same books from the user input!"
-            "IMPORTANT: Output ONLY a valid JSON array with this exact format:\n"
-            '[{"title": "Book Title", "reason": "Why this book is recommended", "link": "URL"}]\n'
-            "Rules:\n"
-            "- Use double quotes for all strings\n"
-            "- No trailing commas\n"
-            "- No markdown formatting or code blocks\n"
-            "- No explanations or extra text\n"
-            "- If no good recommendations, return empty array: []\n\n"
-            f"Books found from search:\n{recommendations_text}"
+            logger.info("[reasoning_node] No recommendations to process.")
+            return {"final_recommendations": [], "events": [runtrace.NothingToReason()]}
+
+        # Keep only the most relevant, distinct hits so the prompt stays within budget
+        ranked = await prerank(
+            recommendations, state.get("extracted_books", []),
+            token_budget=min(PRERANK_TOKEN_BUDGET, prompts.REASONING.budget()),
+            timeout=llm_timeout(state.get("deadline")),
         )
-
-        print("[reasoning_node] Prompt sent to LLM:\n", prompt)
-        response = ollama.chat(model="llama3", messages=[{"role": "user", "content": prompt}])
-        content = response['message']['content']
-
-        print("[reasoning_node] Raw LLM response:\n", repr(content))
-        print(f"[reasoning_node] Response type: {type(content)}, length: {len(content)}")
-        print("[reasoning_node] Response content (first 500 chars):", content[:500])
-
-        # Use the new safe JSON parsing function
-        final_recommendations = safe_json_parse(content, fallback_value=[])
-        print("[reasoning_node] Parsed final recommendations:", final_recommendations)
-        print("[reasoning_node] Type of final_recommendations:", type(final_recommendations))
-        print("[reasoning_node] Length of final_recommendations:", len(final_recommendations) if isinstance(final_recommendations, list) else "Not a list")
-
-        # Compose final reasoning combining initial and LLM results
-        final_reasoning = initial_reasoning + "\n\nFinal reasoning:\n"
-        for rec in final_recommendations:
-            final_reasoning += f"✅ Recommended: {rec.get('title', 'Unknown')} - {rec.get('reason', 'No reason provided.')}\n"
+        logger.info("[reasoning_node] Pre-ranking kept %d of %d search hits", len(ranked), len(recommendations))
+
+        # Format recommendations as input for the LLM; pre-ranking always keeps one hit, however long
+        recommendations_text = prompts.REASONING.fit_text("\n".join(format_hit(rec) for rec in ranked))
+        logger.debug("[reasoning_node] Prompt data sent to LLM:\n%s", recommendations_text)
+
+        deadline = state.get("deadline")
+        budget_events = []
+        if remaining(deadline, REASONING_MIN_BUDGET) < REASONING_MIN_BUDGET:
+            logger.warning("[reasoning_node] Too little time left to call the model, returning top search hits")
+            final_recommendations = search_fallback(ranked)
+            budget_events = [runtrace.BudgetExhausted("before")]
+        else:
+            # Stream tokens so the UI can show partial output; app.py listens with stream_mode="custom"
+            from langgraph.config import get_stream_writer
+            writer = get_stream_writer()
+            parts = []
+            try:
+                async for chunk in llm.stream_chat(
+                    **prompts.REASONING.chat_args(recommendations_text),
+                    timeout=llm_timeout(deadline),
+                    format=output_format(RECOMMENDATION_LIST_SCHEMA),
+                ):
+                    token = chunk["message"]["content"]
+                    if token:
+                        parts.append(token)
+                        writer({"reasoning_token": token})
+                content = "".join(parts)
+                logger.debug("[reasoning_node] Raw LLM response:\n%r", content)
+                final_recommendations = parse_json_array(content, check_recommendation)
+            except asyncio.TimeoutError:
+                # Keep the recommendations the model finished before the deadline
+                final_recommendations = [
+                    rec for rec in ArrayScanner().feed("".join(parts)) if check_recommendation(rec)
+                ]
+                logger.warning("[reasoning_node] Reasoning ran out of time after %d recommendations", len(final_recommendations))
+                if not final_recommendations:
+                    final_recommendations = search_fallback(ranked)
+                budget_events = [runtrace.BudgetExhausted("during")]
+
+        logger.debug("[reasoning_node] Parsed final recommendations: %s", final_recommendations)
+
+        events = [runtrace.ReasoningStarted()] + budget_events + [
+            runtrace.Recommended(str(rec.get("title", "Unknown")), str(rec.get("reason", "")))
+            for rec in final_recommendations if isinstance(rec, dict)
+        ]
 
         # Validate final recommendations
         validated_recommendations = []
@@ -466,47 +511,95 @@ async def reasoning_node(state):
                     if validated_rec["title"]:  # Only add if title is not empty
                         validated_recommendations.append(validated_rec)
         
-        print("[reasoning_node] Validated final recommendations:", validated_recommendations)
-        print("[reasoning_node] Final reasoning:\n", final_reasoning)
+        logger.debug("[reasoning_node] Validated final recommendations: %s", validated_recommendations)
 
-        # Return the new state with our data
-        result_state = {
-            "final_recommendations": validated_recommendations,
-            "final_reasoning": final_reasoning
-        }
-        
-        print("[reasoning_node] Returning state with keys:", list(result_state.keys()))
-        print("[reasoning_node] 👈 exit with", result_state)
-        
-        # Try returning as a dict to ensure proper state handling
-        return dict(result_state)
+        logger.info("[reasoning_node] 👈 exit with %d recommendations", len(validated_recommendations))
+        return {"final_recommendations": validated_recommendations, "events": events}
 
     except Exception as e:
-        print("[reasoning_node] ❌ exception:", repr(e))
-        print("[reasoning_node] Traceback:\n", traceback.format_exc())
+        logger.exception("[reasoning_node] ❌ exception: %r", e)
         # Return a safe fallback state instead of raising
-        print("[reasoning_node] Returning fallback state due to exception")
-        return {
-            "final_recommendations": [],
-            "final_reasoning": f"Error in reasoning node: {str(e)}"
-        }
-
-
+        logger.warning("[reasoning_node] Returning fallback state due to exception")
+        return {"final_recommendations": [], "events": [runtrace.ReasoningFailed(str(e))]}
+
+
+
+def search_fallback(ranked, limit=5):
+    """The best pre-ranked search hits in the shape of final recommendations"""
+    return [
+        {"title": hit.get("title", ""), "reason": hit.get("snippet", "") or "Top web search result.", "link": hit.get("link", "")}
+        for hit in ranked[:limit]
+    ]
+
+# Shortcut when extraction found nothing: same final state reasoning_node gives, without the hops
+async def no_books_node(state):
+    logger.info("[no_books_node] Nothing extracted, skipping author completion, search and reasoning")
+    return {
+        "recommendations": [],
+        "final_recommendations": [],
+        "events": [runtrace.NoBooks(), runtrace.NothingToReason()],
+    }
+
+def route_after_extraction(state):
+    books = state.get("extracted_books") or []
+    if not books:
+        route = "no_books"
+    elif any(not book.get("author") for book in books):
+        route = "complete_authors"
+    else:
+        route = "recommend_books"
+    tracing.incr("graph_route_total", route=route)
+    return route
+
+def node(name, fn):
+    # Restores the request's log buffer and trace context inside the node task
+    return request_logged(traced_node(name, fn))
 
 # Build the graph
-def build_graph():
-    graph = StateGraph(dict)
-
-    graph.add_node("extract_books", extract_books_node)
-    graph.add_node("complete_authors", complete_authors_node)  # <-- New node
-    graph.add_node("recommend_books", recommend_books_node)
-    graph.add_node("reasoning", reasoning_node)
+def build_graph(streaming=None, checkpointer=None, routing=None):
+    """Compile the recommender graph.
+
+    `routing` is "conditional" (default from GRAPH_ROUTING) to skip author completion when every
+    book has an author and go straight to the end when nothing was extracted, or "fixed" to run
+    every node regardless.
+
+    With a `checkpointer` (e.g. sessions.SessionSaver) every run needs a thread_id in its config,
+    and runs on the same thread reuse the previous extraction and per-book searches.
+    """
+    if streaming is None:
+        streaming = PIPELINE_STREAMING
+    if routing is None:
+        routing = GRAPH_ROUTING
+    from langgraph.graph import StateGraph, END
+    graph = StateGraph(RecommenderState)
+
+    if streaming:
+        # Extraction, author completion and search overlap inside one node; it keeps the
+        # recommend_books name because the UI picks the search log from that node's update
+        graph.add_node("recommend_books", node("recommend_books", extract_and_search_node))
+        graph.add_node("reasoning", node("reasoning", reasoning_node))
+        graph.add_edge("recommend_books", "reasoning")
+        graph.add_edge("reasoning", END)
+        graph.set_entry_point("recommend_books")
+        return graph.compile(checkpointer=checkpointer)
+
+    graph.add_node("extract_books", node("extract_books", extract_books_node))
+    graph.add_node("complete_authors", node("complete_authors", complete_authors_node))  # <-- New node
+    graph.add_node("recommend_books", node("recommend_books", recommend_books_node))
+    graph.add_node("reasoning", node("reasoning", reasoning_node))
 
     # Define edges
-    graph.add_edge("extract_books", "complete_authors")  # Modified
+    if routing == "fixed":
+        graph.add_edge("extract_books", "complete_authors")  # Modified
+    else:
+        graph.add_node("no_books", node("no_books", no_books_node))
+        graph.add_conditional_edges(
+            "extract_books", route_after_extraction, ["no_books", "complete_authors", "recommend_books"]
+        )
+        graph.add_edge("no_books", END)
     graph.add_edge("complete_authors", "recommend_books")  # Modified
     graph.add_edge("recommend_books", "reasoning")
     graph.add_edge("reasoning", END)
 
     graph.set_entry_point("extract_books")
-    return graph.compile()
+    return graph.compile(checkpointer=checkpointer)
@@ -1,88 +1,146 @@
+import startup
+if __name__ == "__main__":
+    # Compile the graph and warm models while gradio is still importing
+    startup.start()
 import gradio as gr
-from agents import build_graph
+from jsonparse import ArrayScanner
+from search import shutdown_client
+from asynclog import logger
+import tracing
+from lazyimport import lazy_import
+from deadline import new_deadline
+from admission import AdmissionController, Busy, user_key
+from runtrace import append_events, render
 import json
+import sys
+import time
 from pprint import pformat
 
-graph = build_graph()
+# Pulls in langgraph's checkpointer, which the warm-up thread loads anyway
+sessions = lazy_import("sessions")
 
-async def run_book_recommender(user_input):
-    initial_state = {"user_input": user_input}
-    final_state = None
+# Caps concurrent graph runs and queues the rest fairly per user, see admission.py
+admission = AdmissionController()
 
+# Minimum seconds between two streamed UI updates, keeps the websocket from flooding
+STREAM_UPDATE_INTERVAL = 0.05
+
+def format_recommendations(recs):
+    # Ensure recs is a list
+    if not isinstance(recs, list):
+        recs = []
+
+    # Filter out invalid entries
+    valid_recs = []
+    for r in recs:
+        if isinstance(r, dict) and r.get('title'):
+            valid_recs.append(r)
+
+    if valid_recs:
+        # Format nicely as before
+        return "\n\n".join(
+            f"📘 {r.get('title', 'Unknown Title')}\n🔗 {r.get('link','')}\n💡 {r.get('reason','')}"
+            for r in valid_recs
+        )
+    return "No recommendations found."
+
+async def run_book_recommender(user_input, request: gr.Request = None):
+    # The budget starts now, time spent in the queue included
+    deadline = new_deadline()
+    # Direct calls (bench, scripts) have no request and count as separate users
+    user = user_key(request) or sessions.new_session_id()
+    if admission.would_queue():
+        yield "", "⏳ Busy, waiting for a free slot..."
     try:
-        step_count = 0
-        async for state in graph.astream(initial_state):
-            step_count += 1
-            print(f"🔍 Step {step_count}: State keys = {list(state.keys())}")
-            if "final_recommendations" in state:
-                print(f"🔍 Step {step_count}: Found final_recommendations: {state['final_recommendations']}")
-            if "final_reasoning" in state:
-                print(f"🔍 Step {step_count}: Found final_reasoning (first 200 chars): {state['final_reasoning'][:200]}...")
-            final_state = state
-        print(f"✅ Graph completed in {step_count} steps")
-    except Exception as e:
-        print("🔥 Exception while streaming graph:", e)
-        import traceback
-        print("🔥 Traceback:", traceback.format_exc())
-        raise
-
-    if final_state is None:
-        final_state = {
-            "final_recommendations": [],
-            "final_reasoning": "⚠️ Graph never yielded a final state."
-        }
-    
-    # Ensure we have the expected keys in final_state
-    print(f"🔍 Final state keys: {list(final_state.keys())}")
-    print(f"🔍 Final state content: {final_state}")
-    
-    if "final_recommendations" not in final_state:
-        print("⚠️ final_recommendations not found in final state")
-        final_state["final_recommendations"] = []
-    if "final_reasoning" not in final_state:
-        print("⚠️ final_reasoning not found in final state")
-        final_state["final_reasoning"] = "⚠️ Missing reasoning data from graph execution."
-
-    # Access the final state - check both possible structures
-    recs = final_state.get("final_recommendations", [])
-    reasoning = final_state.get("final_reasoning", "")
-    
-    # If not found in direct keys, check if they're nested under 'reasoning'
-    if not recs and "reasoning" in final_state:
-        reasoning_data = final_state.get("reasoning", {})
-        if isinstance(reasoning_data, dict):
-            recs = reasoning_data.get("final_recommendations", [])
-            reasoning = reasoning_data.get("final_reasoning", reasoning)
-    
-    print(f"🔍 Extracted recs: {recs}")
-    print(f"🔍 Extracted reasoning (first 200 chars): {reasoning[:200] if reasoning else 'None'}...")
-
-    # Defensive formatting of recommendations
+        async with admission.admit(user):
+            async for outputs in recommend(user_input, request, deadline):
+                yield outputs
+    except Busy as e:
+        yield "", f"⚠️ Too many requests right now ({e.reason}). Please try again in about {max(1, round(e.retry_after))} seconds."
+
+async def recommend(user_input, request=None, deadline=None):
+    # Nodes return partial results rather than run past the deadline
+    initial_state = {"user_input": user_input, "deadline": deadline}
+    # The run's events as the nodes report them; only turned into text here, for the UI
+    events = []
+    recs = None
+    search_reasoning = ""
+    streamed_text = ""
+    # Picks complete recommendation objects out of the token stream as they close
+    scanner = ArrayScanner()
+    partial_recs = []
+    last_update = 0.0
+
+    yield "", "⏳ Extracting books from your input..."
+
+    # Per-request log buffer; nodes find it through the request_id in the graph config
+    request_log = logger.start_request()
+    # Detached root span: this generator is resumed by Gradio from different tasks
+    root_span = tracing.span("request", detached=True, trace_id=tracing.new_trace_id())
+    root_span.__enter__()
+    # finally, not except: a client that disconnects cancels or closes this generator, which
+    # raises CancelledError/GeneratorExit, and the request's log buffer must not outlive it
     try:
-        # Ensure recs is a list
-        if not isinstance(recs, list):
+        try:
+            session_id = getattr(request, "session_hash", None) or sessions.new_session_id()
+            config = sessions.session_config(session_id, tracing.graph_config(root_span))
+            config["configurable"]["request_id"] = request_log.id
+            step_count = 0
+            async for mode, chunk in startup.get_graph().astream(initial_state, config=config, stream_mode=["updates", "custom"]):
+                if mode == "custom":
+                    token = chunk.get("reasoning_token") if isinstance(chunk, dict) else None
+                    if not token:
+                        continue
+                    streamed_text += token
+                    partial_recs.extend(r for r in scanner.feed(token) if isinstance(r, dict))
+                    now = time.monotonic()
+                    if now - last_update >= STREAM_UPDATE_INTERVAL:
+                        last_update = now
+                        yield (
+                            format_recommendations(partial_recs) if partial_recs else "⏳ Generating recommendations...",
+                            search_reasoning + "\n\nFinal reasoning (streaming):\n" + streamed_text,
+                        )
+                    continue
+
+                step_count += 1
+                request_log.debug("Step %d: nodes = %s", step_count, list(chunk.keys()))
+                for node_name, update in chunk.items():
+                    if not isinstance(update, dict):
+                        continue
+                    events = append_events(events, update.get("events"))
+                    if "final_recommendations" in update:
+                        recs = update["final_recommendations"]
+                    if node_name == "recommend_books":
+                        search_reasoning = render(events)
+                        yield "⏳ Generating recommendations...", search_reasoning
+            request_log.info("Graph completed in %d steps", step_count)
+        except Exception as e:
+            logger.exception("Exception while streaming graph: %s", e)
+            raise
+        finally:
+            root_span.__exit__(*sys.exc_info())
+
+        reasoning = render(events)
+        if recs is None:
+            request_log.debug("No node returned final_recommendations")
             recs = []
-        
-        # Filter out invalid entries
-        valid_recs = []
-        for r in recs:
-            if isinstance(r, dict) and r.get('title'):
-                valid_recs.append(r)
-        
-        if valid_recs:
-            # Format nicely as before
-            recs_text = "\n\n".join(
-                f"📘 {r.get('title', 'Unknown Title')}\n🔗 {r.get('link','')}\n💡 {r.get('reason','')}"
-                for r in valid_recs
-            )
-        else:
-            recs_text = "No recommendations found."
-            
-    except Exception as e:
-        print(f"Error formatting recommendations: {e}")
-        recs_text = f"Error formatting recommendations: {e}"
-
-    return recs_text, reasoning
+            reasoning += "\n⚠️ Missing reasoning data from graph execution."
+
+        request_log.debug("Extracted %d recommendations", len(recs) if isinstance(recs, list) else 0)
+
+        # Defensive formatting of recommendations
+        try:
+            recs_text = format_recommendations(recs)
+        except Exception as e:
+            request_log.error("Error formatting recommendations: %s", e)
+            recs_text = f"Error formatting recommendations: {e}"
+
+        log_text = request_log.text()
+    finally:
+        logger.end_request(request_log)
+    if log_text:
+        reasoning = f"{reasoning}\n\n--- Debug log ({request_log.id}) ---\n{log_text}"
+    yield recs_text, reasoning
 
 with gr.Blocks() as demo:
     gr.Markdown("# 📚 AI Book Recommender")
@@ -95,7 +153,15 @@ with gr.Blocks() as demo:
       fn=run_book_recommender,
       inputs=user_in,
       outputs=[out_recs, out_reason],
+      # Gradio's own queue would serialize clicks; admission decides what runs and what is turned away
+      concurrency_limit=None,
     )
 
 if __name__=="__main__":
-    demo.launch()
+    tracing.start_metrics_server()
+    try:
+        demo.launch(prevent_thread_lock=True)
+        startup.mark_done("ui")
+        demo.block_thread()
+    finally:
+        shutdown_client()
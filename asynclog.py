@@ -0,0 +1,170 @@
+import atexit
+import contextvars
+import itertools
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+_LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+
+LOG_LEVEL = {name: level for level, name in _LEVEL_NAMES.items()}.get(os.environ.get("LOG_LEVEL", "INFO").upper(), INFO)
+# Lines kept per request for the UI debug box; older lines fall off the front
+LOG_BUFFER_SIZE = int(os.environ.get("LOG_BUFFER_SIZE", "500"))
+# Pending stdout lines; when the writer falls behind, new lines are dropped rather than blocking
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+
+_current = contextvars.ContextVar("request_log", default=None)
+_ids = itertools.count(1)
+
+def _format(record):
+    created, level, msg, args = record
+    if args:
+        try:
+            msg = msg % args
+        except (TypeError, ValueError):
+            msg = f"{msg} {args!r}"
+    return f"{time.strftime('%H:%M:%S', time.localtime(created))} {_LEVEL_NAMES.get(level, level)} {msg}"
+
+class RequestLog:
+    """Bounded log of one request; records are formatted only when read"""
+
+    def __init__(self, logger, size=LOG_BUFFER_SIZE):
+        self.id = f"req-{next(_ids)}"
+        self._logger = logger
+        self._records = deque(maxlen=size)
+
+    def append(self, record):
+        self._records.append(record)
+
+    def text(self, level=None):
+        level = self._logger.level if level is None else level
+        return "\n".join(_format(r) for r in list(self._records) if r[1] >= level)
+
+    def debug(self, msg, *args):
+        self._logger.log(DEBUG, msg, *args, request=self)
+
+    def info(self, msg, *args):
+        self._logger.log(INFO, msg, *args, request=self)
+
+    def warning(self, msg, *args):
+        self._logger.log(WARNING, msg, *args, request=self)
+
+    def error(self, msg, *args):
+        self._logger.log(ERROR, msg, *args, request=self)
+
+class AsyncLogger:
+    """Leveled logger: per-request ring buffers plus stdout output written by a background thread.
+
+    Messages use %-style arguments and are formatted lazily, so a call below the active level
+    costs a single comparison. Logging never blocks the event loop.
+    """
+
+    def __init__(self, level=LOG_LEVEL, stream=None):
+        self.level = level
+        self.stream = stream
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        self._requests = {}
+        self._writer = None
+        self._writer_lock = threading.Lock()
+
+    def enabled_for(self, level):
+        return level >= self.level
+
+    def log(self, level, msg, *args, request=None):
+        if level < self.level:
+            return
+        record = (time.time(), level, msg, args)
+        request = request or _current.get()
+        if request is not None:
+            request.append(record)
+        self._enqueue(record)
+
+    def debug(self, msg, *args):
+        self.log(DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(WARNING, msg, *args)
+
+    def error(self, msg, *args):
+        self.log(ERROR, msg, *args)
+
+    def exception(self, msg, *args):
+        """ERROR with the current traceback; use inside an except block"""
+        if ERROR >= self.level:
+            self.log(ERROR, msg + "\n%s", *args, traceback.format_exc())
+
+    def start_request(self):
+        request = RequestLog(self)
+        self._requests[request.id] = request
+        return request
+
+    def end_request(self, request):
+        self._requests.pop(request.id, None)
+
+    def get_request(self, request_id):
+        return self._requests.get(request_id)
+
+    def bind(self, request):
+        """Make `request` the log target for the current context (e.g. inside a node task)"""
+        return _current.set(request)
+
+    def unbind(self, token):
+        _current.reset(token)
+
+    def _enqueue(self, record):
+        if self._writer is None:
+            self._start_writer()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start_writer(self):
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name="log-writer", daemon=True)
+                self._writer.start()
+                atexit.register(self.flush)
+
+    def _write_loop(self):
+        while True:
+            record = self._queue.get()
+            stream = self.stream or sys.stdout
+            try:
+                stream.write(_format(record) + "\n")
+                if self._queue.empty():
+                    stream.flush()
+            except Exception:
+                pass
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """Block until everything queued so far has been written"""
+        if self._writer is not None:
+            self._queue.join()
+
+logger = AsyncLogger()
+
+def request_logged(fn):
+    """Wrap a graph node so its log lines land in the request buffer named in the config"""
+    # No functools.wraps: LangGraph inspects the signature to decide whether to pass `config`
+    async def wrapper(state, config=None):
+        request_id = (config or {}).get("configurable", {}).get("request_id")
+        request = logger.get_request(request_id) if request_id else None
+        token = logger.bind(request)
+        try:
+            return await fn(state, config)
+        finally:
+            logger.unbind(token)
+    wrapper.__name__ = getattr(fn, "__name__", "node")
+    return wrapper
@@ -0,0 +1,202 @@
+"""Batch recommendations: run the graph over a JSONL file of inputs and write a JSONL of results.
+
+    python batch.py inputs.jsonl results.jsonl --concurrency 8
+
+Each input line is {"id": ..., "user_input": "..."}; "id" defaults to the line number. Each
+output line is {"id", "user_input", "recommendations", "reasoning", "events", "error",
+"elapsed_ms"}, "events" being the run's runtrace records for analysis. It is written as soon as
+its record finishes, so the output doubles as the checkpoint: running the same command again skips every id that already has a successful result and retries the rest
+(readers should keep the last line per id).
+
+All records share one process, one event loop and therefore the pooled search client, the
+Ollama client, the caches and request coalescing. Model and search limits are the usual
+LLM_MAX_CONCURRENCY / SEARCH_RATE_PER_SEC / SEARCH_MAX_INFLIGHT environment variables.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import llm
+import models
+from agents import build_graph
+from deadline import new_deadline
+from runtrace import render, to_records
+from search import close_client
+
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "8"))
+# Seconds past --timeout before a record that didn't wrap up on its own is abandoned
+BATCH_TIMEOUT_GRACE = float(os.environ.get("BATCH_TIMEOUT_GRACE", "5"))
+# Seconds between progress lines on stderr
+BATCH_PROGRESS_INTERVAL = float(os.environ.get("BATCH_PROGRESS_INTERVAL", "10"))
+
+def read_records(path):
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"[batch] {path}:{line_no}: skipping invalid JSON ({e})", file=sys.stderr)
+                continue
+            if isinstance(record, str):
+                record = {"user_input": record}
+            if not isinstance(record, dict) or not str(record.get("user_input", "")).strip():
+                print(f"[batch] {path}:{line_no}: skipping record without user_input", file=sys.stderr)
+                continue
+            record.setdefault("id", line_no)
+            yield record
+
+def completed_ids(path):
+    """Ids with a successful result in an existing output file"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # A line cut short by an interrupted run; that record is simply redone
+                continue
+            if isinstance(result, dict) and not result.get("error"):
+                done.add(_id_key(result.get("id")))
+    return done
+
+def _id_key(value):
+    # 7 and "7" name the same record whether it came from JSON or from the line number
+    return str(value)
+
+def open_output(path):
+    out = open(path, "a+", encoding="utf-8")
+    out.seek(0, os.SEEK_END)
+    if out.tell() > 0:
+        out.seek(out.tell() - 1)
+        if out.read(1) != "\n":
+            # Don't glue the first new result onto a truncated last line
+            out.write("\n")
+    return out
+
+class BatchStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.ok = 0
+        self.failed = 0
+        self.skipped = 0
+        self.latencies = []
+
+    def record(self, result):
+        if result["error"]:
+            self.failed += 1
+        else:
+            self.ok += 1
+        self.latencies.append(result["elapsed_ms"])
+
+    def line(self):
+        elapsed = time.perf_counter() - self.started
+        done = self.ok + self.failed
+        rate = done / elapsed if elapsed > 0 else 0.0
+        return f"{done} done ({self.ok} ok, {self.failed} failed, {self.skipped} skipped) in {elapsed:.1f}s, {rate:.2f} records/s"
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return self.line()
+        p50 = latencies[len(latencies) // 2]
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        return f"{self.line()}, p50 {p50:.0f} ms, p95 {p95:.0f} ms"
+
+async def process(graph, record, timeout=None):
+    started = time.perf_counter()
+    result = {
+        "id": record["id"], "user_input": record["user_input"],
+        "recommendations": [], "reasoning": "", "events": [], "error": None,
+    }
+    try:
+        # Nodes wrap up with partial results at the deadline; the hard timeout is only a backstop
+        state = await asyncio.wait_for(
+            graph.ainvoke({"user_input": record["user_input"], "deadline": new_deadline(timeout)}),
+            None if timeout is None else timeout + BATCH_TIMEOUT_GRACE,
+        )
+        result["recommendations"] = state.get("final_recommendations", [])
+        result["reasoning"] = render(state.get("events"))
+        result["events"] = to_records(state.get("events"))
+    except asyncio.TimeoutError:
+        result["error"] = f"timed out after {timeout}s"
+    except Exception as e:
+        result["error"] = repr(e)
+    result["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return result
+
+async def run_batch(records, out, concurrency=BATCH_CONCURRENCY, timeout=None, done=frozenset(), progress=BATCH_PROGRESS_INTERVAL):
+    graph = build_graph()
+    # Load the models once up front instead of inside the first records' latency
+    await models.warm_up(llm.get_client())
+    stats = BatchStats()
+    # Small queue: a huge input file is read as workers free up, not all at once
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def worker():
+        while True:
+            record = await queue.get()
+            if record is None:
+                return
+            result = await process(graph, record, timeout)
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            out.flush()
+            stats.record(result)
+
+    async def reporter():
+        while True:
+            await asyncio.sleep(progress)
+            print(f"[batch] {stats.line()}", file=sys.stderr)
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    report_task = asyncio.create_task(reporter()) if progress > 0 else None
+    try:
+        for record in records:
+            if _id_key(record["id"]) in done:
+                stats.skipped += 1
+                continue
+            await queue.put(record)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers + ([report_task] if report_task else []):
+            task.cancel()
+        os.fsync(out.fileno())
+        await close_client()
+    return stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the recommender over a JSONL file of inputs")
+    parser.add_argument("input", help="JSONL with one {\"id\", \"user_input\"} object per line")
+    parser.add_argument("output", help="JSONL results, appended to and used to resume")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY, help="records in flight")
+    parser.add_argument("--timeout", type=float, default=None, help="time budget per record in seconds (default REQUEST_BUDGET)")
+    parser.add_argument("--progress", type=float, default=BATCH_PROGRESS_INTERVAL, help="seconds between progress lines, 0 = off")
+    parser.add_argument("--restart", action="store_true", help="ignore existing results and start over")
+    args = parser.parse_args(argv)
+
+    if args.restart and os.path.exists(args.output):
+        os.remove(args.output)
+    done = completed_ids(args.output)
+    if done:
+        print(f"[batch] Resuming, {len(done)} records already done", file=sys.stderr)
+
+    with open_output(args.output) as out:
+        try:
+            stats = asyncio.run(run_batch(
+                read_records(args.input), out, args.concurrency, args.timeout, done, args.progress
+            ))
+        except KeyboardInterrupt:
+            print("[batch] Interrupted, rerun the same command to resume", file=sys.stderr)
+            return 130
+    print(f"[batch] {stats.summary()}")
+    return 0 if stats.failed == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,251 @@
+"""End-to-end throughput and latency of the recommender against local fake DuckDuckGo/Ollama servers.
+
+Usage: python bench/bench_e2e.py [--sessions 40] [--concurrency 8] [--mode graph|app] [--streaming]
+                                 [--routing conditional|fixed] [--fuse-authors] [--hedge] [--budget 5]
+                                 [--providers duckduckgo,searxng] [--strategy race|merge]
+                                 [--search-tail-fraction 0.05 --search-tail-latency 3] [--search-error-rate 0.1]
+                                 [--token-rate 40] [--prefill-rate 2000 [--prompt-cache-slots 0]]
+                                 [--search-latency 0.3] [--external]
+
+Starts bench/fake_servers.py in a subprocess (skip with --external when it is already running),
+drives `sessions` requests through graph.astream (or app.run_book_recommender with --mode app)
+with at most `concurrency` in flight, and reports requests per second, p50/p95/p99 of every
+traced span (node.*, search, llm.*), model calls per session, prompt evaluation per prompt
+(time and evaluated tokens, see prompts.py) and the peak RSS of this process.
+No network access needed. Compare --routing fixed against the default conditional routing (and
+--fuse-authors) to see the round-trips the graph skips. The --search-tail-* and --search-error-rate
+options make the fake search slow or failing now and then, to measure retries, --hedge and --budget,
+or to compare racing --providers (the fake server also answers SearXNG's JSON API) against one.
+--prefill-rate charges for evaluated prompt tokens; --prompt-cache-slots 0 turns off the fake
+server's prefix reuse to see what the fixed instruction prefixes save.
+
+Caches are disabled and the search rate limit raised unless set in the environment, so runs
+measure the pipeline rather than the cache or the politeness delay.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+
+from fake_servers import FIXTURES, add_arguments  # noqa: E402
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(p / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+def wait_for_port(host, port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise SystemExit(f"fake server on {host}:{port} did not come up")
+
+def start_fake_servers(args):
+    cmd = [
+        sys.executable, os.path.join(BENCH_DIR, "fake_servers.py"),
+        "--host", args.host,
+        "--search-port", str(args.search_port),
+        "--ollama-port", str(args.ollama_port),
+        "--search-latency", str(args.search_latency),
+        "--search-tail-fraction", str(args.search_tail_fraction),
+        "--search-tail-latency", str(args.search_tail_latency),
+        "--search-error-rate", str(args.search_error_rate),
+        "--searx-latency", str(args.searx_latency),
+        "--prefill-latency", str(args.prefill_latency),
+        "--token-rate", str(args.token_rate),
+        "--prefill-rate", str(args.prefill_rate),
+        "--prompt-cache-slots", str(args.prompt_cache_slots),
+        "--pages", args.pages,
+        "--replies", args.replies,
+    ]
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+    wait_for_port(args.host, args.search_port)
+    wait_for_port(args.host, args.ollama_port)
+    return proc
+
+def configure_environment(args, workdir):
+    # Module-level settings are read at import time, so this runs before the app is imported
+    os.environ.setdefault("SEARCH_URL", f"http://{args.host}:{args.search_port}/html/")
+    os.environ.setdefault("OLLAMA_HOST", f"http://{args.host}:{args.ollama_port}")
+    os.environ.setdefault("SEARCH_CACHE_ENABLED", "0")
+    os.environ.setdefault("LLM_CACHE_ENABLED", "0")
+    os.environ.setdefault("SEARCH_RATE_PER_SEC", "1000")
+    os.environ.setdefault("SEARCH_RATE_BURST", "1000")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("CACHE_DIR", os.path.join(workdir, "cache"))
+    os.environ["PIPELINE_STREAMING"] = "1" if args.streaming else "0"
+    os.environ["GRAPH_ROUTING"] = args.routing
+    os.environ["FUSE_AUTHOR_COMPLETION"] = "1" if args.fuse_authors else "0"
+    os.environ["SEARCH_HEDGE_ENABLED"] = "1" if args.hedge else "0"
+    os.environ["SEARCH_PROVIDERS"] = args.providers
+    os.environ["SEARCH_STRATEGY"] = args.strategy
+    os.environ.setdefault("SEARXNG_URL", f"http://{args.host}:{args.search_port}/search")
+    if args.budget is not None:
+        os.environ["REQUEST_BUDGET"] = str(args.budget)
+    os.environ["TRACE_ENABLED"] = "1"
+    os.environ["TRACE_FILE"] = os.path.join(workdir, "traces.jsonl")
+
+async def run_session(mode, target, user_input):
+    from deadline import new_deadline
+    if mode == "app":
+        async for _ in target(user_input):
+            pass
+    else:
+        async for _ in target.astream({"user_input": user_input, "deadline": new_deadline()}):
+            pass
+
+async def drive(args, inputs):
+    if args.mode == "app":
+        import app
+        target = app.run_book_recommender
+    else:
+        from agents import build_graph
+        target = build_graph()
+
+    # Like the app, load the models before the clock starts
+    import llm
+    import models
+    await models.warm_up(llm.get_client())
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    errors = 0
+
+    async def one(i):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await run_session(args.mode, target, inputs[i % len(inputs)])
+            except Exception as e:
+                errors += 1
+                print(f"session {i} failed: {e!r}", file=sys.stderr)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(args.sessions)))
+    elapsed = time.perf_counter() - start
+
+    from search import close_client
+    await close_client()
+    return elapsed, sorted(latencies), errors
+
+def read_spans(trace_file):
+    if not os.path.exists(trace_file):
+        return []
+    with open(trace_file, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+def span_latencies(records):
+    by_name = {}
+    for record in records:
+        by_name.setdefault(record["name"], []).append(record["duration_ms"] / 1000)
+    return {name: sorted(values) for name, values in by_name.items()}
+
+def prompt_evals(records):
+    """prompt name -> ([prompt eval seconds], [evaluated tokens]) of calls that reached the model"""
+    by_prompt = {}
+    for record in records:
+        if "prompt_eval_ms" in record:
+            seconds, tokens = by_prompt.setdefault(record.get("prompt") or record["name"], ([], []))
+            seconds.append(record["prompt_eval_ms"] / 1000)
+            tokens.append(record.get("prompt_tokens", 0))
+    return {name: (sorted(seconds), tokens) for name, (seconds, tokens) in by_prompt.items()}
+
+def report_row(name, values):
+    p50, p95, p99 = (percentile(values, p) * 1000 for p in (50, 95, 99))
+    print(f"{name:<28} {len(values):>6} {p50:>10.1f} {p95:>10.1f} {p99:>10.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--mode", choices=("graph", "app"), default="graph")
+    parser.add_argument("--streaming", action="store_true", help="use the streaming extract-and-search pipeline")
+    parser.add_argument("--routing", choices=("conditional", "fixed"), default="conditional", help="graph edges after extraction")
+    parser.add_argument("--fuse-authors", action="store_true", help="let extraction fill in authors in the same call")
+    parser.add_argument("--hedge", action="store_true", help="send a hedged duplicate for searches slower than p95")
+    parser.add_argument("--providers", default="duckduckgo", help="comma separated search providers (SEARCH_PROVIDERS)")
+    parser.add_argument("--strategy", choices=("race", "merge"), default="race", help="how several providers are combined")
+    parser.add_argument("--budget", type=float, default=None, help="per-request deadline in seconds (REQUEST_BUDGET)")
+    parser.add_argument("--inputs", default=os.path.join(FIXTURES, "inputs.txt"), help="one user message per line")
+    parser.add_argument("--external", action="store_true", help="use fake servers that are already running")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    with open(args.inputs, encoding="utf-8") as f:
+        inputs = [line.strip() for line in f if line.strip()]
+
+    with tempfile.TemporaryDirectory(prefix="bench-e2e-") as workdir:
+        configure_environment(args, workdir)
+        servers = None if args.external else start_fake_servers(args)
+        try:
+            elapsed, latencies, errors = asyncio.run(drive(args, inputs))
+        finally:
+            if servers is not None:
+                servers.terminate()
+                servers.wait()
+
+        import tracing
+        tracing.flush()
+        records = read_spans(os.environ["TRACE_FILE"])
+        spans = span_latencies(records)
+        evals = prompt_evals(records)
+
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(
+        f"{args.sessions} sessions, concurrency {args.concurrency}, mode {args.mode}"
+        f"{' (streaming)' if args.streaming else ''}, routing {args.routing}"
+        f"{', fused authors' if args.fuse_authors else ''}{', hedged search' if args.hedge else ''}"
+        f", providers {args.providers} ({args.strategy})"
+    )
+    print(f"throughput  {args.sessions / elapsed:.2f} req/s over {elapsed:.2f}s, {errors} errors")
+    print(f"peak RSS    {peak_rss_mb:.1f} MiB")
+    print(
+        f"search      {tracing.counter_total('search_retries_total'):.0f} retries, "
+        f"{tracing.counter_total('search_hedges_total'):.0f} hedges "
+        f"({tracing.counter_total('search_hedges_total', winner='hedge'):.0f} won), "
+        f"{tracing.counter_total('search_deadline_exceeded_total'):.0f} cut by the deadline"
+    )
+    from providers import get_search
+    for name, stats in get_search().summary().items():
+        print(
+            f"provider    {name}: {stats['wins']} wins, {stats['calls']} calls, {stats['errors']} errors, "
+            f"{(stats['latency'] or 0) * 1000:.0f} ms average"
+        )
+    chat_calls = tracing.counter_total("llm_calls_total")
+    print(f"model calls {chat_calls / args.sessions:.2f} per session ({chat_calls:.0f} total, after coalescing)")
+    from llm import llm_flight
+    from search import search_flight
+    for flight in (search_flight, llm_flight):
+        stats = flight.stats()
+        print(f"coalesced   {flight.name}: {stats['coalesced']} of {stats['leaders'] + stats['coalesced']} calls")
+    print()
+    print(f"{'latency (ms)':<28} {'count':>6} {'p50':>10} {'p95':>10} {'p99':>10}")
+    report_row("session", latencies)
+    node_names = sorted(n for n in spans if n.startswith("node."))
+    for name in node_names + sorted(n for n in spans if n not in node_names):
+        report_row(name, spans[name])
+    print()
+    print(f"{'prompt eval (ms)':<28} {'count':>6} {'p50':>10} {'p95':>10} {'p99':>10} {'tokens/call':>12}")
+    for name, (seconds, tokens) in sorted(evals.items()):
+        print(f"{name:<28} {len(seconds):>6} {percentile(seconds, 50) * 1000:>10.1f} "
+              f"{percentile(seconds, 95) * 1000:>10.1f} {percentile(seconds, 99) * 1000:>10.1f} "
+              f"{sum(tokens) / len(tokens):>12.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Parse time and recovery rate of LLM reply parsing over a corpus of malformed replies.
+
+Usage: python bench/bench_parse.py [--corpus bench/parse_corpus.jsonl] [--repeat 200]
+
+Each corpus line is {"reply": <raw model output>, "expected": <array we should recover>}.
+The regex cascade that agents.py used before the single-pass scanner is kept below as the baseline.
+"""
+import argparse
+import ast
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from jsonparse import parse_json_array  # noqa: E402
+
+def legacy_extract_json_array(text):
+    text = re.sub(r"```(?:json)?\n?|</?(?:pre|code|p)>", "", text, flags=re.IGNORECASE)
+    match = re.search(r"(\[\s*{.*?}\s*\])", text, re.DOTALL)
+    if not match:
+        match = re.search(r"(\[.*?\])", text, re.DOTALL)
+        if not match:
+            return []
+    json_str = match.group(1)
+    try:
+        return json.loads(json_str)
+    except json.JSONDecodeError:
+        try:
+            return ast.literal_eval(json_str)
+        except Exception:
+            try:
+                json_str = re.sub(r',\s*}', '}', json_str)
+                json_str = re.sub(r',\s*]', ']', json_str)
+                json_str = re.sub(r'(\w+):', r'"\1":', json_str)
+                json_str = re.sub(r'"\s*{\s*"', '{"', json_str)
+                json_str = re.sub(r'"\s*}\s*"', '"}', json_str)
+                json_str = re.sub(r'"\s*}\s*{', '"},{', json_str)
+                json_str = re.sub(r'"\s*({[^}]+})\s*"', r'\1', json_str)
+                return json.loads(json_str)
+            except Exception:
+                return []
+
+def legacy_safe_json_parse(content):
+    cleaned_content = re.sub(r"```(?:json)?\n?|</?(?:pre|code|p)>", "", content, flags=re.IGNORECASE).strip()
+    try:
+        return json.loads(cleaned_content)
+    except json.JSONDecodeError:
+        extracted = legacy_extract_json_array(cleaned_content)
+        if extracted:
+            return extracted
+        try:
+            return ast.literal_eval(cleaned_content)
+        except Exception:
+            try:
+                fixed_content = re.sub(r',\s*}', '}', cleaned_content)
+                fixed_content = re.sub(r',\s*]', ']', fixed_content)
+                fixed_content = re.sub(r'(\w+):', r'"\1":', fixed_content)
+                fixed_content = fixed_content.replace("'", '"')
+                fixed_content = re.sub(r'"\s*{\s*"', '{"', fixed_content)
+                fixed_content = re.sub(r'"\s*}\s*"', '"}', fixed_content)
+                fixed_content = re.sub(r'"\s*}\s*{', '"},{', fixed_content)
+                fixed_content = re.sub(r'"\s*({[^}]+})\s*"', r'\1', fixed_content)
+                return json.loads(fixed_content)
+            except Exception:
+                return []
+
+def run(name, parse, corpus, repeat):
+    recovered = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for case in corpus:
+            parse(case["reply"])
+    elapsed = time.perf_counter() - start
+
+    for case in corpus:
+        if parse(case["reply"]) == case["expected"]:
+            recovered += 1
+
+    per_reply_us = elapsed / (repeat * len(corpus)) * 1e6
+    print(f"{name:<10} {per_reply_us:>10.1f} us/reply   recovered {recovered}/{len(corpus)}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "parse_corpus.jsonl"))
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    with open(args.corpus, encoding="utf-8") as f:
+        corpus = [json.loads(line) for line in f if line.strip()]
+
+    print(f"{len(corpus)} replies, {args.repeat} rounds")
+    run("legacy", legacy_safe_json_parse, corpus, args.repeat)
+    run("scanner", parse_json_array, corpus, args.repeat)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Micro-benchmark of search result extraction over the recorded result pages.
+
+Usage: python bench/bench_search_parse.py [--results 30] [--max-results 5] [--loops 2000]
+
+Compares search.parse_results_lean (scans result blocks and stops at max_results) with
+search.parse_results_dom (the full selectolax DOM) on every page in bench/fixtures/search, each
+padded to `results` hits like a real DuckDuckGo page. Reports microseconds per query and the
+Python heap allocated per query (tracemalloc peak). The DOM's own tree is allocated by lexbor
+outside the Python heap, so the DOM figure is a lower bound.
+"""
+import argparse
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+
+from fake_servers import FIXTURES, load_pages  # noqa: E402
+from search import parse_results_dom, parse_results_lean  # noqa: E402
+
+RESULT_BLOCK = re.compile(r'<div class="result[ "].*?\n</div>\n', re.S)
+
+def pad_page(page, results):
+    """Repeat the page's result blocks until it has `results` of them, each with its own link"""
+    blocks = RESULT_BLOCK.findall(page)
+    if not blocks or len(blocks) >= results:
+        return page
+    extra = []
+    for i in range(results - len(blocks)):
+        # %3Fp%3D is "?p=" inside the encoded uddg target, so every copy is a distinct page
+        extra.append(blocks[i % len(blocks)].replace("&amp;rut=", f"%3Fp%3D{i}&amp;rut="))
+    end = page.rindex(blocks[-1]) + len(blocks[-1])
+    return page[:end] + "".join(extra) + page[end:]
+
+def time_per_call(fn, page, max_results, loops):
+    best = float("inf")
+    for _ in range(5):
+        started = time.perf_counter()
+        for _ in range(loops):
+            fn(page, max_results)
+        best = min(best, (time.perf_counter() - started) / loops)
+    return best
+
+def heap_per_call(fn, page, max_results):
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        fn(page, max_results)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak - base
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--results", type=int, default=30, help="hits per page after padding")
+    parser.add_argument("--max-results", type=int, default=5)
+    parser.add_argument("--loops", type=int, default=2000)
+    parser.add_argument("--pages", default=os.path.join(FIXTURES, "search"))
+    args = parser.parse_args()
+
+    pages = [pad_page(page.decode("utf-8"), args.results) for page in load_pages(args.pages)]
+    print(f"{len(pages)} pages, {args.results} hits each ({sum(map(len, pages)) // len(pages)} bytes avg), max_results {args.max_results}")
+    print(f"{'parser':<8} {'us/query':>10} {'heap KiB/query':>16}")
+    for name, fn in (("lean", parse_results_lean), ("dom", parse_results_dom)):
+        seconds = sum(time_per_call(fn, page, args.max_results, args.loops) for page in pages) / len(pages)
+        heap = sum(heap_per_call(fn, page, args.max_results) for page in pages) / len(pages)
+        print(f"{name:<8} {seconds * 1e6:>10.1f} {heap / 1024:>16.1f}")
+
+    for page in pages:
+        lean = parse_results_lean(page, args.max_results)
+        dom = parse_results_dom(page, args.max_results)
+        if lean != dom:
+            print("lean and dom results differ on a page", file=sys.stderr)
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,337 @@
+"""Local stand-ins for DuckDuckGo's HTML endpoint and the Ollama API, for offline benchmarks.
+
+Usage: python bench/fake_servers.py [--search-port 8765] [--ollama-port 11435]
+                                    [--search-latency 0.3] [--prefill-latency 0.5] [--token-rate 40]
+                                    [--prefill-rate 0] [--prompt-cache-slots 4]
+
+The search server answers GET /html/?q=... with the recorded result page in
+bench/fixtures/search that mentions most of the query's words, and GET /search?q=...&format=json
+with the same page's results as a SearXNG instance would (after --searx-latency, without the
+DuckDuckGo tail and errors). The Ollama server answers
+/api/chat (streaming and not) by replaying the first reply in bench/fixtures/ollama_replies.jsonl
+whose "match" regex is found in the conversation, at `token-rate` tokens per second after
+`prefill-latency` seconds plus, with --prefill-rate, the prompt tokens it had to evaluate at that
+many per second. Like Ollama, it keeps the last --prompt-cache-slots prompts per model and only
+evaluates what follows the longest prefix shared with one of them, which is what
+prompt_eval_count/prompt_eval_duration report. /api/embed returns deterministic bag-of-words vectors.
+
+Point the app at them with SEARCH_URL=http://127.0.0.1:8765/html/ OLLAMA_HOST=http://127.0.0.1:11435
+(and SEARXNG_URL=http://127.0.0.1:8765/search).
+"""
+import argparse
+import asyncio
+import hashlib
+import html
+import json
+import os
+import random
+import re
+import time
+from urllib.parse import parse_qs, urlsplit
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+EMBED_DIM = 256
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 503: "Service Unavailable"}
+
+def load_pages(directory):
+    pages = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".html"):
+            with open(os.path.join(directory, name), "rb") as f:
+                pages.append(f.read())
+    if not pages:
+        raise SystemExit(f"no .html pages in {directory}")
+    return pages
+
+def load_replies(path):
+    with open(path, encoding="utf-8") as f:
+        return [(re.compile(r["match"]), r["reply"]) for r in map(json.loads, f) if r]
+
+def split_tokens(text):
+    # Roughly what llama3 emits: words with their leading space, punctuation on its own
+    return re.findall(r"\s*\w+|\s*[^\w\s]|\s+", text)
+
+def embed_text(text):
+    vec = [0.0] * EMBED_DIM
+    for word in re.findall(r"\w+", text.lower()):
+        vec[int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=4).digest(), "little") % EMBED_DIM] += 1.0
+    return vec
+
+class Request:
+    __slots__ = ("method", "path", "query", "headers", "body")
+
+    def __init__(self, method, target, headers, body):
+        parts = urlsplit(target)
+        self.method = method
+        self.path = parts.path
+        self.query = parse_qs(parts.query)
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body or b"{}")
+
+class Response:
+    """Writes HTTP/1.1 responses, either whole or as a chunked stream"""
+
+    def __init__(self, writer):
+        self._writer = writer
+
+    def _head(self, status, content_type, extra):
+        lines = [f"HTTP/1.1 {status} {_REASONS.get(status, 'OK')}", f"Content-Type: {content_type}", *extra]
+        self._writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+    async def send(self, status, body, content_type="application/json"):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode("utf-8")
+        elif isinstance(body, str):
+            body = body.encode("utf-8")
+        self._head(status, content_type, [f"Content-Length: {len(body)}"])
+        self._writer.write(body)
+        await self._writer.drain()
+
+    async def start_stream(self, content_type="application/x-ndjson"):
+        self._head(200, content_type, ["Transfer-Encoding: chunked"])
+        await self._writer.drain()
+
+    async def write_chunk(self, data):
+        self._writer.write(f"{len(data):x}\r\n".encode("latin-1") + data + b"\r\n")
+        await self._writer.drain()
+
+    async def end_stream(self):
+        self._writer.write(b"0\r\n\r\n")
+        await self._writer.drain()
+
+async def serve(handler, host, port):
+    """Minimal keep-alive HTTP/1.1 server around `handler(request, response)`"""
+
+    async def on_connection(reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", "0"))
+                body = await reader.readexactly(length) if length else b""
+                await handler(Request(method, target, headers, body), Response(writer))
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(on_connection, host, port, backlog=1024)
+
+_RESULT_LINK = re.compile(r'class="result__a"[^>]*href="([^"]*)"[^>]*>(.*?)</a>.*?class="result__snippet"[^>]*>(.*?)</(?:a|div|td)>', re.S)
+_TAG = re.compile(r"<[^>]+>")
+
+def searx_results(page):
+    results = []
+    for href, title, snippet in _RESULT_LINK.findall(page.decode("utf-8", "replace")):
+        href = html.unescape(href)
+        url = (parse_qs(urlsplit(href).query).get("uddg") or [href])[0]
+        if url.startswith("//"):
+            url = "https:" + url
+        results.append({
+            "url": url,
+            "title": html.unescape(_TAG.sub("", title)).strip(),
+            "content": html.unescape(_TAG.sub("", snippet)).strip(),
+            "engine": "fake",
+        })
+    return {"results": results}
+
+class FakeSearch:
+    def __init__(self, pages, latency, tail_fraction=0.0, tail_latency=0.0, error_rate=0.0, searx_latency=0.3):
+        self.pages = [page.lower() for page in pages]
+        self.raw_pages = pages
+        self.latency = latency
+        # A share of requests is slow or fails, like a real search engine under load
+        self.tail_fraction = tail_fraction
+        self.tail_latency = tail_latency
+        self.error_rate = error_rate
+        self.searx_latency = searx_latency
+
+    async def __call__(self, request, response):
+        if request.path.rstrip("/") == "/search":
+            await asyncio.sleep(self.searx_latency)
+            await response.send(200, searx_results(self.page_for((request.query.get("q") or [""])[0])))
+            return
+        if request.path.rstrip("/") != "/html":
+            await response.send(404, {"error": "not found"})
+            return
+        query = (request.query.get("q") or [""])[0]
+        if random.random() < self.error_rate:
+            await asyncio.sleep(self.latency)
+            await response.send(503, {"error": "unavailable"})
+            return
+        await asyncio.sleep(self.tail_latency if random.random() < self.tail_fraction else self.latency)
+        await response.send(200, self.page_for(query), "text/html; charset=utf-8")
+
+    def page_for(self, query):
+        # The page mentioning most of the query's words, ties broken by a stable hash
+        words = [w.encode("utf-8") for w in re.findall(r"\w{4,}", query.lower())]
+        digest = hashlib.sha1(query.lower().encode("utf-8")).digest()
+        best = max(
+            range(len(self.pages)),
+            key=lambda i: (sum(w in self.pages[i] for w in words), (i - digest[0]) % len(self.pages) == 0),
+        )
+        return self.raw_pages[best]
+
+def shared_prefix(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+class PromptCache:
+    """Per model, the token lists of the last `slots` prompts, as Ollama's KV cache slots hold them"""
+
+    def __init__(self, slots):
+        self.slots = slots
+        self._models = {}
+
+    def evaluate(self, model, tokens):
+        """How many of `tokens` need evaluating; the prompt takes the slot it shares most with"""
+        if self.slots <= 0:
+            return len(tokens)
+        cached = self._models.setdefault(model, [])
+        best, reused = None, 0
+        for i, previous in enumerate(cached):
+            n = shared_prefix(previous, tokens)
+            if n > reused:
+                best, reused = i, n
+        if best is not None:
+            cached.pop(best)
+        elif len(cached) >= self.slots:
+            cached.pop(0)
+        cached.append(tokens)
+        # The last token is always evaluated, it produces the first output
+        return max(1, len(tokens) - reused)
+
+class FakeOllama:
+    def __init__(self, replies, prefill_latency, token_rate, prefill_rate=0.0, cache_slots=4):
+        self.replies = replies
+        self.prefill_latency = prefill_latency
+        self.token_rate = token_rate
+        self.prefill_rate = prefill_rate
+        self.prompt_cache = PromptCache(cache_slots)
+
+    def reply_for(self, messages):
+        # The prompt as a chat template lays it out, roles and all
+        prompt = "".join(f"<|{m.get('role', '')}|>{m.get('content', '')}\n" for m in messages)
+        for pattern, reply in self.replies:
+            if pattern.search(prompt):
+                return prompt, reply
+        return prompt, "[]"
+
+    def _message(self, model, content, done, **extra):
+        return {
+            "model": model,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "message": {"role": "assistant", "content": content},
+            "done": done,
+            **extra,
+        }
+
+    async def __call__(self, request, response):
+        if request.path == "/api/embed" and request.method == "POST":
+            body = request.json()
+            texts = body.get("input", [])
+            texts = [texts] if isinstance(texts, str) else texts
+            await response.send(200, {"model": body.get("model", ""), "embeddings": [embed_text(t) for t in texts]})
+            return
+        if request.path != "/api/chat" or request.method != "POST":
+            await response.send(404, {"error": "not found"})
+            return
+
+        body = request.json()
+        model = body.get("model", "")
+        prompt, reply = self.reply_for(body.get("messages", []))
+        tokens = split_tokens(reply)
+        evaluated = self.prompt_cache.evaluate(model, split_tokens(prompt))
+        started = time.perf_counter()
+        await asyncio.sleep(self.prefill_latency + (evaluated / self.prefill_rate if self.prefill_rate > 0 else 0.0))
+        prefilled = time.perf_counter()
+        delay = 1.0 / self.token_rate if self.token_rate > 0 else 0.0
+
+        def stats():
+            now = time.perf_counter()
+            return {
+                "done_reason": "stop",
+                "total_duration": int((now - started) * 1e9),
+                "prompt_eval_count": evaluated,
+                "prompt_eval_duration": int((prefilled - started) * 1e9),
+                "eval_count": len(tokens),
+                "eval_duration": int((now - prefilled) * 1e9),
+            }
+
+        if not body.get("stream", True):
+            await asyncio.sleep(delay * len(tokens))
+            await response.send(200, self._message(model, reply, True, **stats()))
+            return
+
+        await response.start_stream()
+        for token in tokens:
+            await response.write_chunk((json.dumps(self._message(model, token, False)) + "\n").encode("utf-8"))
+            if delay:
+                await asyncio.sleep(delay)
+        await response.write_chunk((json.dumps(self._message(model, "", True, **stats())) + "\n").encode("utf-8"))
+        await response.end_stream()
+
+async def run_servers(args):
+    search = await serve(
+        FakeSearch(
+            load_pages(args.pages), args.search_latency,
+            args.search_tail_fraction, args.search_tail_latency, args.search_error_rate, args.searx_latency,
+        ),
+        args.host, args.search_port,
+    )
+    ollama = await serve(
+        FakeOllama(
+            load_replies(args.replies), args.prefill_latency, args.token_rate, args.prefill_rate, args.prompt_cache_slots
+        ),
+        args.host, args.ollama_port,
+    )
+    print(f"search  http://{args.host}:{args.search_port}/html/", flush=True)
+    print(f"ollama  http://{args.host}:{args.ollama_port}", flush=True)
+    async with search, ollama:
+        await asyncio.gather(search.serve_forever(), ollama.serve_forever())
+
+def add_arguments(parser):
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--search-port", type=int, default=8765)
+    parser.add_argument("--ollama-port", type=int, default=11435)
+    parser.add_argument("--search-latency", type=float, default=0.3, help="seconds per search page")
+    parser.add_argument("--search-tail-fraction", type=float, default=0.0, help="share of searches that take --search-tail-latency")
+    parser.add_argument("--search-tail-latency", type=float, default=3.0, help="seconds for a slow search")
+    parser.add_argument("--search-error-rate", type=float, default=0.0, help="share of searches answered with 503")
+    parser.add_argument("--searx-latency", type=float, default=0.3, help="seconds per SearXNG JSON answer")
+    parser.add_argument("--prefill-latency", type=float, default=0.5, help="seconds before the first token")
+    parser.add_argument("--prefill-rate", type=float, default=0.0, help="evaluated prompt tokens per second, 0 = free")
+    parser.add_argument("--prompt-cache-slots", type=int, default=4, help="cached prompts per model, 0 = no prefix reuse")
+    parser.add_argument("--token-rate", type=float, default=40.0, help="generated tokens per second, 0 = instant")
+    parser.add_argument("--pages", default=os.path.join(FIXTURES, "search"))
+    parser.add_argument("--replies", default=os.path.join(FIXTURES, "ollama_replies.jsonl"))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    try:
+        asyncio.run(run_servers(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Cold start profile: import-time breakdown of app.py and time-to-ready of a fresh replica.
+
+Usage: python bench/profile_startup.py [--top 15] [--no-launch] [--external]
+
+First runs `python -X importtime -c "import app"` and prints the slowest top-level packages
+(cumulative, as imported by the app) and modules (self time). Then launches `python app.py`
+against the fake Ollama/DuckDuckGo servers from bench/fake_servers.py (skip starting them with
+--external) and polls the readiness server until /healthz and then /ready answer 200, printing
+when each warm-up step finished.
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCH_DIR, "..")
+sys.path.insert(0, ROOT)
+
+from bench_e2e import start_fake_servers  # noqa: E402
+from fake_servers import add_arguments  # noqa: E402
+
+def import_profile(top):
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=ROOT, capture_output=True, text=True, env={**os.environ, "TRACE_ENABLED": "0"},
+    )
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((int(self_us), int(cumulative_us), name.strip(), depth))
+
+    total = next((cumulative for _, cumulative, name, _ in rows if name == "app"), 0)
+    # Depth 1 are the imports app.py itself triggers, their cumulative time adds up to the total
+    packages = {}
+    for _, cumulative, name, depth in rows:
+        if depth == 1:
+            packages[name.split(".")[0]] = packages.get(name.split(".")[0], 0) + cumulative
+    print(f"import app: {total / 1e6:.2f}s")
+    print(f"\n{'imported by app':<32} {'cumulative s':>12}")
+    for name, us in sorted(packages.items(), key=lambda kv: -kv[1])[:top]:
+        print(f"{name:<32} {us / 1e6:>12.3f}")
+    print(f"\n{'module':<48} {'self s':>8}")
+    for self_us, _, name, _ in sorted(rows, reverse=True)[:top]:
+        print(f"{name:<48} {self_us / 1e6:>8.3f}")
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def get(url):
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read() or b"{}")
+    except OSError:
+        return None, None
+
+def time_to_ready(args, timeout=120):
+    ready_port = free_port()
+    env = {
+        **os.environ,
+        "READY_PORT": str(ready_port),
+        "READY_HOST": "127.0.0.1",
+        "GRADIO_SERVER_PORT": str(free_port()),
+        "SEARCH_URL": f"http://{args.host}:{args.search_port}/html/",
+        "OLLAMA_HOST": f"http://{args.host}:{args.ollama_port}",
+        "LOG_LEVEL": "WARNING",
+    }
+    started = time.perf_counter()
+    app = subprocess.Popen([sys.executable, "app.py"], cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    alive = None
+    try:
+        while time.perf_counter() - started < timeout:
+            if alive is None and get(f"http://127.0.0.1:{ready_port}/healthz")[0] == 200:
+                alive = time.perf_counter() - started
+            code, body = get(f"http://127.0.0.1:{ready_port}/ready")
+            if code == 200:
+                ready = time.perf_counter() - started
+                print(f"\nprocess alive   {alive:.2f}s")
+                print(f"ready           {ready:.2f}s")
+                for step, at in body["steps"].items():
+                    print(f"  {step:<13} {at:.2f}s after startup began")
+                for step, error in body["errors"].items():
+                    print(f"  {step} failed: {error}")
+                return ready
+            time.sleep(0.05)
+        print(f"\nnot ready after {timeout}s", file=sys.stderr)
+        return None
+    finally:
+        app.terminate()
+        app.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--no-launch", action="store_true", help="only print the import profile")
+    parser.add_argument("--external", action="store_true", help="use fake servers that are already running")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    import_profile(args.top)
+    if args.no_launch:
+        return
+    servers = None if args.external else start_fake_servers(args)
+    try:
+        time_to_ready(args)
+    finally:
+        if servers is not None:
+            servers.terminate()
+            servers.wait()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_DIR = os.environ.get("CACHE_DIR", ".cache")
+
+# Marker for "not in cache", so a cached None/[] is still a hit
+MISS = object()
+
+
+class TwoTierCache:
+    """In-memory LRU in front of a SQLite table, both with per-entry TTL and a size bound.
+
+    Values must be JSON serializable. Pass `path=None` to keep only the memory tier.
+    """
+
+    def __init__(self, path, table="cache", max_memory_entries=1024, max_disk_entries=50000, ttl=86400):
+        self.table = table
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+        self._memory = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._writes_since_trim = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._db = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._db.execute(f"CREATE INDEX IF NOT EXISTS {table}_accessed ON {table}(accessed_at)")
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return value
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    if row[1] > now:
+                        self._db.execute(f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?", (now, key))
+                        value = json.loads(row[0])
+                        self._remember(key, row[1], value)
+                        self.disk_hits += 1
+                        return value
+                    self._db.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+            self.misses += 1
+            return MISS
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._remember(key, expires_at, value)
+            if self._db is not None:
+                self._db.execute(
+                    f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(value, ensure_ascii=False), expires_at, now),
+                )
+                self._writes_since_trim += 1
+                # Trimming needs a COUNT(*), so only do it every so often
+                if self._writes_since_trim >= 100:
+                    self._trim_disk(now)
+
+    def delete(self, key):
+        with self._lock:
+            self._memory.pop(key, None)
+            if self._db is not None:
+                self._db.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def purge(self):
+        """Drop every entry from both tiers"""
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute(f"DELETE FROM {self.table}")
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "memory_entries": len(self._memory),
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _remember(self, key, expires_at, value):
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def _trim_disk(self, now):
+        self._writes_since_trim = 0
+        self._db.execute(f"DELETE FROM {self.table} WHERE expires_at <= ?", (now,))
+        (count,) = self._db.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()
+        overflow = count - self.max_disk_entries
+        if overflow > 0:
+            self._db.execute(
+                f"DELETE FROM {self.table} WHERE key IN "
+                f"(SELECT key FROM {self.table} ORDER BY accessed_at LIMIT ?)",
+                (overflow,),
+            )
+            self.evictions += overflow
@@ -0,0 +1,277 @@
+"""Offline book catalog: normalized-title -> (title, author) lookups without the model or the network.
+
+The index is a single memory-mapped file built from a bulk dump, e.g. Open Library's
+ol_dump_works / ol_dump_authors TSVs (https://openlibrary.org/developers/dumps), or from a
+plain "title<TAB>author" TSV:
+
+    python catalog.py build --works ol_dump_works.txt.gz --authors ol_dump_authors.txt.gz
+    python catalog.py build --tsv my_books.tsv
+    python catalog.py update --tsv more_books.tsv
+    python catalog.py lookup "the hobit"
+"""
+import argparse
+import gzip
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import unicodedata
+import numpy as np
+from asynclog import logger
+
+CATALOG_PATH = os.environ.get("CATALOG_PATH", os.path.join("data", "catalog.idx"))
+# Minimum trigram similarity for a fuzzy match to be trusted
+CATALOG_MIN_SCORE = float(os.environ.get("CATALOG_MIN_SCORE", "0.75"))
+
+_MAGIC = b"BKCAT001"
+# magic, records, blob size, postings count
+_HEADER = struct.Struct("<8sQQQ")
+_SEP = b"\x1f"
+
+# Normalized titles only use [a-z0-9 ], so every trigram maps to a slot in a dense table
+_ALPHABET = " abcdefghijklmnopqrstuvwxyz0123456789"
+_CHAR_ID = {c: i for i, c in enumerate(_ALPHABET)}
+_N_TRIGRAMS = len(_ALPHABET) ** 3
+# Trigrams like " th" match a large part of the catalog and add nothing but work
+_MAX_POSTINGS = 200000
+
+def normalize_title(title):
+    title = unicodedata.normalize("NFKD", title).encode("ascii", "ignore").decode("ascii")
+    return re.sub(r"[^a-z0-9]+", " ", title.lower()).strip()
+
+def trigrams(norm):
+    padded = f"  {norm} "
+    ids = {
+        (_CHAR_ID[padded[i]] * 37 + _CHAR_ID[padded[i + 1]]) * 37 + _CHAR_ID[padded[i + 2]]
+        for i in range(len(padded) - 2)
+    }
+    return sorted(ids)
+
+class Catalog:
+    """Read-only view over an index file; lookups touch only the pages they need"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.size, blob_size, n_postings = _HEADER.unpack_from(self._mm, 0)
+        if magic != _MAGIC:
+            raise ValueError(f"{path} is not a catalog index")
+
+        pos = _HEADER.size
+        self._offsets = np.frombuffer(self._mm, dtype="<u8", count=self.size + 1, offset=pos)
+        pos += 8 * (self.size + 1)
+        self._blob_start = pos
+        pos += blob_size
+        self._tri_counts = np.frombuffer(self._mm, dtype="<u2", count=self.size, offset=pos)
+        pos += 2 * self.size
+        self._tri_starts = np.frombuffer(self._mm, dtype="<u8", count=_N_TRIGRAMS + 1, offset=pos)
+        pos += 8 * (_N_TRIGRAMS + 1)
+        self._postings = np.frombuffer(self._mm, dtype="<u4", count=n_postings, offset=pos)
+
+    def close(self):
+        self._offsets = self._tri_counts = self._tri_starts = self._postings = None
+        self._mm.close()
+        self._file.close()
+
+    def record(self, i):
+        start = self._blob_start + int(self._offsets[i])
+        end = self._blob_start + int(self._offsets[i + 1])
+        norm, title, author = self._mm[start:end].split(_SEP)
+        return norm.decode("utf-8"), title.decode("utf-8"), author.decode("utf-8")
+
+    def _norm_at(self, i):
+        start = self._blob_start + int(self._offsets[i])
+        return self._mm[start:self._mm.find(_SEP, start)]
+
+    def records(self):
+        for i in range(self.size):
+            yield self.record(i)
+
+    def lookup(self, title):
+        """Exact match on the normalized title; returns (title, author) or None"""
+        key = normalize_title(title).encode("utf-8")
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._norm_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.size and self._norm_at(lo) == key:
+            _, title, author = self.record(lo)
+            return title, author
+        return None
+
+    def search(self, title, limit=5):
+        """Fuzzy match by trigram Jaccard similarity; returns [(score, title, author)] best first"""
+        query = trigrams(normalize_title(title))
+        if not query or self.size == 0:
+            return []
+        lists = []
+        for t in query:
+            start, end = int(self._tri_starts[t]), int(self._tri_starts[t + 1])
+            if 0 < end - start <= _MAX_POSTINGS:
+                lists.append(self._postings[start:end])
+        if not lists:
+            return []
+
+        ids, common = np.unique(np.concatenate(lists), return_counts=True)
+        scores = common / (len(query) + self._tri_counts[ids].astype(np.float64) - common)
+        best = np.argsort(-scores, kind="stable")[:limit]
+        results = []
+        for i in best:
+            _, found_title, author = self.record(int(ids[i]))
+            results.append((float(scores[i]), found_title, author))
+        return results
+
+    def resolve(self, title, min_score=CATALOG_MIN_SCORE):
+        """Exact lookup, then the best fuzzy match above `min_score`; returns (title, author) or None"""
+        exact = self.lookup(title)
+        if exact is not None:
+            return exact
+        matches = self.search(title, limit=1)
+        if matches and matches[0][0] >= min_score:
+            return matches[0][1], matches[0][2]
+        return None
+
+_catalog = None
+_catalog_checked = False
+
+def get_catalog():
+    """The catalog at CATALOG_PATH, or None when no index has been built"""
+    global _catalog, _catalog_checked
+    if not _catalog_checked:
+        _catalog_checked = True
+        if os.path.exists(CATALOG_PATH):
+            _catalog = Catalog(CATALOG_PATH)
+            logger.info("[catalog] Loaded %d titles from %s", _catalog.size, CATALOG_PATH)
+    return _catalog
+
+def write_index(entries, path):
+    """Write {normalized title: (title, author, rank)} to `path` atomically"""
+    keys = sorted(entries)
+    blob = bytearray()
+    offsets = np.zeros(len(keys) + 1, dtype="<u8")
+    tri_counts = np.zeros(len(keys), dtype="<u2")
+    pair_tris, pair_ids = [], []
+
+    for i, norm in enumerate(keys):
+        title, author, _ = entries[norm]
+        blob += _SEP.join(s.replace("\x1f", " ").encode("utf-8") for s in (norm, title, author))
+        offsets[i + 1] = len(blob)
+        tris = trigrams(norm)
+        tri_counts[i] = min(len(tris), 65535)
+        pair_tris.append(np.asarray(tris, dtype=np.uint32))
+        pair_ids.append(np.full(len(tris), i, dtype=np.uint32))
+
+    tris = np.concatenate(pair_tris) if pair_tris else np.zeros(0, dtype=np.uint32)
+    ids = np.concatenate(pair_ids) if pair_ids else np.zeros(0, dtype=np.uint32)
+    order = np.argsort(tris, kind="stable")
+    postings = ids[order].astype("<u4")
+    tri_starts = np.zeros(_N_TRIGRAMS + 1, dtype="<u8")
+    np.cumsum(np.bincount(tris, minlength=_N_TRIGRAMS), out=tri_starts[1:])
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, len(keys), len(blob), len(postings)))
+        f.write(offsets.tobytes())
+        f.write(blob)
+        f.write(tri_counts.tobytes())
+        f.write(tri_starts.tobytes())
+        f.write(postings.tobytes())
+    os.replace(tmp, path)
+
+def _open_text(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, encoding="utf-8", errors="replace")
+
+def _add(entries, title, author, rank):
+    title, author = title.strip(), author.strip()
+    norm = normalize_title(title)
+    if not norm or not author:
+        return
+    current = entries.get(norm)
+    # Several works share a title; keep the most revised one, a decent popularity proxy
+    if current is None or rank > current[2]:
+        entries[norm] = (title, author, rank)
+
+def read_openlibrary(works_path, authors_path, entries):
+    authors = {}
+    with _open_text(authors_path) as f:
+        for line in f:
+            parts = line.rstrip("\n").split("\t", 4)
+            if len(parts) == 5 and parts[0] == "/type/author":
+                name = json.loads(parts[4]).get("name")
+                if name:
+                    authors[parts[1]] = name
+    print(f"[catalog] {len(authors)} authors")
+
+    with _open_text(works_path) as f:
+        for line in f:
+            parts = line.rstrip("\n").split("\t", 4)
+            if len(parts) != 5 or parts[0] != "/type/work":
+                continue
+            work = json.loads(parts[4])
+            for ref in work.get("authors", []):
+                key = (ref.get("author") or {}).get("key") if isinstance(ref, dict) else None
+                if key in authors:
+                    _add(entries, work.get("title", ""), authors[key], int(parts[2] or 0))
+                    break
+
+def read_tsv(path, entries):
+    with _open_text(path) as f:
+        for line in f:
+            parts = line.rstrip("\n").split("\t")
+            if len(parts) >= 2:
+                # Plain lists have no popularity signal, the first occurrence wins
+                _add(entries, parts[0], parts[1], -len(entries))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build and query the offline book catalog index")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name in ("build", "update"):
+        p = sub.add_parser(name, help=f"{name} the index ({'replace' if name == 'build' else 'merge into'} existing)")
+        p.add_argument("--works", help="Open Library works dump (.txt or .txt.gz)")
+        p.add_argument("--authors", help="Open Library authors dump (.txt or .txt.gz)")
+        p.add_argument("--tsv", action="append", default=[], help="title<TAB>author file, may repeat")
+        p.add_argument("--out", default=CATALOG_PATH)
+    p = sub.add_parser("lookup", help="resolve a title against the index")
+    p.add_argument("title")
+    p.add_argument("--index", default=CATALOG_PATH)
+    args = parser.parse_args(argv)
+
+    if args.command == "lookup":
+        catalog = Catalog(args.index)
+        print("exact:", catalog.lookup(args.title))
+        for score, title, author in catalog.search(args.title):
+            print(f"{score:.2f}  {title} — {author}")
+        return 0
+
+    if bool(args.works) != bool(args.authors):
+        parser.error("--works and --authors must be given together")
+    if not args.works and not args.tsv:
+        parser.error("nothing to index, pass --works/--authors and/or --tsv")
+
+    entries = {}
+    if args.command == "update" and os.path.exists(args.out):
+        existing = Catalog(args.out)
+        for norm, title, author in existing.records():
+            # Lowest possible rank, so anything in the new inputs replaces it
+            entries[norm] = (title, author, -sys.maxsize)
+        existing.close()
+    if args.works:
+        read_openlibrary(args.works, args.authors, entries)
+    for path in args.tsv:
+        read_tsv(path, entries)
+
+    write_index(entries, args.out)
+    print(f"[catalog] Wrote {len(entries)} titles to {args.out}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
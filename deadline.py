@@ -0,0 +1,31 @@
+"""Per-request time budget.
+
+A deadline is an absolute wall-clock time (time.time()) stored in the graph state, so it survives
+the checkpointer and means the same thing in every node. Callers set a fresh one with each input:
+
+    graph.astream({"user_input": text, "deadline": new_deadline()})
+
+Nodes pass remaining(deadline, cap) as the timeout of each call and return what they have when it
+runs out, instead of letting one slow search or generation set the latency of the whole request.
+"""
+import os
+import time
+
+# Seconds a request may take end to end, 0 = no deadline
+REQUEST_BUDGET = float(os.environ.get("REQUEST_BUDGET", "120"))
+
+def new_deadline(budget=None):
+    budget = REQUEST_BUDGET if budget is None else budget
+    if not budget or budget <= 0:
+        return None
+    return time.time() + budget
+
+def remaining(deadline, cap=None):
+    """Seconds left before `deadline` (never negative), at most `cap`; `cap` when there is no deadline"""
+    if deadline is None:
+        return cap
+    left = max(0.0, deadline - time.time())
+    return left if cap is None else min(left, cap)
+
+def expired(deadline):
+    return deadline is not None and time.time() >= deadline
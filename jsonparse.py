@@ -0,0 +1,334 @@
+import json
+import re
+
+# JSON schemas handed to the model server as `format=`, so the reply is constrained to valid JSON
+BOOK_LIST_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "title": {"type": "string", "minLength": 1},
+            "author": {"type": "string"},
+        },
+        "required": ["title", "author"],
+    },
+}
+
+# Extraction that also fills in authors (fused author completion): every entry needs one
+AUTHORED_BOOK_LIST_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "title": {"type": "string", "minLength": 1},
+            "author": {"type": "string", "minLength": 1},
+        },
+        "required": ["title", "author"],
+    },
+}
+
+RECOMMENDATION_LIST_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "title": {"type": "string", "minLength": 1},
+            "reason": {"type": "string"},
+            "link": {"type": "string"},
+        },
+        "required": ["title", "reason", "link"],
+    },
+}
+
+_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "number": (int, float),
+    "integer": int,
+    "boolean": bool,
+    "null": type(None),
+}
+
+def compile_schema(schema):
+    """Turn the subset of JSON Schema used above into a plain `check(value) -> bool` function.
+
+    Supports type, properties, required, items and minLength; compiled once at import time.
+    """
+    checks = []
+
+    expected = _TYPES.get(schema.get("type"))
+    if expected is not None:
+        if schema["type"] in ("number", "integer"):
+            # bool is an int subclass but not a JSON number
+            checks.append(lambda v: isinstance(v, expected) and not isinstance(v, bool))
+        else:
+            checks.append(lambda v: isinstance(v, expected))
+
+    if "minLength" in schema:
+        min_length = schema["minLength"]
+        checks.append(lambda v: not isinstance(v, str) or len(v.strip()) >= min_length)
+
+    required = tuple(schema.get("required", ()))
+    if required:
+        checks.append(lambda v: not isinstance(v, dict) or all(k in v for k in required))
+
+    properties = {name: compile_schema(sub) for name, sub in schema.get("properties", {}).items()}
+    if properties:
+        checks.append(
+            lambda v: not isinstance(v, dict)
+            or all(check(v[name]) for name, check in properties.items() if name in v)
+        )
+
+    if "items" in schema:
+        item_check = compile_schema(schema["items"])
+        checks.append(lambda v: not isinstance(v, list) or all(item_check(i) for i in v))
+
+    checks = tuple(checks)
+    return lambda value: all(check(value) for check in checks)
+
+_WORD = re.compile(r"-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?|[A-Za-z_][\w\-]*")
+_LITERALS = {"true": "true", "false": "false", "null": "null", "True": "true", "False": "false", "None": "null"}
+_CONTROL = {"\n": "\\n", "\r": "\\r", "\t": "\\t"}
+
+class ArrayScanner:
+    """Single pass, bracket-aware scanner for the first JSON-ish array in LLM output.
+
+    Text can be fed in chunks as it streams in; `feed` returns the top-level elements that
+    completed in that chunk. While scanning it repairs the usual llama3 mistakes in place:
+    single quotes, unquoted keys, Python literals, trailing or missing commas, objects wrapped
+    in quotes and a reply cut off mid-array. Each element is decoded on its own, so one broken
+    element is dropped instead of failing the whole reply.
+    """
+
+    def __init__(self):
+        self.items = []
+        # How many of `items` feed() has returned so far
+        self.emitted = 0
+        self.done = False
+        self.found = False
+        self._fallback = None
+        self._buf = ""
+        self._stack = []
+        self._out = []
+        self._last = None
+
+    def feed(self, text):
+        if self.done:
+            return []
+        self._buf += text
+        self._scan(final=False)
+        # Not a length taken before the scan: _close_top may swap `items` for a later array mid-chunk
+        new = self.items[self.emitted:]
+        self.emitted = len(self.items)
+        return new
+
+    def finish(self):
+        """Flush the remaining text; returns the recovered array or None if there was none"""
+        if not self.done:
+            self._scan(final=True)
+        if not self.found:
+            return None
+        if not self.items and self._fallback:
+            return self._fallback
+        return self.items
+
+    def _emit(self, token):
+        if self._last in ("value", "close"):
+            # Missing comma between two values
+            if len(self._stack) == 1:
+                self._finish_element()
+            else:
+                self._out.append(",")
+        self._out.append(token)
+
+    def _finish_element(self):
+        if self._out:
+            try:
+                self.items.append(json.loads("".join(self._out)))
+            except ValueError:
+                pass
+            self._out = []
+
+    def _close_top(self):
+        self._stack = []
+        self._last = None
+        # Prefer an array of objects: "[some note] then [{...}]" should pick the second one
+        if not self.items or any(isinstance(i, (dict, list)) for i in self.items):
+            self.done = True
+        else:
+            self._fallback = self._fallback or self.items
+            self.items = []
+            self.emitted = 0
+
+    def _scan(self, final):
+        buf = self._buf
+        n = len(buf)
+        i = 0
+        while i < n and not self.done:
+            if not self._stack:
+                j = buf.find("[", i)
+                if j < 0:
+                    i = n
+                    break
+                self.found = True
+                self._stack.append("]")
+                self._out = []
+                self._last = "open"
+                i = j + 1
+                continue
+
+            c = buf[i]
+            if c.isspace():
+                i += 1
+                continue
+
+            if c == '"' or c == "'":
+                k = i + 1
+                while k < n and buf[k].isspace():
+                    k += 1
+                if k == n and not final:
+                    break
+                # A quote wrapping an object ("{...}") or trailing one ({...}") is noise
+                if (k < n and buf[k] == "{") or (self._last == "close" and c == '"'):
+                    i += 1
+                    continue
+                end = self._string_end(buf, i, c)
+                if end < 0:
+                    if final:
+                        i = n
+                    break
+                raw = buf[i + 1:end]
+                if c == "'":
+                    raw = raw.replace("\\'", "'").replace('"', '\\"')
+                else:
+                    raw = raw.replace("\\'", "'")
+                for ch, escaped in _CONTROL.items():
+                    if ch in raw:
+                        raw = raw.replace(ch, escaped)
+                self._emit('"' + raw + '"')
+                self._last = "value"
+                i = end + 1
+                continue
+
+            if c == "[" or c == "{":
+                if c == "{" and self._stack[-1] == "}" and self._last == "value":
+                    # An object can't start where a key is expected: the previous one was never closed
+                    self._out.append(self._stack.pop())
+                    self._last = "close"
+                    if len(self._stack) == 1:
+                        self._finish_element()
+                self._emit(c)
+                self._stack.append("]" if c == "[" else "}")
+                self._last = "open"
+                i += 1
+                continue
+
+            if c == "]" or c == "}":
+                i += 1
+                if len(self._stack) == 1:
+                    if c == "]":
+                        self._finish_element()
+                        self._close_top()
+                    continue
+                if c not in self._stack:
+                    continue
+                # Auto-close anything left open inside the container being closed
+                while True:
+                    if self._out and self._out[-1] == ",":
+                        self._out.pop()
+                    closer = self._stack.pop()
+                    self._out.append(closer)
+                    if closer == c:
+                        break
+                self._last = "close" if c == "}" else "value"
+                if len(self._stack) == 1:
+                    self._finish_element()
+                continue
+
+            if c == ",":
+                if len(self._stack) == 1:
+                    self._finish_element()
+                elif self._last in ("value", "close"):
+                    self._out.append(",")
+                self._last = "comma"
+                i += 1
+                continue
+
+            if c == ":":
+                self._out.append(":")
+                self._last = "colon"
+                i += 1
+                continue
+
+            m = _WORD.match(buf, i)
+            if m:
+                if m.end() == n and not final:
+                    break
+                word = m.group(0)
+                k = m.end()
+                while k < n and buf[k].isspace():
+                    k += 1
+                if k < n and buf[k] == ":":
+                    self._emit(json.dumps(word))
+                elif word in _LITERALS:
+                    self._emit(_LITERALS[word])
+                elif word[0] == "-" or word[0].isdigit():
+                    self._emit(word)
+                else:
+                    self._emit(json.dumps(word))
+                self._last = "value"
+                i = m.end()
+                continue
+
+            # Anything else (backticks, stray punctuation) is noise
+            i += 1
+
+        self._buf = buf[i:]
+
+    @staticmethod
+    def _string_end(buf, start, quote):
+        j = start + 1
+        while True:
+            k = buf.find(quote, j)
+            if k < 0:
+                return -1
+            backslashes = 0
+            b = k - 1
+            while b > start and buf[b] == "\\":
+                backslashes += 1
+                b -= 1
+            if backslashes % 2 == 0:
+                return k
+            j = k + 1
+
+def scan_first_array(text: str):
+    """Recover the first array from `text` in one linear pass, None if there is no array"""
+    scanner = ArrayScanner()
+    scanner.feed(text)
+    return scanner.finish()
+
+def _unwrap(item):
+    # Some replies put each object in a string: ["{\"title\": ...}"]
+    if isinstance(item, str) and "{" in item:
+        inner = scan_first_array("[" + item + "]")
+        if inner and isinstance(inner[0], dict):
+            return inner[0]
+    return item
+
+def parse_json_array(content: str, item_check=None):
+    """Parse an LLM reply that should be a JSON array, keeping only elements passing `item_check`"""
+    try:
+        value = json.loads(content)
+    except ValueError:
+        value = None
+    if not isinstance(value, list):
+        value = scan_first_array(content) or []
+    items = [_unwrap(item) for item in value]
+    if item_check is not None:
+        items = [item for item in items if item_check(item)]
+    return items
+
+# Replies from unconstrained models often leave out optional fields, only the title is mandatory
+check_book = compile_schema({**BOOK_LIST_SCHEMA["items"], "required": ["title"]})
+check_recommendation = compile_schema({**RECOMMENDATION_LIST_SCHEMA["items"], "required": ["title"]})
@@ -0,0 +1,21 @@
+import importlib.util
+import sys
+
+def lazy_import(name):
+    """Return module `name`, deferring its actual import until an attribute is first used.
+
+    For heavy dependencies (httpx, ollama) that modules need at call time but not at import
+    time, so `import app` doesn't pay for them before the UI can start.
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named {name!r}", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -0,0 +1,259 @@
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import time
+import models
+import tracing
+from cache import TwoTierCache, CACHE_DIR, MISS
+from contextlib import aclosing
+from singleflight import SingleFlight
+from lazyimport import lazy_import
+
+ollama = lazy_import("ollama")
+
+# How many generations may run against the model server at once, the rest queue here
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "2"))
+# Per-call timeout in seconds, covers both queueing and generation
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "180"))
+
+# Response memo for deterministic prompts, nodes opt in with chat(..., cache=True)
+LLM_CACHE_ENABLED = os.environ.get("LLM_CACHE_ENABLED", "1") == "1"
+
+llm_cache = TwoTierCache(
+    os.path.join(CACHE_DIR, "llm.sqlite3"),
+    table="llm_responses",
+    max_memory_entries=int(os.environ.get("LLM_CACHE_MEMORY_ENTRIES", "1024")),
+    max_disk_entries=int(os.environ.get("LLM_CACHE_DISK_ENTRIES", "20000")),
+    ttl=float(os.environ.get("LLM_CACHE_TTL", str(7 * 24 * 3600))),
+)
+
+# Identical prompts in flight at the same time are sent to the model once
+llm_flight = SingleFlight("llm")
+
+_client = None
+_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+
+def get_client():
+    """Return the shared ollama.AsyncClient, creating it on first use (honours OLLAMA_HOST)"""
+    global _client
+    if _client is None:
+        _client = ollama.AsyncClient()
+    return _client
+
+def set_client(client):
+    global _client
+    _client = client
+
+async def _acquire_slot():
+    queued = time.perf_counter()
+    await _semaphore.acquire()
+    tracing.observe("llm_queue_wait_seconds", time.perf_counter() - queued)
+
+def _fallback_for(error, model):
+    """The model to retry with when the server doesn't have `model`, None for any other error"""
+    return models.fall_back(model) if models.is_missing(error) else None
+
+async def _chat(model, messages, **kwargs):
+    await _acquire_slot()
+    try:
+        try:
+            return await get_client().chat(model=model, messages=messages, **kwargs)
+        except Exception as e:
+            fallback = _fallback_for(e, model)
+            if fallback is None:
+                raise
+            return await get_client().chat(model=fallback, messages=messages, **kwargs)
+    finally:
+        _semaphore.release()
+
+def _record_usage(model, response, span):
+    # prompt_eval_count covers only the tokens evaluated for this call, not a reused cached prefix
+    prompt_tokens = response.get("prompt_eval_count") or 0
+    completion_tokens = response.get("eval_count") or 0
+    prompt_eval = (response.get("prompt_eval_duration") or 0) / 1e9
+    tracing.incr("llm_prompt_tokens_total", prompt_tokens, model=model)
+    tracing.incr("llm_completion_tokens_total", completion_tokens, model=model)
+    tracing.observe("llm_prompt_eval_seconds", prompt_eval, model=model)
+    span.set(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, prompt_eval_ms=round(prompt_eval * 1000, 3))
+
+def cache_key(model, messages, options=None, format=None):
+    """Content address of a call: everything that influences the generated text"""
+    payload = json.dumps(
+        {"model": model, "options": options or {}, "format": format or "", "messages": messages},
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def request_key(model, messages, kwargs):
+    """Identity of an in-flight call for coalescing: the cache key plus any other call options"""
+    extra = {k: v for k, v in kwargs.items() if k not in ("options", "format")}
+    key = cache_key(model, messages, kwargs.get("options"), kwargs.get("format"))
+    if extra:
+        key += json.dumps(extra, sort_keys=True, default=str)
+    return key
+
+def _to_cacheable(response):
+    return {
+        "model": response["model"],
+        "message": {"role": response["message"]["role"], "content": response["message"]["content"]},
+    }
+
+async def chat(model, messages, timeout=None, cache=False, prompt=None, **kwargs):
+    """Non-blocking replacement for ollama.chat.
+
+    Raises asyncio.TimeoutError when the call takes longer than `timeout` (default LLM_TIMEOUT).
+    Cancelling the awaiting task cancels the request and frees its slot.
+    With `cache=True` identical calls are answered from llm_cache instead of the model.
+    `prompt` names the prompt (see prompts.py) on the call's span.
+    """
+    if kwargs.get("stream"):
+        # The slot would be released before the first token; stream_chat holds it for the whole stream
+        raise ValueError("llm.chat does not stream, use llm.stream_chat")
+    timeout = LLM_TIMEOUT if timeout is None else timeout
+    use_cache = cache and LLM_CACHE_ENABLED
+    with tracing.span("llm.chat", model=model, prompt=prompt) as span:
+        if use_cache:
+            key = cache_key(model, messages, kwargs.get("options"), kwargs.get("format"))
+            cached = llm_cache.get(key)
+            if cached is not MISS:
+                tracing.incr("llm_cache_hits_total", model=model)
+                span.set(cached=True)
+                return cached
+            tracing.incr("llm_cache_misses_total", model=model)
+
+        async def call():
+            response = await _chat(model, messages, **kwargs)
+            tracing.incr("llm_calls_total", model=model)
+            _record_usage(model, response, span)
+            if use_cache:
+                llm_cache.set(key, _to_cacheable(response))
+            return response
+
+        # Concurrent identical calls share one generation; each caller keeps its own timeout
+        return await asyncio.wait_for(llm_flight.do(request_key(model, messages, kwargs), call), timeout)
+
+async def stream_chat(model, messages, timeout=None, cache=False, prompt=None, **kwargs):
+    """Streaming variant of chat(): yields response chunks as the model produces them.
+
+    The slot is held until the stream is exhausted or closed; `timeout` bounds the whole stream
+    for this caller only. A shared stream runs under LLM_TIMEOUT, so a subscriber running out of
+    time leaves it without cutting it short for the others. With `cache=True` a memoized reply is
+    yielded as a single chunk, and a fresh one is stored once the stream completes.
+    """
+    timeout = LLM_TIMEOUT if timeout is None else timeout
+    use_cache = cache and LLM_CACHE_ENABLED
+    if use_cache:
+        key = cache_key(model, messages, kwargs.get("options"), kwargs.get("format"))
+        cached = llm_cache.get(key)
+        if cached is not MISS:
+            tracing.incr("llm_cache_hits_total", model=model)
+            yield {**cached, "done": True}
+            return
+        tracing.incr("llm_cache_misses_total", model=model)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    # Concurrent identical streams share one generation; joiners replay what was already produced
+    shared = llm_flight.stream(
+        request_key(model, messages, kwargs),
+        lambda: _stream(model, messages, LLM_TIMEOUT, key if use_cache else None, kwargs, prompt),
+    )
+    async with aclosing(shared) as chunks:
+        iterator = chunks.__aiter__()
+        while True:
+            left = deadline - loop.time()
+            if left <= 0:
+                raise asyncio.TimeoutError()
+            try:
+                chunk = await asyncio.wait_for(iterator.__anext__(), left)
+            except StopAsyncIteration:
+                break
+            yield chunk
+
+async def _open_stream(model, messages, kwargs, remaining):
+    """(stream, iterator, first chunk or None); the server's errors, e.g. a missing model, arrive here"""
+    stream = await asyncio.wait_for(
+        get_client().chat(model=model, messages=messages, stream=True, **kwargs), remaining()
+    )
+    iterator = stream.__aiter__()
+    try:
+        chunk = await asyncio.wait_for(iterator.__anext__(), remaining())
+    except StopAsyncIteration:
+        chunk = None
+    except BaseException:
+        if hasattr(stream, "aclose"):
+            await stream.aclose()
+        raise
+    return stream, iterator, chunk
+
+async def _stream(model, messages, timeout, store_key, kwargs, prompt=None):
+    use_cache = store_key is not None
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+
+    def remaining():
+        left = deadline - loop.time()
+        if left <= 0:
+            raise asyncio.TimeoutError()
+        return left
+
+    # Detached: the consumer runs its own work (and spans) between chunks
+    span = tracing.span("llm.stream", detached=True, model=model, prompt=prompt)
+    span.__enter__()
+    started = time.perf_counter()
+    stream = None
+    acquired = False
+    try:
+        # Inside the try: a stream that times out or is cancelled in the queue still exports its span
+        await asyncio.wait_for(_acquire_slot(), remaining())
+        acquired = True
+        try:
+            stream, iterator, chunk = await _open_stream(model, messages, kwargs, remaining)
+        except Exception as e:
+            fallback = _fallback_for(e, model)
+            if fallback is None:
+                raise
+            model = fallback
+            stream, iterator, chunk = await _open_stream(model, messages, kwargs, remaining)
+        tracing.incr("llm_calls_total", model=model)
+        parts = []
+        first = True
+        while chunk is not None:
+            if first:
+                first = False
+                ttft = time.perf_counter() - started
+                tracing.observe("llm_time_to_first_token_seconds", ttft, model=model)
+                span.set(ttft_ms=round(ttft * 1000, 3))
+            if chunk.get("done"):
+                _record_usage(model, chunk, span)
+            if use_cache:
+                parts.append(chunk["message"]["content"])
+            yield chunk
+            try:
+                chunk = await asyncio.wait_for(iterator.__anext__(), remaining())
+            except StopAsyncIteration:
+                chunk = None
+        if use_cache:
+            llm_cache.set(store_key, {"model": model, "message": {"role": "assistant", "content": "".join(parts)}})
+    finally:
+        if stream is not None and hasattr(stream, "aclose"):
+            await stream.aclose()
+        if acquired:
+            _semaphore.release()
+        span.__exit__(*sys.exc_info())
+
+async def embed(model, texts, timeout=None, **kwargs):
+    """Embed a batch of texts with the model server; returns one vector per text.
+
+    Embedding calls are short, so they skip the generation semaphore instead of queueing behind it.
+    """
+    timeout = LLM_TIMEOUT if timeout is None else timeout
+    with tracing.span("llm.embed", model=model, texts=len(texts)):
+        response = await asyncio.wait_for(get_client().embed(model=model, input=texts, **kwargs), timeout)
+    return response["embeddings"]
+
+def cache_stats():
+    return llm_cache.stats()
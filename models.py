@@ -0,0 +1,133 @@
+"""Which model each node uses, with its generation options and keep_alive.
+
+Extraction and author completion are short structured tasks and run on a small model; only
+reasoning needs the large one. Override per role with environment variables:
+
+    MODEL_EXTRACT=qwen2.5:3b  MODEL_EXTRACT_OPTIONS='{"num_ctx": 2048, "temperature": 0}'
+    MODEL_REASONING=llama3:70b  MODEL_REASONING_KEEP_ALIVE=-1
+
+Roles: extract, authors, reasoning, embed. Ollama keeps a model loaded for keep_alive after each
+call (-1 = forever), and every request refreshes it, so busy models stay resident. With two chat
+models plus the embedder, the server needs OLLAMA_MAX_LOADED_MODELS >= 3.
+
+warm_up() (run from startup.py's background thread) loads every configured model up front with the
+same options as real calls, since a different num_ctx would make Ollama reload the model.
+"""
+import json
+import os
+import time
+from asynclog import logger
+from lazyimport import lazy_import
+
+ollama = lazy_import("ollama")
+
+LARGE_MODEL = os.environ.get("LLM_MODEL", "llama3")
+SMALL_MODEL = os.environ.get("LLM_SMALL_MODEL", "llama3.2:3b")
+EMBED_MODEL = os.environ.get("EMBED_MODEL", "nomic-embed-text")
+KEEP_ALIVE = os.environ.get("LLM_KEEP_ALIVE", "30m")
+# Load models in the background when the app starts
+WARM_UP_ENABLED = os.environ.get("LLM_WARM_UP", "1") == "1"
+
+class ModelConfig:
+    __slots__ = ("role", "model", "options", "keep_alive", "fallback")
+
+    def __init__(self, role, model, options=None, keep_alive=KEEP_ALIVE, fallback=None):
+        env = f"MODEL_{role.upper()}"
+        self.role = role
+        self.model = os.environ.get(env, model)
+        self.options = {**(options or {}), **json.loads(os.environ.get(f"{env}_OPTIONS", "{}"))}
+        self.keep_alive = _keep_alive(os.environ.get(f"{env}_KEEP_ALIVE", keep_alive))
+        # Used instead when `model` is not installed on the server
+        self.fallback = fallback
+
+    def chat_args(self):
+        return {"model": self.model, "options": dict(self.options), "keep_alive": self.keep_alive}
+
+    def __repr__(self):
+        return f"ModelConfig({self.role!r}, {self.model!r}, options={self.options}, keep_alive={self.keep_alive!r})"
+
+def _keep_alive(value):
+    # Ollama takes either a duration string ("30m") or a number of seconds (-1 = never unload)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+MODELS = {
+    "extract": ModelConfig("extract", SMALL_MODEL, {"temperature": 0, "num_ctx": 2048, "num_predict": 512}, fallback=LARGE_MODEL),
+    "authors": ModelConfig("authors", SMALL_MODEL, {"temperature": 0, "num_ctx": 2048, "num_predict": 512}, fallback=LARGE_MODEL),
+    "reasoning": ModelConfig("reasoning", LARGE_MODEL, {"num_ctx": 4096, "num_predict": 1024}),
+    "embed": ModelConfig("embed", EMBED_MODEL),
+}
+
+def _align_context():
+    # Ollama reloads a model whenever num_ctx changes, so roles sharing a model share the largest one
+    largest = {}
+    for config in MODELS.values():
+        if "num_ctx" in config.options:
+            largest[config.model] = max(largest.get(config.model, 0), config.options["num_ctx"])
+    for config in MODELS.values():
+        if config.model in largest and "num_ctx" in config.options:
+            config.options["num_ctx"] = largest[config.model]
+
+_align_context()
+
+# Models the server reported missing -> the fallback their roles were switched to
+_replaced = {}
+
+def fall_back(model):
+    """Switch the roles on `model`, which the server doesn't have, to their fallback.
+
+    Returns the model to retry with, or None when no role on `model` has a fallback. Called by
+    llm.py on a 404, so a missing small model doesn't fail requests when warm-up didn't run.
+    """
+    if model in _replaced:
+        return _replaced[model]
+    fallback = None
+    for config in MODELS.values():
+        if config.model == model and config.fallback and config.fallback != model:
+            logger.warning(
+                "[models] %s is not installed (ollama pull %s), %s falls back to %s",
+                model, model, config.role, config.fallback,
+            )
+            config.model = fallback = config.fallback
+    if fallback is not None:
+        _replaced[model] = fallback
+        _align_context()
+    return fallback
+
+def get(role):
+    return MODELS[role]
+
+def chat_args(role):
+    """model/options/keep_alive keyword arguments for llm.chat and llm.stream_chat"""
+    return MODELS[role].chat_args()
+
+def is_missing(error):
+    return isinstance(error, ollama.ResponseError) and error.status_code == 404
+
+async def _load(client, config):
+    started = time.perf_counter()
+    if config.role == "embed":
+        await client.embed(model=config.model, input=["warm-up"], keep_alive=config.keep_alive)
+    else:
+        # An empty conversation loads the model without generating anything
+        await client.chat(model=config.model, messages=[], options=config.options, keep_alive=config.keep_alive)
+    return time.perf_counter() - started
+
+async def warm_up(client=None):
+    """Load every configured model, switching roles whose model isn't installed to their fallback"""
+    client = client or ollama.AsyncClient()
+    for config in MODELS.values():
+        try:
+            elapsed = await _load(client, config)
+        except Exception as e:
+            if not (is_missing(e) and fall_back(config.model)):
+                logger.warning("[models] Could not load %s for %s: %r", config.model, config.role, e)
+                continue
+            try:
+                elapsed = await _load(client, config)
+            except Exception as e:
+                logger.warning("[models] Could not load %s for %s: %r", config.model, config.role, e)
+                continue
+        logger.info("[models] %s ready for %s in %.1fs", config.model, config.role, elapsed)
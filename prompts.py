@@ -0,0 +1,161 @@
+"""Prompt layout and context budgeting for the model calls in agents.py.
+
+Every prompt is a node's fixed instructions in the system message followed by the request's
+data in the user message. The instructions never contain request data, so for a given node they
+are the same bytes on every call and Ollama reuses their evaluated KV cache (it keeps the longest
+common prefix per slot); only the data after them is evaluated per request.
+
+The data is sized against the role's context window (num_ctx in models.py): its budget is num_ctx
+minus the instructions, the reply (num_predict) and PROMPT_TEMPLATE_OVERHEAD tokens for the chat
+template. Text that doesn't fit is cut at a line or word boundary and lists are split into
+chunks for separate calls. Calls send the same num_ctx the budget assumed, which stays fixed per
+model since changing it makes Ollama reload the model.
+
+Ollama has no tokenize endpoint, so tokens are estimated from characters with a ratio on the
+conservative side for English (PROMPT_CHARS_PER_TOKEN); prompt_eval_count on responses, traced by
+llm.py, shows what the model actually evaluated.
+"""
+import math
+import os
+import models
+import tracing
+from asynclog import logger
+
+PROMPT_CHARS_PER_TOKEN = float(os.environ.get("PROMPT_CHARS_PER_TOKEN", "3.5"))
+# Role headers and special tokens the chat template wraps around the two messages
+PROMPT_TEMPLATE_OVERHEAD = int(os.environ.get("PROMPT_TEMPLATE_OVERHEAD", "32"))
+# What Ollama uses when a call doesn't set num_ctx / num_predict
+DEFAULT_NUM_CTX = 2048
+DEFAULT_REPLY_TOKENS = 512
+# Never squeeze the data below this, even when the instructions and reply leave less room
+MIN_DATA_TOKENS = 64
+
+_JSON_RULES = (
+    "IMPORTANT: Output ONLY a valid JSON array with this exact format:\n"
+    "{format}\n"
+    "Rules:\n"
+    "- Use double quotes for all strings\n"
+    "- No trailing commas\n"
+    "- No markdown formatting or code blocks\n"
+    "- No explanations or extra text\n"
+    "{last_rule}"
+)
+
+def count_tokens(text):
+    return math.ceil(len(text) / PROMPT_CHARS_PER_TOKEN)
+
+def trim_text(text, max_tokens):
+    """`text` cut to about `max_tokens`, at the last line break or space that fits"""
+    limit = int(max_tokens * PROMPT_CHARS_PER_TOKEN)
+    if len(text) <= limit:
+        return text
+    cut = text[:limit]
+    boundary = max(cut.rfind("\n"), cut.rfind(" "))
+    return cut[:boundary] if boundary > limit // 2 else cut
+
+class NodePrompt:
+    """One node's prompt: fixed instructions, then a labelled data section sized to the budget"""
+
+    __slots__ = ("name", "role", "instructions", "label", "_fixed_tokens")
+
+    def __init__(self, name, role, instructions, label):
+        self.name = name
+        self.role = role
+        self.instructions = instructions
+        self.label = label
+        self._fixed_tokens = count_tokens(instructions) + count_tokens(label) + PROMPT_TEMPLATE_OVERHEAD
+
+    def num_ctx(self):
+        # Read per call: a missing model switches the role to its fallback and realigns num_ctx
+        return models.get(self.role).options.get("num_ctx", DEFAULT_NUM_CTX)
+
+    def budget(self):
+        """Tokens left for the data section"""
+        reply = models.get(self.role).options.get("num_predict", DEFAULT_REPLY_TOKENS)
+        if reply < 0:
+            reply = DEFAULT_REPLY_TOKENS
+        return max(MIN_DATA_TOKENS, self.num_ctx() - self._fixed_tokens - reply)
+
+    def fit_text(self, text):
+        fitted = trim_text(text, self.budget())
+        if len(fitted) < len(text):
+            tracing.incr("prompt_trimmed_total", prompt=self.name)
+            logger.warning("[prompts] %s data cut from ~%d to ~%d tokens", self.name, count_tokens(text), self.budget())
+        return fitted
+
+    def chunk_items(self, items, render):
+        """Items split into consecutive chunks that each fit the budget"""
+        if not items:
+            return []
+        budget = self.budget()
+        chunks = [[]]
+        used = 0
+        for item in items:
+            cost = count_tokens(render(item)) + 1
+            if chunks[-1] and used + cost > budget:
+                chunks.append([])
+                used = 0
+            chunks[-1].append(item)
+            used += cost
+        if len(chunks) > 1:
+            tracing.incr("prompt_chunked_total", prompt=self.name)
+        return chunks
+
+    def messages(self, data):
+        return [
+            {"role": "system", "content": self.instructions},
+            {"role": "user", "content": f"{self.label}{data}"},
+        ]
+
+    def chat_args(self, data):
+        """model/options/keep_alive/messages for llm.chat and llm.stream_chat, num_ctx always set"""
+        args = models.chat_args(self.role)
+        args["options"]["num_ctx"] = self.num_ctx()
+        args["messages"] = self.messages(data)
+        args["prompt"] = self.name
+        tracing.observe("prompt_data_tokens", count_tokens(data), prompt=self.name)
+        return args
+
+def _extraction_instructions(author_rule):
+    return (
+        "Extract all book titles and authors from the user input. Do not add books on your own, just take the user input. "
+        f"{author_rule}\n"
+        + _JSON_RULES.format(format='[{"title": "Book Title", "author": "Author Name"}]', last_rule="- If no books found, return empty array: []")
+    )
+
+EXTRACT = NodePrompt(
+    "extract", "extract",
+    _extraction_instructions(
+        "If a book is mentioned but the author is missing, try to fill the missing author in using reasoning with your knowledge."
+    ),
+    "User input: ",
+)
+
+# Extraction that also completes authors, so no separate completion call is needed
+EXTRACT_WITH_AUTHORS = NodePrompt(
+    "extract_with_authors", "extract",
+    _extraction_instructions(
+        "Every entry must have an author: fill in every author the user didn't mention from your knowledge."
+    ),
+    "User input: ",
+)
+
+AUTHORS = NodePrompt(
+    "authors", "authors",
+    "You are given a list of books with some missing authors. "
+    "For each book, fill in the correct author using your knowledge.\n"
+    + _JSON_RULES.format(format='[{"title": "Book Title", "author": "Author Name"}]', last_rule="- Return all books, not just the ones with missing authors"),
+    "Books with missing authors:\n",
+)
+
+REASONING = NodePrompt(
+    "reasoning", "reasoning",
+    "You are a helpful book recommendation expert. You are given web search results. "
+    "Analyze them and select the most relevant book recommendations. Explain why you recommend each book. "
+    "Do not recommend the same books from the user input!\n"
+    + _JSON_RULES.format(
+        format='[{"title": "Book Title", "reason": "Why this book is recommended", "link": "URL"}]',
+        last_rule="- If no good recommendations, return empty array: []",
+    ),
+    "Books found from search:\n",
+)
@@ -0,0 +1,306 @@
+"""Search providers behind one interface, queried in parallel with adaptive steering.
+
+Backends (SEARCH_PROVIDERS, comma separated, in order of preference):
+
+    duckduckgo  the HTML scraper in search.py
+    searxng     a self-hosted SearXNG instance's JSON API at SEARXNG_URL
+
+With SEARCH_STRATEGY=race (default) the SEARCH_FANOUT best-scoring providers start together and
+the first answer with at least SEARCH_MIN_RESULTS hits wins; the others are cancelled, and the
+next provider only starts when a running one fails. With SEARCH_STRATEGY=merge every provider
+runs for up to SEARCH_MERGE_BUDGET seconds and their hits are interleaved and deduped.
+
+Each provider's latency and error rate are tracked as moving averages; providers are ranked by
+latency inflated by their error rate, so a slow or failing backend loses traffic, and it gets
+probed now and then (SEARCH_PROBE_RATE) so it can win it back once it recovers.
+"""
+import asyncio
+import os
+import random
+import time
+from typing import NamedTuple
+import search
+import tracing
+from asynclog import logger
+from deadline import expired, remaining
+
+SEARCH_PROVIDERS = os.environ.get("SEARCH_PROVIDERS", "duckduckgo")
+SEARCH_STRATEGY = os.environ.get("SEARCH_STRATEGY", "race")
+SEARCH_FANOUT = int(os.environ.get("SEARCH_FANOUT", "2"))
+SEARCH_MIN_RESULTS = int(os.environ.get("SEARCH_MIN_RESULTS", "3"))
+SEARCH_MERGE_BUDGET = float(os.environ.get("SEARCH_MERGE_BUDGET", "1.5"))
+SEARCH_PROBE_RATE = float(os.environ.get("SEARCH_PROBE_RATE", "0.05"))
+SEARXNG_URL = os.environ.get("SEARXNG_URL", "http://127.0.0.1:8888/search")
+
+class SearchRequest(NamedTuple):
+    query: str
+    # "similar" (books like a given one) or "author" (who wrote `title`)
+    kind: str = "similar"
+    title: str = ""
+    max_results: int = 5
+    deadline: float = None
+
+class SearchUnavailable(Exception):
+    """Every provider failed for a query; `errors` maps provider name to its exception"""
+
+    def __init__(self, errors):
+        super().__init__(", ".join(f"{name}: {error!r}" for name, error in errors.items()))
+        self.errors = errors
+
+class ProviderStats:
+    __slots__ = ("latency", "failure", "calls", "errors", "wins")
+
+    # Weight of the newest sample in the moving averages
+    ALPHA = 0.2
+
+    def __init__(self):
+        self.latency = None
+        self.failure = 0.0
+        self.calls = 0
+        self.errors = 0
+        self.wins = 0
+
+    def record(self, seconds=None, failed=False):
+        self.calls += 1
+        self.errors += failed
+        self.failure += self.ALPHA * (float(failed) - self.failure)
+        if seconds is not None and not failed:
+            self.latency = seconds if self.latency is None else self.latency + self.ALPHA * (seconds - self.latency)
+
+    def score(self):
+        # Lower is better; unmeasured providers rank by configured order (latency 0 ties)
+        return (self.latency or 0.0) * (1 + 4 * self.failure) + self.failure
+
+class SearchProvider:
+    name = "provider"
+    kinds = frozenset({"similar", "author"})
+
+    async def search(self, request):
+        """[{"title", "link", "snippet"}] for `request`; raise when the backend fails"""
+        raise NotImplementedError
+
+class DuckDuckGoProvider(SearchProvider):
+    name = "duckduckgo"
+
+    async def search(self, request):
+        return await search.duckduckgo_search(request.query, request.max_results, deadline=request.deadline)
+
+class SearxProvider(SearchProvider):
+    name = "searxng"
+
+    def __init__(self, url=SEARXNG_URL):
+        self.url = url
+        self.host = search.urlsplit(url).netloc
+
+    async def search(self, request):
+        key = "searxng|" + search.cache_key(request.query, request.max_results)
+        if search.SEARCH_CACHE_ENABLED:
+            cached = search.search_cache.get(key)
+            if cached is not search.MISS:
+                return cached
+        await search.rate_limiter.acquire(self.host)
+        response = await search.get_client().get(
+            self.url, params={"q": request.query, "format": "json"},
+            timeout=remaining(request.deadline, search.SEARCH_TIMEOUT),
+        )
+        if response.status_code in search.RETRY_STATUSES:
+            raise search.TransientSearchError(f"HTTP {response.status_code} from {self.host}")
+        response.raise_for_status()
+        results = []
+        seen = set()
+        for item in response.json().get("results", []):
+            if len(results) >= request.max_results:
+                break
+            link = search.decode_link(item.get("url", ""))
+            key_ = search.link_key(link)
+            if link and item.get("title") and key_ not in seen:
+                seen.add(key_)
+                results.append({"title": item["title"], "link": link, "snippet": item.get("content", "")})
+        if search.SEARCH_CACHE_ENABLED and results:
+            search.search_cache.set(key, results)
+        return results
+
+PROVIDER_TYPES = {cls.name: cls for cls in (DuckDuckGoProvider, SearxProvider)}
+
+def merge_results(answers, max_results):
+    """Interleave the providers' hits (best provider first in each round) and drop repeats"""
+    merged = []
+    seen = set()
+    for rank in range(max(map(len, answers), default=0)):
+        for hits in answers:
+            if rank >= len(hits):
+                continue
+            hit = hits[rank]
+            key = search.link_key(hit["link"]) if hit.get("link") else hit.get("title", "").lower()
+            if key in seen:
+                continue
+            seen.add(key)
+            merged.append(hit)
+            if len(merged) >= max_results:
+                return merged
+    return merged
+
+class MultiSearch:
+    def __init__(self, providers, strategy=SEARCH_STRATEGY, fanout=SEARCH_FANOUT, min_results=SEARCH_MIN_RESULTS,
+                 merge_budget=SEARCH_MERGE_BUDGET, probe_rate=SEARCH_PROBE_RATE):
+        self.providers = list(providers)
+        self.strategy = strategy
+        self.fanout = max(1, fanout)
+        self.min_results = min_results
+        self.merge_budget = merge_budget
+        self.probe_rate = probe_rate
+        self.stats = {provider.name: ProviderStats() for provider in self.providers}
+
+    def ranked(self, kind):
+        candidates = [p for p in self.providers if kind in p.kinds]
+        # sorted() is stable, so equal scores keep the configured order
+        ranked = sorted(candidates, key=lambda p: self.stats[p.name].score())
+        if len(ranked) > self.fanout and random.random() < self.probe_rate:
+            # Let a provider outside the fan-out show whether it got better
+            probe = ranked.pop(random.randrange(self.fanout, len(ranked)))
+            ranked.insert(0, probe)
+        return ranked
+
+    async def _call(self, provider, request):
+        started = time.perf_counter()
+        try:
+            results = await provider.search(request)
+        except asyncio.CancelledError:
+            tracing.incr("provider_requests_total", provider=provider.name, outcome="cancelled")
+            raise
+        except Exception:
+            if expired(request.deadline):
+                # The caller's budget ran out, which says nothing about the provider's health
+                tracing.incr("provider_requests_total", provider=provider.name, outcome="deadline")
+            else:
+                self.stats[provider.name].record(failed=True)
+                tracing.incr("provider_requests_total", provider=provider.name, outcome="error")
+            raise
+        elapsed = time.perf_counter() - started
+        self.stats[provider.name].record(elapsed)
+        tracing.incr("provider_requests_total", provider=provider.name, outcome="ok")
+        tracing.observe("provider_latency_seconds", elapsed, provider=provider.name)
+        return results
+
+    async def search(self, request):
+        if expired(request.deadline):
+            raise asyncio.TimeoutError("request deadline passed before searching")
+        providers = self.ranked(request.kind)
+        if not providers:
+            return []
+        if len(providers) == 1:
+            try:
+                results = await self._call(providers[0], request)
+                self._win(providers[0])
+                return results
+            except asyncio.TimeoutError:
+                raise
+            except Exception as e:
+                raise SearchUnavailable({providers[0].name: e}) from e
+        if self.strategy == "merge":
+            return await self._merge(providers, request)
+        return await self._race(providers, request)
+
+    def _win(self, provider):
+        self.stats[provider.name].wins += 1
+        tracing.incr("provider_wins_total", provider=provider.name)
+
+    async def _race(self, providers, request):
+        waiting = list(providers)
+        running = {}
+        errors = {}
+        fallback = None  # best insufficient answer, used if nobody does better
+        try:
+            while waiting or running:
+                while waiting and len(running) < self.fanout and not expired(request.deadline):
+                    provider = waiting.pop(0)
+                    running[asyncio.ensure_future(self._call(provider, request))] = provider
+                if not running:
+                    break
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    provider = running.pop(task)
+                    if task.exception() is not None:
+                        errors[provider.name] = task.exception()
+                        logger.warning("[providers] %s failed for %r: %r", provider.name, request.query, task.exception())
+                        continue
+                    results = task.result()
+                    if len(results) >= min(self.min_results, request.max_results):
+                        self._win(provider)
+                        return results
+                    if fallback is None or len(results) > len(fallback[1]):
+                        fallback = (provider, results)
+        finally:
+            for task in running:
+                task.cancel()
+        if fallback is not None:
+            self._win(fallback[0])
+            return fallback[1]
+        raise _failure(errors)
+
+    async def _merge(self, providers, request):
+        tasks = {asyncio.ensure_future(self._call(p, request)): p for p in providers}
+        budget = remaining(request.deadline, self.merge_budget)
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=budget)
+            if not any(t.exception() is None for t in done) and pending:
+                # Nothing usable within the budget: take whatever answers first, up to the deadline
+                done_more, pending = await asyncio.wait(
+                    pending, timeout=remaining(request.deadline), return_when=asyncio.FIRST_COMPLETED
+                )
+                done |= done_more
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+        answers = []
+        errors = {}
+        # Best-ranked provider first, so its hits lead every round of the interleave
+        for task, provider in tasks.items():
+            if task not in done:
+                continue
+            if task.exception() is not None:
+                errors[provider.name] = task.exception()
+            else:
+                answers.append(task.result())
+                if task.result():
+                    self._win(provider)
+        if not answers:
+            raise _failure(errors)
+        return merge_results(answers, request.max_results)
+
+    def summary(self):
+        return {
+            name: {"latency": s.latency, "failure": round(s.failure, 3), "calls": s.calls, "errors": s.errors, "wins": s.wins}
+            for name, s in self.stats.items()
+        }
+
+def _failure(errors):
+    if not errors or all(isinstance(e, asyncio.TimeoutError) for e in errors.values()):
+        return asyncio.TimeoutError("no search provider answered in time")
+    return SearchUnavailable(errors)
+
+def build_providers(names=SEARCH_PROVIDERS):
+    providers = []
+    for name in (n.strip() for n in names.split(",")):
+        if not name:
+            continue
+        cls = PROVIDER_TYPES.get(name)
+        if cls is None:
+            logger.warning("[providers] Unknown search provider %r, known: %s", name, ", ".join(PROVIDER_TYPES))
+            continue
+        providers.append(cls())
+    return providers
+
+_search = None
+
+def get_search():
+    """The process-wide MultiSearch over SEARCH_PROVIDERS"""
+    global _search
+    if _search is None:
+        _search = MultiSearch(build_providers())
+    return _search
+
+async def search_books(query, kind="similar", title="", max_results=5, deadline=None):
+    """Search across the configured providers; raises asyncio.TimeoutError or SearchUnavailable"""
+    return await get_search().search(SearchRequest(query, kind, title, max_results, deadline))
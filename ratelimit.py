@@ -0,0 +1,62 @@
+import asyncio
+import os
+import time
+
+# Defaults can be tuned per deployment without touching code
+SEARCH_MAX_INFLIGHT = int(os.environ.get("SEARCH_MAX_INFLIGHT", "10"))
+SEARCH_RATE_PER_SEC = float(os.environ.get("SEARCH_RATE_PER_SEC", "5.0"))
+SEARCH_RATE_BURST = int(os.environ.get("SEARCH_RATE_BURST", "10"))
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, at most `burst` stored"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        # The lock keeps waiters in FIFO order so nobody starves
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class HostRateLimiter:
+    """One token bucket per host, created on first use"""
+
+    def __init__(self, rate=SEARCH_RATE_PER_SEC, burst=SEARCH_RATE_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+
+    async def acquire(self, host):
+        if self.rate <= 0:
+            return
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            bucket = self._buckets[host] = TokenBucket(self.rate, self.burst)
+        await bucket.acquire()
+
+
+async def gather_bounded(coros, limit=SEARCH_MAX_INFLIGHT):
+    """Run coroutines concurrently with at most `limit` in flight; results keep input order"""
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*(run(c) for c in coros))
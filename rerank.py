@@ -0,0 +1,105 @@
+import asyncio
+import os
+import re
+import numpy as np
+import llm
+import models
+from prompts import count_tokens
+from asynclog import logger
+
+# How many hits, and roughly how many prompt tokens of them, reach reasoning_node
+PRERANK_TOP_K = int(os.environ.get("PRERANK_TOP_K", "12"))
+PRERANK_TOKEN_BUDGET = int(os.environ.get("PRERANK_TOKEN_BUDGET", "1500"))
+# Cosine similarity above which two hits count as the same page
+DEDUPE_THRESHOLD = float(os.environ.get("PRERANK_DEDUPE_THRESHOLD", "0.92"))
+
+def format_hit(hit):
+    return f"Title: {hit['title']}\nLink: {hit['link']}\nSnippet: {hit['snippet']}\n"
+
+def _normalize(text):
+    return re.sub(r"[^a-z0-9]+", " ", text.lower()).strip()
+
+def _page_subject(title):
+    # "Dune by Frank Herbert | Goodreads" -> "dune by frank herbert"
+    return _normalize(re.split(r"\s[-|–]\s", title, maxsplit=1)[0])
+
+def is_own_book(hit, books):
+    """True when the hit is a page about one of the user's books rather than a recommendation"""
+    subject = _page_subject(hit.get("title", ""))
+    for book in books:
+        title = _normalize(book.get("title", ""))
+        if title and (subject == title or subject.startswith(title + " by ")):
+            return True
+    return False
+
+def _unit_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def select_within_budget(hits, top_k=PRERANK_TOP_K, token_budget=PRERANK_TOKEN_BUDGET):
+    selected = []
+    used = 0
+    for hit in hits:
+        cost = count_tokens(format_hit(hit))
+        if len(selected) >= top_k or (selected and used + cost > token_budget):
+            break
+        selected.append(hit)
+        used += cost
+    return selected
+
+def lexical_prerank(hits, books, top_k=PRERANK_TOP_K, token_budget=PRERANK_TOKEN_BUDGET):
+    """Fallback without embeddings: drop own books and exact duplicates, keep search order"""
+    seen = set()
+    kept = []
+    for hit in hits:
+        key = (hit.get("link") or _normalize(hit.get("title", "")))
+        if key in seen or is_own_book(hit, books):
+            continue
+        seen.add(key)
+        kept.append(hit)
+    return select_within_budget(kept, top_k, token_budget)
+
+async def prerank(hits, books, top_k=PRERANK_TOP_K, token_budget=PRERANK_TOKEN_BUDGET, timeout=None):
+    """Score hits against the input books, collapse near-duplicates and keep the best within budget.
+
+    `timeout` bounds the embedding call (default LLM_TIMEOUT); past it the lexical ranking is used.
+    """
+    candidates = [hit for hit in hits if not is_own_book(hit, books)]
+    if not candidates or not books:
+        return lexical_prerank(candidates, books, top_k, token_budget)
+
+    hit_texts = [f"{h.get('title', '')}. {h.get('snippet', '')}" for h in candidates]
+    book_texts = [f"{b.get('title', '')} by {b.get('author', '')}" for b in books]
+    try:
+        embed_model = models.get("embed")
+        vectors = await llm.embed(
+            embed_model.model, hit_texts + book_texts, timeout=timeout, keep_alive=embed_model.keep_alive
+        )
+    except asyncio.TimeoutError:
+        logger.warning("[prerank] Embedding ran out of time, falling back to lexical pre-ranking")
+        return lexical_prerank(candidates, books, top_k, token_budget)
+    except Exception as e:
+        logger.warning("[prerank] Embedding failed, falling back to lexical pre-ranking: %r", e)
+        return lexical_prerank(candidates, books, top_k, token_budget)
+
+    matrix = _unit_rows(np.asarray(vectors, dtype=np.float32))
+    hit_vecs, book_vecs = matrix[: len(candidates)], matrix[len(candidates):]
+    # Relevance of a hit = similarity to the closest input book
+    scores = (hit_vecs @ book_vecs.T).max(axis=1)
+    order = np.argsort(-scores, kind="stable")
+
+    kept = []
+    seen_links = set()
+    for i in order:
+        link = candidates[i].get("link", "")
+        if link and link in seen_links:
+            continue
+        if kept and float((hit_vecs[kept] @ hit_vecs[i]).max()) >= DEDUPE_THRESHOLD:
+            continue
+        seen_links.add(link)
+        kept.append(int(i))
+        if len(kept) >= top_k:
+            break
+
+    return select_within_budget([candidates[i] for i in kept], top_k, token_budget)
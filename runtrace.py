@@ -0,0 +1,101 @@
+"""What happened during one recommendation run, as typed events instead of accumulated text.
+
+Nodes append small slotted records (NamedTuples) to the `events` channel of the graph state;
+nothing is rendered until the UI or batch output needs text, so checkpoints and streamed updates
+carry a list of short tuples rather than an ever-growing reasoning string. The entry node starts
+each run with RunStarted, which clears the previous run's events from the session's state.
+
+    render(events)      -> the reasoning text shown to users
+    to_records(events)  -> JSON-ready dicts, e.g. for analytics
+"""
+from typing import NamedTuple
+
+class RunStarted(NamedTuple):
+    user_input: str
+
+class NoBooks(NamedTuple):
+    pass
+
+class SearchIssued(NamedTuple):
+    query: str
+
+class HitFound(NamedTuple):
+    query: str
+    title: str
+    link: str
+
+class NoResults(NamedTuple):
+    query: str
+
+class SearchSkipped(NamedTuple):
+    query: str
+
+class NoHits(NamedTuple):
+    pass
+
+class NothingToReason(NamedTuple):
+    pass
+
+class ReasoningStarted(NamedTuple):
+    pass
+
+class BudgetExhausted(NamedTuple):
+    # "before" reasoning (top search hits returned) or "during" it (list may be incomplete)
+    stage: str
+
+class Recommended(NamedTuple):
+    title: str
+    reason: str
+
+class ReasoningFailed(NamedTuple):
+    error: str
+
+EVENT_TYPES = (
+    RunStarted, NoBooks, SearchIssued, HitFound, NoResults, SearchSkipped, NoHits,
+    NothingToReason, ReasoningStarted, BudgetExhausted, Recommended, ReasoningFailed,
+)
+# For the checkpointer's serializer, which only restores types it has been told about
+MSGPACK_TYPES = [(cls.__module__, cls.__name__) for cls in EVENT_TYPES]
+
+def append_events(current, update):
+    """Reducer for the `events` channel: appends, or starts over when a run begins"""
+    if not update:
+        return current or []
+    if isinstance(update[0], RunStarted):
+        return list(update)
+    return (current or []) + list(update)
+
+def _line(event):
+    kind = type(event)
+    if kind is SearchIssued:
+        return f"Searching with query: {event.query}"
+    if kind is HitFound:
+        return f"✅ Found: {event.title} ({event.link})"
+    if kind is NoResults:
+        return f"No results found for: {event.query}"
+    if kind is SearchSkipped:
+        return f"⚠️ Search did not complete in time, skipped: {event.query}"
+    if kind is NoBooks:
+        return "No books extracted from the input. Check if the extraction failed."
+    if kind is NoHits:
+        return "No recommendations found across all queries."
+    if kind is NothingToReason:
+        return "No recommendations found to reason about."
+    if kind is ReasoningStarted:
+        return "\nFinal reasoning:"
+    if kind is BudgetExhausted:
+        if event.stage == "before":
+            return "⏱️ Time budget ran out before reasoning; these are the top search hits."
+        return "⏱️ Time budget ran out during reasoning; the list may be incomplete."
+    if kind is Recommended:
+        return f"✅ Recommended: {event.title} - {event.reason or 'No reason provided.'}"
+    if kind is ReasoningFailed:
+        return f"Error in reasoning node: {event.error}"
+    return None
+
+def render(events):
+    """The run's reasoning log as text, built once at the output boundary"""
+    return "\n".join(line for line in map(_line, events or []) if line is not None)
+
+def to_records(events):
+    return [{"event": type(event).__name__, **event._asdict()} for event in events or []]
@@ -1,24 +1,340 @@
 # search.py (modify to accept logger)
-import httpx
-from selectolax.parser import HTMLParser
+import asyncio
+import html
+import os
+import random
+import re
+import time
+from collections import deque
+from urllib.parse import parse_qs, parse_qsl, urlencode, urlsplit, urlunsplit
+from lazyimport import lazy_import
+from ratelimit import HostRateLimiter
+from cache import TwoTierCache, CACHE_DIR, MISS
+import tracing
+from asynclog import logger
+from singleflight import SingleFlight
+from deadline import remaining
 
-async def duckduckgo_search(query, max_results=5, logger=None):
-    url = f"https://html.duckduckgo.com/html/?q={query}"
-    headers = {"User-Agent": "Mozilla/5.0"}
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, headers=headers, timeout=10)
+# Loaded on first use, importing this module stays cheap for a fast cold start
+httpx = lazy_import("httpx")
 
-    html = HTMLParser(response.text)
+# Point at another DuckDuckGo-compatible HTML endpoint, e.g. the fake server in bench/
+SEARCH_URL = os.environ.get("SEARCH_URL", "https://html.duckduckgo.com/html/")
+SEARCH_HOST = urlsplit(SEARCH_URL).netloc
+
+# Connection pool tuning, see httpx.Limits
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(os.environ.get("HTTP_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP2_ENABLED = os.environ.get("HTTP2_ENABLED", "0") == "1"
+
+# Seconds per HTTP attempt; a caller's deadline can cut it shorter
+SEARCH_TIMEOUT = float(os.environ.get("SEARCH_TIMEOUT", "10"))
+# Extra attempts after a connection error, timeout or 429/5xx, with full-jitter exponential backoff
+SEARCH_RETRIES = int(os.environ.get("SEARCH_RETRIES", "2"))
+SEARCH_BACKOFF_BASE = float(os.environ.get("SEARCH_BACKOFF_BASE", "0.25"))
+SEARCH_BACKOFF_MAX = float(os.environ.get("SEARCH_BACKOFF_MAX", "2.0"))
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Hedging: when a search is slower than the recent p95, send a duplicate and take whichever answers first
+SEARCH_HEDGE_ENABLED = os.environ.get("SEARCH_HEDGE_ENABLED", "0") == "1"
+SEARCH_HEDGE_PERCENTILE = float(os.environ.get("SEARCH_HEDGE_PERCENTILE", "95"))
+# Used until enough latencies are recorded, and as the lower bound afterwards
+SEARCH_HEDGE_DELAY = float(os.environ.get("SEARCH_HEDGE_DELAY", "1.0"))
+SEARCH_HEDGE_MIN_DELAY = float(os.environ.get("SEARCH_HEDGE_MIN_DELAY", "0.05"))
+
+# Scan result blocks with a few regexes and stop at max_results; 0 = parse the whole page as a DOM
+SEARCH_LEAN_PARSE = os.environ.get("SEARCH_LEAN_PARSE", "1") == "1"
+_RESULT_START = re.compile(r'<div class="result[ "]')
+_TITLE = re.compile(r'<a[^>]*class="result__a"[^>]*href="([^"]*)"[^>]*>(.*?)</a>', re.S)
+_SNIPPET = re.compile(r'class="result__snippet"[^>]*>(.*?)</(?:a|div|td)>', re.S)
+_TAG = re.compile(r"<[^>]+>")
+_TRACKING_PARAMS = {"fbclid", "gclid", "msclkid", "ref", "ref_src"}
+
+# Result cache, set SEARCH_CACHE_ENABLED=0 to always go to the network
+SEARCH_CACHE_ENABLED = os.environ.get("SEARCH_CACHE_ENABLED", "1") == "1"
+SEARCH_CACHE_TTL = float(os.environ.get("SEARCH_CACHE_TTL", str(24 * 3600)))
+
+# Shared across all sessions so concurrent users can't exceed the per-host rate together
+rate_limiter = HostRateLimiter()
+# Identical queries in flight at the same time go out once
+search_flight = SingleFlight("search")
+
+_client = None
+_client_loop = None
+
+class TransientSearchError(Exception):
+    """A response worth retrying (throttled or server error)"""
+
+class LatencyTracker:
+    """Latencies of the last `window` successful searches, for the hedging delay"""
+
+    def __init__(self, window=200, min_samples=20):
+        self.samples = deque(maxlen=window)
+        self.min_samples = min_samples
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+
+    def percentile(self, p, default):
+        if len(self.samples) < self.min_samples:
+            return default
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+search_latency = LatencyTracker()
+
+search_cache = TwoTierCache(
+    os.path.join(CACHE_DIR, "search.sqlite3"),
+    table="search_results",
+    max_memory_entries=int(os.environ.get("SEARCH_CACHE_MEMORY_ENTRIES", "2048")),
+    max_disk_entries=int(os.environ.get("SEARCH_CACHE_DISK_ENTRIES", "100000")),
+    ttl=SEARCH_CACHE_TTL,
+)
+
+def _h2_available():
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def create_client(transport=None):
+    """Build a pooled AsyncClient; pass `transport` to route requests somewhere other than the network"""
+    http2 = HTTP2_ENABLED and _h2_available()
+    if HTTP2_ENABLED and not http2:
+        logger.warning("[search] HTTP/2 requested but the 'h2' package is not installed, using HTTP/1.1")
+    return httpx.AsyncClient(
+        headers={"User-Agent": "Mozilla/5.0"},
+        timeout=SEARCH_TIMEOUT,
+        http2=http2,
+        transport=transport,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+def get_client():
+    """Return the process-wide client, creating it on first use"""
+    global _client, _client_loop
+    if _client is None or _client.is_closed:
+        _client = create_client()
+        _client_loop = asyncio.get_running_loop()
+    return _client
+
+def set_client(client):
+    """Swap in another client (e.g. one built with httpx.MockTransport in tests)"""
+    global _client, _client_loop
+    _client = client
+    _client_loop = None
+
+async def close_client():
+    global _client
+    client, _client = _client, None
+    if client is not None and not client.is_closed:
+        await client.aclose()
+
+def shutdown_client(timeout=5):
+    """Close the shared client from synchronous code, e.g. after demo.launch() returns"""
+    loop = _client_loop
+    if _client is None:
+        return
+    try:
+        if loop is not None and loop.is_running():
+            # Connections belong to the loop that opened them, so close them there
+            asyncio.run_coroutine_threadsafe(close_client(), loop).result(timeout)
+        else:
+            asyncio.run(close_client())
+    except Exception as e:
+        logger.warning("[search] Error while closing HTTP client: %r", e)
+
+def cache_key(query, max_results):
+    # Case and whitespace differences should not produce separate entries
+    normalized = re.sub(r"\s+", " ", query).strip().lower()
+    return f"{normalized}|{max_results}"
+
+def purge_cache():
+    search_cache.purge()
+
+async def duckduckgo_search(query, max_results=5, logger=None, use_cache=True, deadline=None):
+    """Search results for `query`, from the cache or the network.
+
+    Raises asyncio.TimeoutError once `deadline` (see deadline.py) passes; cached results are
+    returned even after it. Transient failures are retried inside the shared fetch.
+    """
+    use_cache = use_cache and SEARCH_CACHE_ENABLED
+    key = cache_key(query, max_results)
+    with tracing.span("search", query=query) as span:
+        if use_cache:
+            cached = search_cache.get(key)
+            if cached is not MISS:
+                tracing.incr("search_requests_total", cache="hit")
+                span.set(cached=True, hits=len(cached))
+                return cached
+
+        tracing.incr("search_requests_total", cache="miss" if use_cache else "bypass")
+        timeout = remaining(deadline)
+        if timeout is not None and timeout <= 0:
+            tracing.incr("search_deadline_exceeded_total")
+            span.set(deadline_exceeded=True)
+            raise asyncio.TimeoutError(f"no time left to search for {query!r}")
+        try:
+            # Coalesced callers share the fetch but each stops waiting at its own deadline
+            results = await asyncio.wait_for(
+                search_flight.do(key, lambda: fetch_and_store(key, query, max_results, use_cache)), timeout
+            )
+        except asyncio.TimeoutError:
+            tracing.incr("search_deadline_exceeded_total")
+            span.set(deadline_exceeded=True)
+            raise
+        span.set(cached=False, hits=len(results))
+        return results
+
+async def fetch_and_store(key, query, max_results, use_cache):
+    results = await fetch_with_retries(query, max_results)
+    # Empty pages are often throttling responses, don't pin them in the cache
+    if use_cache and results:
+        search_cache.set(key, results)
+    return results
+
+def backoff_delay(attempt):
+    # Full jitter: spreads out retries from many sessions that failed at the same moment
+    return random.uniform(0, min(SEARCH_BACKOFF_MAX, SEARCH_BACKOFF_BASE * 2 ** attempt))
+
+async def fetch_with_retries(query, max_results=5):
+    for attempt in range(SEARCH_RETRIES + 1):
+        try:
+            return await fetch_hedged(query, max_results)
+        except (httpx.TransportError, TransientSearchError) as e:
+            if attempt == SEARCH_RETRIES:
+                raise
+            delay = backoff_delay(attempt)
+            tracing.incr("search_retries_total")
+            logger.warning("[search] %r for %r, retry %d in %.2fs", e, query, attempt + 1, delay)
+            await asyncio.sleep(delay)
+
+async def fetch_hedged(query, max_results=5):
+    if not SEARCH_HEDGE_ENABLED:
+        return await fetch_results(query, max_results)
+    delay = max(SEARCH_HEDGE_MIN_DELAY, search_latency.percentile(SEARCH_HEDGE_PERCENTILE, SEARCH_HEDGE_DELAY))
+    primary = asyncio.ensure_future(fetch_results(query, max_results))
+    pending = {primary}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if done:
+            return primary.result()
+        logger.debug("[search] No answer for %r after %.2fs, sending a hedged request", query, delay)
+        hedge = asyncio.ensure_future(fetch_results(query, max_results))
+        pending.add(hedge)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    tracing.incr("search_hedges_total", winner="hedge" if task is hedge else "primary")
+                    return task.result()
+                error = task.exception()
+        tracing.incr("search_hedges_total", winner="none")
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def fetch_results(query, max_results=5):
+    await rate_limiter.acquire(SEARCH_HOST)
+    started = time.perf_counter()
+    response = await get_client().get(SEARCH_URL, params={"q": query})
+    if response.status_code in RETRY_STATUSES:
+        raise TransientSearchError(f"HTTP {response.status_code} from {SEARCH_HOST}")
+    search_latency.record(time.perf_counter() - started)
+
+    return parse_results(response.text, max_results)
+
+def parse_results(page, max_results=5):
+    """The first `max_results` distinct hits on a results page, with real target links"""
+    if SEARCH_LEAN_PARSE:
+        results = parse_results_lean(page, max_results)
+        # Nothing found on a non-empty page: maybe the markup changed, let the DOM parser try
+        if results or "result__a" not in page:
+            return results
+    return parse_results_dom(page, max_results)
+
+def parse_results_lean(page, max_results=5):
+    """Scan result blocks one at a time and stop as soon as `max_results` usable hits are found"""
     results = []
+    seen = set()
+    starts = _RESULT_START.finditer(page)
+    match = next(starts, None)
+    while match is not None and len(results) < max_results:
+        following = next(starts, None)
+        block = page[match.start():following.start() if following else len(page)]
+        match = following
+        if "result--ad" in block[:200]:
+            continue
+        title = _TITLE.search(block)
+        snippet = _SNIPPET.search(block)
+        if not title or not snippet:
+            continue
+        _add_result(results, seen, title.group(1), _text(title.group(2)), _text(snippet.group(1)))
+    return results
 
-    for result in html.css("div.result")[:max_results]:
+def parse_results_dom(page, max_results=5):
+    """Full DOM parse, the fallback for markup the lean scanner doesn't recognise"""
+    results = []
+    seen = set()
+    from selectolax.parser import HTMLParser
+    for result in HTMLParser(page).css("div.result"):
+        if len(results) >= max_results:
+            break
+        if "result--ad" in result.attributes.get("class", ""):
+            continue
         title_el = result.css_first("a.result__a")
         snippet_el = result.css_first(".result__snippet")
-
         if title_el and snippet_el:
-            title = title_el.text(strip=True)
-            link = title_el.attributes.get("href", "")
-            snippet = snippet_el.text(strip=True)
-            results.append({"title": title, "link": link, "snippet": snippet})
-
+            _add_result(
+                results, seen, title_el.attributes.get("href", ""),
+                " ".join(title_el.text().split()), " ".join(snippet_el.text().split()),
+            )
     return results
+
+def _add_result(results, seen, href, title, snippet):
+    link = decode_link(href)
+    key = link_key(link)
+    if not link or key in seen:
+        return
+    seen.add(key)
+    results.append({"title": title, "link": link, "snippet": snippet})
+
+def _text(fragment):
+    # Tags out, entities decoded, whitespace collapsed: "loved <b>Dune</b>" -> "loved Dune"
+    return " ".join(html.unescape(_TAG.sub("", fragment)).split())
+
+def decode_link(href):
+    """The target URL of a DuckDuckGo redirect link (//duckduckgo.com/l/?uddg=...), normalized"""
+    href = html.unescape(href or "").strip()
+    if href.startswith("//"):
+        href = "https:" + href
+    parts = urlsplit(href)
+    if parts.netloc.endswith("duckduckgo.com") and parts.path.startswith("/l/"):
+        target = parse_qs(parts.query).get("uddg")
+        if not target:
+            return ""
+        href = target[0]
+        parts = urlsplit(href)
+    if parts.scheme not in ("http", "https") or not parts.netloc:
+        return ""
+    # Tracking parameters and fragments don't change the page
+    query = urlencode([(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not _is_tracking(k)])
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or "/", query, ""))
+
+def link_key(link):
+    """What makes two links the same page: scheme, "www." and a trailing slash don't"""
+    parts = urlsplit(link)
+    host = parts.netloc.removeprefix("www.")
+    return f"{host}{parts.path.rstrip('/')}?{parts.query}"
+
+def _is_tracking(name):
+    name = name.lower()
+    return name.startswith("utm_") or name in _TRACKING_PARAMS
@@ -0,0 +1,90 @@
+import os
+import uuid
+from collections import OrderedDict
+from langgraph.checkpoint.memory import InMemorySaver
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+from runtrace import MSGPACK_TYPES
+
+# Sessions whose graph state is kept between submissions; the least recently used go first
+SESSION_MAX = int(os.environ.get("SESSION_MAX", "256"))
+# Checkpoints kept per session, only the latest is needed to resume
+SESSION_KEEP_CHECKPOINTS = int(os.environ.get("SESSION_KEEP_CHECKPOINTS", "2"))
+
+class SessionSaver(InMemorySaver):
+    """InMemorySaver bounded for a long-running server.
+
+    Keeps the state of the `max_sessions` most recently active threads and only the last
+    `keep_checkpoints` checkpoints of each, so memory doesn't grow with uptime or resubmissions.
+    """
+
+    def __init__(self, max_sessions=SESSION_MAX, keep_checkpoints=SESSION_KEEP_CHECKPOINTS):
+        # The run's event records are restored as their own types rather than plain lists
+        super().__init__(serde=JsonPlusSerializer(allowed_msgpack_modules=MSGPACK_TYPES))
+        self.max_sessions = max_sessions
+        self.keep_checkpoints = max(1, keep_checkpoints)
+        self._sessions = OrderedDict()  # thread_id -> {"blobs": set(), "writes": set()}
+
+    def _track(self, thread_id):
+        entry = self._sessions.get(thread_id)
+        if entry is None:
+            entry = self._sessions[thread_id] = {"blobs": set(), "writes": set()}
+        self._sessions.move_to_end(thread_id)
+        return entry
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        result = super().put(config, checkpoint, metadata, new_versions)
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        entry = self._track(thread_id)
+        entry["blobs"].update((thread_id, checkpoint_ns, k, v) for k, v in new_versions.items())
+        self._prune(thread_id, checkpoint_ns, entry)
+        while len(self._sessions) > self.max_sessions:
+            self.delete_thread(next(iter(self._sessions)))
+        return result
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        super().put_writes(config, writes, task_id, task_path)
+        configurable = config["configurable"]
+        key = (configurable["thread_id"], configurable.get("checkpoint_ns", ""), configurable["checkpoint_id"])
+        self._track(configurable["thread_id"])["writes"].add(key)
+
+    def _prune(self, thread_id, checkpoint_ns, entry):
+        checkpoints = self.storage[thread_id][checkpoint_ns]
+        if len(checkpoints) <= self.keep_checkpoints:
+            return
+        # Checkpoint ids are time-ordered, like get_tuple's max() relies on
+        for checkpoint_id in sorted(checkpoints)[:-self.keep_checkpoints]:
+            del checkpoints[checkpoint_id]
+            key = (thread_id, checkpoint_ns, checkpoint_id)
+            self.writes.pop(key, None)
+            entry["writes"].discard(key)
+
+        # Blobs hold the channel values; drop the versions no remaining checkpoint points at
+        live = set()
+        for saved, _, _ in checkpoints.values():
+            versions = self.serde.loads_typed(saved)["channel_versions"]
+            live.update((thread_id, checkpoint_ns, k, v) for k, v in versions.items())
+        for key in [k for k in entry["blobs"] if k[1] == checkpoint_ns and k not in live]:
+            self.blobs.pop(key, None)
+            entry["blobs"].discard(key)
+
+    def delete_thread(self, thread_id):
+        entry = self._sessions.pop(thread_id, None)
+        if entry is None:
+            super().delete_thread(thread_id)
+            return
+        # Same as the base class without scanning every session's keys
+        self.storage.pop(thread_id, None)
+        for key in entry["writes"]:
+            self.writes.pop(key, None)
+        for key in entry["blobs"]:
+            self.blobs.pop(key, None)
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+def session_config(session_id, config=None):
+    """Add the checkpointer's thread_id for `session_id` to a graph config"""
+    config = dict(config or {})
+    config["configurable"] = {**config.get("configurable", {}), "thread_id": session_id}
+    return config
@@ -0,0 +1,142 @@
+import asyncio
+import os
+from contextlib import aclosing
+import tracing
+
+# Set COALESCE_REQUESTS=0 to give every caller its own request again
+COALESCE_ENABLED = os.environ.get("COALESCE_REQUESTS", "1") == "1"
+
+class _Broadcast:
+    """Items of one shared stream, kept so late subscribers can replay them from the start"""
+
+    __slots__ = ("items", "done", "error", "changed", "subscribers", "task")
+
+    def __init__(self):
+        self.items = []
+        self.done = False
+        self.error = None
+        self.changed = asyncio.Event()
+        self.subscribers = 0
+        self.task = None
+
+class SingleFlight:
+    """Coalesce concurrent identical calls: the first caller for a key runs the work in a shared
+    task, later callers with the same key await that task instead of starting their own.
+
+    Results are shared as-is, so callers must not mutate them. Errors reach every waiter and are
+    not remembered, the next call after a failure starts fresh. A waiter that is cancelled (or
+    times out) only stops waiting; the shared work is cancelled once nobody waits for it anymore.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.leaders = 0
+        self.coalesced = 0
+        self._calls = {}    # key -> (task, [waiter count])
+        self._streams = {}  # key -> _Broadcast
+
+    def _count(self, leader):
+        if leader:
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+        tracing.incr("singleflight_calls_total", group=self.name, role="leader" if leader else "coalesced")
+
+    async def do(self, key, fn):
+        """Return `await fn()`, sharing one call among everyone asking for `key` at the same time"""
+        if not COALESCE_ENABLED:
+            return await fn()
+        loop = asyncio.get_running_loop()
+        entry = self._calls.get(key)
+        # Tasks belong to one event loop, a call in flight on another loop can't be joined
+        if entry is None or entry[0].get_loop() is not loop:
+            task = loop.create_task(fn())
+            entry = self._calls[key] = (task, [0])
+            task.add_done_callback(lambda t: self._forget(self._calls, key, t))
+            self._count(leader=True)
+        else:
+            self._count(leader=False)
+
+        task, waiters = entry
+        waiters[0] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if waiters[0] == 1 and not task.done():
+                # Last one out: drop the work, and don't let a new caller join a dying task
+                task.cancel()
+                self._forget(self._calls, key, task)
+            raise
+        finally:
+            waiters[0] -= 1
+
+    async def stream(self, key, fn):
+        """Async-iterate `fn()` (an async generator factory), sharing one stream per `key`.
+
+        Subscribers that join late first get the items produced so far, then follow live.
+        """
+        if not COALESCE_ENABLED:
+            async with aclosing(fn()) as items:
+                async for item in items:
+                    yield item
+            return
+        loop = asyncio.get_running_loop()
+        broadcast = self._streams.get(key)
+        if broadcast is None or broadcast.task.get_loop() is not loop:
+            broadcast = self._streams[key] = _Broadcast()
+            broadcast.task = loop.create_task(self._pump(broadcast, fn))
+            broadcast.task.add_done_callback(lambda t: self._forget(self._streams, key, broadcast))
+            self._count(leader=True)
+        else:
+            self._count(leader=False)
+
+        broadcast.subscribers += 1
+        try:
+            position = 0
+            while True:
+                if position < len(broadcast.items):
+                    position += 1
+                    yield broadcast.items[position - 1]
+                    continue
+                if broadcast.done:
+                    if broadcast.error is not None:
+                        raise broadcast.error
+                    return
+                broadcast.changed.clear()
+                await broadcast.changed.wait()
+        finally:
+            broadcast.subscribers -= 1
+            if broadcast.subscribers == 0 and not broadcast.done:
+                broadcast.task.cancel()
+                self._forget(self._streams, key, broadcast)
+
+    async def _pump(self, broadcast, fn):
+        try:
+            # aclosing: a cancelled stream must still run its cleanup (e.g. free the model slot)
+            async with aclosing(fn()) as items:
+                async for item in items:
+                    broadcast.items.append(item)
+                    broadcast.changed.set()
+        except asyncio.CancelledError:
+            broadcast.error = asyncio.CancelledError()
+            raise
+        except Exception as e:
+            broadcast.error = e
+        finally:
+            broadcast.done = True
+            broadcast.changed.set()
+
+    @staticmethod
+    def _forget(calls, key, value):
+        entry = calls.get(key)
+        if entry is value or (isinstance(entry, tuple) and entry[0] is value):
+            del calls[key]
+
+    def stats(self):
+        total = self.leaders + self.coalesced
+        return {
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._calls) + len(self._streams),
+            "coalesce_rate": self.coalesced / total if total else 0.0,
+        }
@@ -0,0 +1,123 @@
+"""Cold start: compile the graph and warm models and the search stack in the background.
+
+`python app.py` calls start() before it imports gradio, so graph compilation, the model loads
+on the Ollama server and the search client's imports and DNS lookup overlap with UI startup
+instead of following it. Until every step is done (graph, models, search, ui) the readiness
+server answers
+
+    GET http://<host>:READY_PORT/ready     503 {"ready": false, "steps": {...}}, then 200
+    GET http://<host>:READY_PORT/healthz   200 as soon as the process is up
+
+so a load balancer only routes to replicas that are warm. A step that fails (e.g. the model
+server is down) still counts as done, with its error in the /ready body; the first requests
+then pay for it as they did before.
+"""
+import asyncio
+import json
+import os
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+from asynclog import logger
+
+READY_PORT = int(os.environ.get("READY_PORT", "7861"))
+# Load balancers check from outside, so this listens on all interfaces unlike /metrics
+READY_HOST = os.environ.get("READY_HOST", "0.0.0.0")
+STEPS = ("graph", "models", "search", "ui")
+
+_started = time.perf_counter()
+_lock = threading.Lock()
+_done = {}    # step -> seconds after start
+_errors = {}  # step -> repr of the exception
+_graph = None
+_graph_lock = threading.Lock()
+_server = None
+_warm_up_thread = None
+
+def mark_done(step, error=None):
+    with _lock:
+        _done[step] = round(time.perf_counter() - _started, 3)
+        if error is not None:
+            _errors[step] = repr(error)
+    logger.info("[startup] %s ready after %.2fs%s", step, _done[step], f" ({error!r})" if error else "")
+    if is_ready():
+        logger.info("[startup] Ready after %.2fs", time.perf_counter() - _started)
+
+def is_ready():
+    return all(step in _done for step in STEPS)
+
+def status():
+    with _lock:
+        return {"ready": is_ready(), "steps": {step: _done.get(step) for step in STEPS}, "errors": dict(_errors)}
+
+def get_graph():
+    """The app's graph, compiled on first use (by the warm-up thread when start() was called)"""
+    global _graph
+    if _graph is None:
+        with _graph_lock:
+            if _graph is None:
+                from agents import build_graph
+                from sessions import SessionSaver
+                # Checkpointed per browser session, so resubmissions only redo what changed
+                _graph = build_graph(checkpointer=SessionSaver())
+    return _graph
+
+def _warm_search():
+    import search
+    # Import the HTTP stack and the fallback parser now, and resolve the host so the first
+    # request doesn't wait on DNS; connections belong to the serving loop and open there
+    search.httpx.AsyncClient
+    from selectolax.parser import HTMLParser  # noqa: F401
+    parts = urlsplit(search.SEARCH_URL)
+    socket.getaddrinfo(parts.hostname, parts.port or (443 if parts.scheme == "https" else 80))
+
+def _warm_models():
+    import models
+    if models.WARM_UP_ENABLED:
+        # Own loop and client, the serving loop isn't running yet
+        asyncio.run(models.warm_up())
+
+def _warm_up():
+    for step, fn in (("graph", get_graph), ("search", _warm_search), ("models", _warm_models)):
+        try:
+            fn()
+        except Exception as e:
+            logger.warning("[startup] Warming up %s failed: %r", step, e)
+            mark_done(step, e)
+        else:
+            mark_done(step)
+
+class _ReadyHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/healthz":
+            code, body = 200, {"alive": True}
+        elif path == "/ready":
+            body = status()
+            code = 200 if body["ready"] else 503
+        else:
+            self.send_error(404)
+            return
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+def start(port=READY_PORT, host=READY_HOST):
+    """Serve /ready and /healthz and start warming up, both from daemon threads; idempotent"""
+    global _server, _warm_up_thread
+    if _server is None and port:
+        _server = ThreadingHTTPServer((host, port), _ReadyHandler)
+        threading.Thread(target=_server.serve_forever, name="readiness", daemon=True).start()
+        logger.info("[startup] Readiness on http://%s:%d/ready", host, port)
+    if _warm_up_thread is None:
+        _warm_up_thread = threading.Thread(target=_warm_up, name="warm-up", daemon=True)
+        _warm_up_thread.start()
+    return _warm_up_thread
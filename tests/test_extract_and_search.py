@@ -0,0 +1,53 @@
+import asyncio
+import agents
+
+REPLY = (
+    '[{"title": "", "author": "Nobody"}, '
+    '{"title": "Dune", "author": "Frank Herbert"}, '
+    '{"title": "Emma", "author": "Jane Austen"}]'
+)
+
+def test_rejected_items_do_not_redispatch_books(monkeypatch):
+    async def stream_chat(**kwargs):
+        for i in range(0, len(REPLY), 7):
+            yield {"message": {"content": REPLY[i:i + 7]}}
+
+    searched = []
+
+    async def search_similar(book, deadline=None):
+        searched.append(book["title"])
+        return f"Books similar to '{book['title']}'", []
+
+    monkeypatch.setattr(agents.llm, "stream_chat", stream_chat)
+    monkeypatch.setattr(agents, "search_similar", search_similar)
+
+    update = asyncio.run(agents.extract_and_search_node({"user_input": "I liked Dune and Emma"}))
+
+    assert searched == ["Dune", "Emma"]
+    assert [book["title"] for book in update["extracted_books"]] == ["Dune", "Emma"]
+
+def test_books_after_a_scalar_array_are_all_searched(monkeypatch):
+    # The scalar array is dropped mid-chunk for the real one, whose first book closes in the same chunk
+    chunks = [
+        'Found [2, ',
+        '3] books: [{"title": "Dune", "author": "Frank Herbert"}, {"ti',
+        'tle": "Emma", "author": "Jane Austen"}]',
+    ]
+
+    async def stream_chat(**kwargs):
+        for chunk in chunks:
+            yield {"message": {"content": chunk}}
+
+    searched = []
+
+    async def search_similar(book, deadline=None):
+        searched.append(book["title"])
+        return f"Books similar to '{book['title']}'", []
+
+    monkeypatch.setattr(agents.llm, "stream_chat", stream_chat)
+    monkeypatch.setattr(agents, "search_similar", search_similar)
+
+    update = asyncio.run(agents.extract_and_search_node({"user_input": "I liked Dune and Emma"}))
+
+    assert searched == ["Dune", "Emma"]
+    assert [book["title"] for book in update["extracted_books"]] == ["Dune", "Emma"]
@@ -0,0 +1,25 @@
+import asyncio
+import agents
+
+REPLY = '[{"title": "Dune", "author": "Frank Herbert"}]'
+
+def test_timed_out_extraction_is_not_reused(monkeypatch):
+    calls = []
+
+    async def chat(**kwargs):
+        user_input = kwargs["messages"][-1]["content"]
+        calls.append(user_input)
+        if "Emma" in user_input:
+            raise asyncio.TimeoutError()
+        return {"message": {"content": REPLY}}
+
+    monkeypatch.setattr(agents.llm, "chat", chat)
+
+    # The session checkpoint: each run starts from the state the previous one left behind
+    state = {}
+    for user_input in ("I liked Dune", "I liked Emma", "I liked Dune"):
+        state.update({"user_input": user_input})
+        state.update(asyncio.run(agents.extract_books_node(state)))
+
+    assert len(calls) == 3
+    assert [book["title"] for book in state["extracted_books"]] == ["Dune"]
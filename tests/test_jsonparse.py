@@ -0,0 +1,22 @@
+from jsonparse import ArrayScanner
+
+def feed_all(scanner, chunks):
+    items = []
+    for chunk in chunks:
+        items.extend(scanner.feed(chunk))
+    return items
+
+def test_feed_returns_real_array_items_after_a_scalar_array():
+    chunks = ['Found [2, ', '3] books: [{"title": "Dune"}, {"ti', 'tle": "Emma"}]']
+    scanner = ArrayScanner()
+
+    # 2 closes before the scanner knows a real array follows, so only the objects are checked
+    assert [i for i in feed_all(scanner, chunks) if isinstance(i, dict)] == [{"title": "Dune"}, {"title": "Emma"}]
+    assert scanner.finish() == [{"title": "Dune"}, {"title": "Emma"}]
+
+def test_feed_returns_each_item_once_in_any_chunking():
+    reply = 'Sure: [1] and [{"title": "Dune"}, {"title": "Emma"}, {"title": "Ubik"}]'
+    for size in range(1, len(reply) + 1):
+        chunks = [reply[i:i + size] for i in range(0, len(reply), size)]
+        items = feed_all(ArrayScanner(), chunks)
+        assert [i for i in items if isinstance(i, dict)] == [{"title": "Dune"}, {"title": "Emma"}, {"title": "Ubik"}]
@@ -0,0 +1,244 @@
+"""Latency spans and Prometheus-style metrics for the recommender pipeline.
+
+Enable with TRACE_ENABLED=1. Finished spans are appended to TRACE_FILE as JSONL, and counters,
+gauges and histograms are served in Prometheus text format on METRICS_PORT (/metrics) once
+start_metrics_server() has been called. When disabled, span() hands back a shared no-op
+object and the counters return immediately, so instrumented code pays one flag check.
+"""
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from asynclog import logger
+
+TRACE_ENABLED = os.environ.get("TRACE_ENABLED", "0") == "1"
+TRACE_FILE = os.environ.get("TRACE_FILE", "traces.jsonl")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9464"))
+
+# Seconds; wide enough for both cache hits and full llama3 generations
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_trace_id = contextvars.ContextVar("trace_id", default=None)
+_parent_span = contextvars.ContextVar("parent_span", default=None)
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_gauges = {}      # (name, labels) -> current value
+_histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+_trace_file = None
+
+def enabled():
+    return TRACE_ENABLED
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+def incr(name, value=1, **labels):
+    if not TRACE_ENABLED:
+        return
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def set_gauge(name, value, **labels):
+    if not TRACE_ENABLED:
+        return
+    with _lock:
+        _gauges[(name, _labels(labels))] = value
+
+def counter_total(name, **labels):
+    """Sum of counter `name` over every label set that includes `labels`"""
+    wanted = set(_labels(labels))
+    with _lock:
+        return sum(v for (n, l), v in _counters.items() if n == name and wanted <= set(l))
+
+def observe(name, value, **labels):
+    if not TRACE_ENABLED:
+        return
+    key = (name, _labels(labels))
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                hist[i] += 1
+                break
+        hist[-2] += value
+        hist[-1] += 1
+
+def _export(record):
+    global _trace_file
+    line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+    with _lock:
+        if _trace_file is None:
+            _trace_file = open(TRACE_FILE, "a", encoding="utf-8")
+        _trace_file.write(line)
+
+def flush():
+    with _lock:
+        if _trace_file is not None:
+            _trace_file.flush()
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+_NOOP = _NoopSpan()
+
+class Span:
+    __slots__ = ("name", "attrs", "span_id", "parent_id", "trace_id", "detached", "_start", "_wall", "_token")
+
+    def __init__(self, name, attrs, detached=False, trace_id=None):
+        self.name = name
+        self.attrs = attrs
+        self.detached = detached
+        self.trace_id = trace_id
+        self._token = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.trace_id = self.trace_id or _trace_id.get()
+        self.parent_id = _parent_span.get()
+        self.span_id = uuid.uuid4().hex[:16]
+        # Detached spans (streams, async generators) don't become the parent of what runs meanwhile
+        if not self.detached:
+            self._token = _parent_span.set(self.span_id)
+        self._wall = time.time()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self._start
+        if self._token is not None:
+            _parent_span.reset(self._token)
+        status = "error" if exc_type is not None else "ok"
+        observe("span_duration_seconds", duration, span=self.name)
+        if exc_type is not None:
+            incr("span_errors_total", span=self.name)
+        _export({
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self._wall,
+            "duration_ms": round(duration * 1000, 3),
+            "status": status,
+            **self.attrs,
+        })
+        if self.parent_id is None:
+            # End of a request's root span: make sure the whole trace reaches the file
+            flush()
+        return False
+
+def span(name, detached=False, trace_id=None, **attrs):
+    """Time a block: `with span("search", query=q) as s: ...; s.set(hits=3)`"""
+    if not TRACE_ENABLED:
+        return _NOOP
+    return Span(name, attrs, detached, trace_id)
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+def graph_config(root):
+    """LangGraph config carrying the request's trace context into the nodes.
+
+    Node tasks may not share the caller's context (Gradio drives the handler step by step),
+    so the ids travel through the config and traced_node restores them.
+    """
+    if not isinstance(root, Span):
+        return {}
+    return {"configurable": {"trace_id": root.trace_id, "parent_span": root.span_id}}
+
+def traced_node(name, fn):
+    """Wrap an async graph node so every invocation is recorded as a `node.<name>` span"""
+    # No functools.wraps: LangGraph inspects the signature to decide whether to pass `config`
+    async def wrapper(state, config=None):
+        if not TRACE_ENABLED:
+            return await fn(state)
+        configurable = (config or {}).get("configurable", {})
+        trace_token = _trace_id.set(configurable.get("trace_id"))
+        parent_token = _parent_span.set(configurable.get("parent_span"))
+        try:
+            with Span(f"node.{name}", {}):
+                return await fn(state)
+        finally:
+            _parent_span.reset(parent_token)
+            _trace_id.reset(trace_token)
+    wrapper.__name__ = getattr(fn, "__name__", name)
+    return wrapper
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+def render_metrics():
+    """All counters and histograms in Prometheus text exposition format"""
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        histograms = {k: list(v) for k, v in _histograms.items()}
+
+    lines = []
+    for name in sorted({n for n, _ in counters}):
+        lines.append(f"# TYPE {name} counter")
+        for (n, labels), value in counters.items():
+            if n == name:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+    for name in sorted({n for n, _ in gauges}):
+        lines.append(f"# TYPE {name} gauge")
+        for (n, labels), value in gauges.items():
+            if n == name:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+    for name in sorted({n for n, _ in histograms}):
+        lines.append(f"# TYPE {name} histogram")
+        for (n, labels), hist in histograms.items():
+            if n != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, hist):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {hist[-1]}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {hist[-2]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {hist[-1]}")
+    return "\n".join(lines) + "\n"
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+_server = None
+
+def start_metrics_server(port=METRICS_PORT, host="127.0.0.1"):
+    """Serve /metrics from a daemon thread; no-op when tracing is off or already started"""
+    global _server
+    if not TRACE_ENABLED or _server is not None:
+        return _server
+    _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("[tracing] Metrics on http://%s:%d/metrics, traces in %s", host, port, TRACE_FILE)
+    return _server